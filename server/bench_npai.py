@@ -0,0 +1,361 @@
+"""Replay benchmark for npai.py against local stand-ins for the Grok (OpenAI-compatible) and Gemini APIs.
+
+The stand-ins replay responses recorded in an npai response and photo cache, fall back to synthesised
+replies for anything unrecorded, and add configurable latency and error injection. The harness then
+drives run_pipeline and analyze_photo over a corpus of yard-chat batches for each engine configuration
+and reports throughput, latency percentiles and call counts.
+
+bench/corpus.jsonl is synthetic: batches written in the style of the prompts' own examples, not recorded
+yard traffic, so its numbers compare engines rather than predict production latency. Recordings are read
+from bench/recordings.sqlite3 (git-ignored); to replay real replies, copy a cache filled by real runs
+there after scrubbing names and regos. The live .npai_cache.sqlite3 is never read, since replaying marks
+its entries as used.
+
+    python bench_npai.py [--corpus bench/corpus.jsonl] [--configs staged,grouped,streamed,fused]
+                         [--repeat 3] [--parallel 1] [--photos 8] [--latency-ms 600] [--latency-sigma 0.4]
+                         [--error-rate 0.02] [--recordings PATH] [--json]
+"""
+import sys
+import os
+import json
+import io
+import math
+import random
+import re
+import time
+import base64
+import threading
+import tempfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench", "corpus.jsonl")
+DEFAULT_RECORDINGS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench", "recordings.sqlite3")
+CONFIGS = {
+    "staged": {},
+    "grouped": {"grouped": True},
+    "streamed": {"streaming": True},
+    "fused": {"engine": "fused"}
+}
+GEMINI_PATH_PATTERN = re.compile(r"^/v1beta/models/(?P<model>[^:/]+):generateContent")
+
+# Fault injection and replay state shared by both stand-in servers
+settings = {"latency_ms": 600.0, "latency_sigma": 0.4, "error_rate": 0.0, "error_statuses": [429, 500, 503]}
+server_stats = {"requests": 0, "replayed": 0, "synthesised": 0, "injected_errors": 0}
+server_stats_lock = threading.Lock()
+recordings = {"responses": None, "photos": None}
+# System prompts seen so far; a repeat is reported as a prefix-cache hit, like the real provider
+seen_prefixes = set()
+# Lead line npai puts in front of the payload in the user turn
+PROMPT_LEAD_PATTERN = re.compile(r"^\s*(?:Now,? process|Messages):\s*\n")
+
+def count_server(name: str):
+    with server_stats_lock:
+        server_stats[name] += 1
+
+def sample_latency() -> float:
+    """Draw one response latency in seconds from a log-normal around the configured median."""
+    if settings["latency_ms"] <= 0:
+        return 0.0
+    return random.lognormvariate(math.log(settings["latency_ms"] / 1000), settings["latency_sigma"])
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+def prompt_input_lines(prompt: str) -> list:
+    """Return the batch lines a user turn carries, without the template's lead line."""
+    body = PROMPT_LEAD_PATTERN.sub("", prompt, count=1)
+    return [line.strip() for line in body.strip().split("\n") if line.strip()]
+
+def synthesise_grok(system: str, prompt: str, response_format: dict = None) -> str:
+    """Produce a well-formed reply for a prompt that has no recording, shaped like the real prompt's output."""
+    lines = prompt_input_lines(prompt)
+    if response_format:
+        records = []
+        for line in lines:
+            sender, _, summary = line.replace("[PHOTO] ", "").partition(": ")
+            records.append({
+                "sender": sender or "Unknown", "summary": summary or line, "category": "Notes",
+                "from_photo": line.startswith("[PHOTO]"), "fields": {"notes": summary or line}
+            })
+        return json.dumps({"records": records})
+    if "reconditioner category" in system:
+        return "[other, Technician]"
+    bullets = [line if line.startswith("- ") else f"- {line}" for line in lines]
+    if "Summarise the main points" in system or "Add the entire name" in system:
+        return "\n".join(bullets)
+    if "assign exactly one category" in system:
+        return "\n".join(f"{line}: Notes" for line in bullets)
+    return "\n".join(f"{line} : [, , , , , {line[2:]}]" for line in bullets)
+
+def replay_grok(body: dict) -> str:
+    """Look the request up in the recorded responses, the same way npai keys its response cache."""
+    messages = body.get("messages", [])
+    system = next((m["content"] for m in messages if m.get("role") == "system"), "")
+    prompt = next((m["content"] for m in reversed(messages) if m.get("role") == "user"), "")
+    response_format = body.get("response_format")
+    if recordings["responses"] is not None:
+        parts = [body.get("model"), system, body.get("max_tokens"), body.get("temperature", 0), prompt]
+        # Plain and structured calls add the response format; streamed calls do not
+        keys = [npai.ResponseCache.make_key(*parts, json.dumps(response_format, sort_keys=True) if response_format else "")]
+        if body.get("stream"):
+            keys.append(npai.ResponseCache.make_key(*parts))
+        for key in keys:
+            cached = recordings["responses"].get(key)
+            if cached is not None:
+                count_server("replayed")
+                return cached
+    count_server("synthesised")
+    return synthesise_grok(system, prompt, response_format)
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Serves /v1/chat/completions (Grok) and /v1beta/models/*:generateContent (Gemini)."""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status: int, payload: dict, headers: dict = None):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        count_server("requests")
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        latency = sample_latency()
+        if random.random() < settings["error_rate"]:
+            count_server("injected_errors")
+            time.sleep(latency / 4)
+            status = random.choice(settings["error_statuses"])
+            self.send_json(status, {"error": {"message": "injected by bench_npai", "code": status}},
+                           {"retry-after-ms": "50"} if status == 429 else None)
+            return
+        if self.path.rstrip("/").endswith("/chat/completions"):
+            self.chat_completion(body, latency)
+        elif GEMINI_PATH_PATTERN.match(self.path):
+            self.generate_content(body, latency)
+        else:
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def chat_completion(self, body: dict, latency: float):
+        content = replay_grok(body)
+        prompt_tokens = sum(estimate_tokens(m.get("content", "")) for m in body.get("messages", []))
+        system = next((m["content"] for m in body.get("messages", []) if m.get("role") == "system"), "")
+        with server_stats_lock:
+            cached_tokens = estimate_tokens(system) if (body.get("model"), system) in seen_prefixes else 0
+            seen_prefixes.add((body.get("model"), system))
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached_tokens},
+            "completion_tokens": estimate_tokens(content),
+            "total_tokens": prompt_tokens + estimate_tokens(content)
+        }
+        base = {"id": f"chatcmpl-bench-{random.getrandbits(32)}", "created": int(time.time()), "model": body.get("model")}
+        if not body.get("stream"):
+            time.sleep(latency)
+            self.send_json(200, dict(base, object="chat.completion", usage=usage, choices=[
+                {"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}
+            ]))
+            return
+        # Stream line by line: a third of the latency before the first token, the rest spread over the lines
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        pieces = [line + "\n" for line in content.split("\n")]
+        time.sleep(latency / 3)
+        for piece in pieces:
+            time.sleep(latency * 2 / 3 / len(pieces))
+            self.send_event(dict(base, object="chat.completion.chunk", choices=[
+                {"index": 0, "delta": {"content": piece}, "finish_reason": None}
+            ]))
+        self.send_event(dict(base, object="chat.completion.chunk", choices=[
+            {"index": 0, "delta": {}, "finish_reason": "stop"}
+        ]))
+        if (body.get("stream_options") or {}).get("include_usage"):
+            self.send_event(dict(base, object="chat.completion.chunk", choices=[], usage=usage))
+        self.send_chunk(b"data: [DONE]\n\n")
+        self.send_chunk(b"")
+
+    def send_event(self, payload: dict):
+        self.send_chunk(f"data: {json.dumps(payload)}\n\n".encode("utf-8"))
+
+    def send_chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def generate_content(self, body: dict, latency: float):
+        text = None
+        prompt = ""
+        for part in (body.get("contents") or [{}])[0].get("parts", []):
+            inline = part.get("inlineData") or part.get("inline_data")
+            if inline and recordings["photos"] is not None:
+                image = npai.open_image(base64.b64decode(inline.get("data", "")))
+                if image is not None:
+                    text = recordings["photos"].lookup(npai.perceptual_hash(image))
+            prompt += part.get("text", "")
+        count_server("replayed" if text is not None else "synthesised")
+        text = text or "Photo: White Toyota Hilux rego 1AB2CD"
+        time.sleep(latency)
+        self.send_json(200, {
+            "candidates": [{"content": {"parts": [{"text": text}], "role": "model"}, "finishReason": "STOP", "index": 0}],
+            "usageMetadata": {
+                "promptTokenCount": estimate_tokens(prompt) + 258,
+                "candidatesTokenCount": estimate_tokens(text),
+                "totalTokenCount": estimate_tokens(prompt) + 258 + estimate_tokens(text)
+            }
+        })
+
+def start_stand_in() -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def percentile(samples: list, pct: float):
+    """Nearest-rank percentile, or None for no samples."""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return round(ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)], 3)
+
+def summarise(latencies: list, wall: float, **extra) -> dict:
+    return dict({
+        "runs": len(latencies),
+        "throughput_per_s": round(len(latencies) / wall, 3) if wall else None,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99)
+    }, **extra)
+
+def reset_server_stats() -> dict:
+    with server_stats_lock:
+        snapshot = dict(server_stats)
+        for key in server_stats:
+            server_stats[key] = 0
+    return snapshot
+
+def bench_pipeline(corpus: list, options: dict, repeat: int, parallel: int) -> dict:
+    """Run every corpus batch `repeat` times through run_pipeline and summarise latency and calls."""
+    runs = [batch for _ in range(repeat) for batch in corpus]
+    results = []
+
+    def run(batch):
+        started = time.monotonic()
+        output = npai.run_pipeline(batch["message"], batch.get("media_url"), use_cache=False, **options)
+        return time.monotonic() - started, output
+
+    reset_server_stats()
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+        results = list(executor.map(run, runs))
+    wall = time.monotonic() - started
+    usages = [output["usage"] for _, output in results]
+    return summarise(
+        [latency for latency, _ in results], wall,
+        calls_per_batch=round(sum(u["calls"] for u in usages) / len(usages), 2) if usages else None,
+        tokens_per_batch=round(sum(u["total_tokens"] for u in usages) / len(usages), 1) if usages else None,
+        cached_share=round(sum(u.get("cached_tokens", 0) for u in usages) / max(1, sum(u["prompt_tokens"] for u in usages)), 3),
+        cost_per_batch=round(sum(u.get("cost_usd", 0) for u in usages) / len(usages), 6) if usages else None,
+        retries=sum(u.get("retries", 0) for u in usages),
+        errors=sum(1 for _, output in results if output.get("error")),
+        failed_lines=sum(len(output.get("failed_lines", [])) for _, output in results),
+        server=reset_server_stats()
+    )
+
+def bench_photos(count: int, parallel: int) -> dict:
+    """Analyse `count` generated JPEGs through analyze_photo and summarise latency."""
+    if count <= 0 or npai.Image is None:
+        return None
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for i in range(count):
+            path = os.path.join(directory, f"photo_{i}.jpg")
+            npai.Image.new("RGB", (1600, 1200), (random.randrange(256), random.randrange(256), random.randrange(256))).save(path, "JPEG")
+            paths.append(path)
+
+        def run(path):
+            started = time.monotonic()
+            npai.analyze_photo(path, use_cache=False)
+            return time.monotonic() - started
+
+        reset_server_stats()
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+            latencies = list(executor.map(run, paths))
+        return summarise(latencies, time.monotonic() - started, server=reset_server_stats())
+
+def load_corpus(path: str) -> list:
+    with open(path, encoding="utf-8") as corpus_file:
+        return [json.loads(line) for line in corpus_file if line.strip()]
+
+def parse_args(argv: list) -> dict:
+    args = {
+        "corpus": DEFAULT_CORPUS, "configs": ",".join(CONFIGS), "repeat": "1", "parallel": "1", "photos": "4",
+        "latency-ms": "600", "latency-sigma": "0.4", "error-rate": "0", "recordings": DEFAULT_RECORDINGS, "json": False
+    }
+    i = 0
+    while i < len(argv):
+        name = argv[i].lstrip("-")
+        if name not in args:
+            raise SystemExit(f"Unknown option {argv[i]}\n{__doc__}")
+        if args[name] is False:
+            args[name] = True
+            i += 1
+        else:
+            args[name] = argv[i + 1]
+            i += 2
+    return args
+
+def main(argv: list) -> int:
+    global npai
+    args = parse_args(argv)
+    settings.update(
+        latency_ms=float(args["latency-ms"]),
+        latency_sigma=float(args["latency-sigma"]),
+        error_rate=float(args["error-rate"])
+    )
+    server = start_stand_in()
+    endpoint = f"http://127.0.0.1:{server.server_address[1]}"
+    # npai builds its clients at import, so point it at the stand-ins first
+    os.environ["XAI_BASE_URL"] = f"{endpoint}/v1"
+    os.environ["NPAI_GEMINI_ENDPOINT"] = endpoint
+    os.environ.setdefault("XAI_API_KEY", "bench")
+    os.environ.setdefault("GOOGLE_API_KEY", "bench")
+    # The stand-ins have no quota; set NPAI_RATE_LIMIT=true and NPAI_GROK_RPM/TPM to measure the limiter itself
+    os.environ.setdefault("NPAI_RATE_LIMIT", "false")
+    os.environ.setdefault("NPAI_RATE_LIMIT_PATH", os.path.join(tempfile.gettempdir(), "npai_bench_ratelimit.json"))
+    import npai
+    if os.path.exists(args["recordings"]):
+        recordings["responses"] = npai.ResponseCache(args["recordings"], npai.CACHE_MAX_ENTRIES, 0)
+        recordings["photos"] = npai.PhotoHashCache(args["recordings"], npai.PHOTO_CACHE_MAX_ENTRIES, 0, npai.PHOTO_HASH_THRESHOLD)
+
+    corpus = load_corpus(args["corpus"])
+    report = {"corpus": len(corpus), "settings": dict(settings), "pipeline": {}}
+    for name in args["configs"].split(","):
+        report["pipeline"][name] = bench_pipeline(corpus, CONFIGS[name], int(args["repeat"]), int(args["parallel"]))
+    report["photos"] = bench_photos(int(args["photos"]), int(args["parallel"]))
+    server.shutdown()
+
+    if args["json"]:
+        print(json.dumps(report, indent=2))
+        return 0
+    print(f"{len(corpus)} batches, latency {settings['latency_ms']}ms (sigma {settings['latency_sigma']}), "
+          f"error rate {settings['error_rate']}")
+    print(f"{'config':<10} {'runs':>5} {'per s':>7} {'p50':>7} {'p95':>7} {'p99':>7} {'calls':>6} {'tokens':>8} {'cached':>7} {'retries':>7} {'errors':>6}")
+    for name, row in report["pipeline"].items():
+        print(f"{name:<10} {row['runs']:>5} {row['throughput_per_s']:>7} {row['p50']:>7} {row['p95']:>7} {row['p99']:>7} "
+              f"{row['calls_per_batch']:>6} {row['tokens_per_batch']:>8} {row['cached_share']:>7} {row['retries']:>7} {row['errors']:>6}")
+    if report["photos"]:
+        row = report["photos"]
+        print(f"{'photos':<10} {row['runs']:>5} {row['throughput_per_s']:>7} {row['p50']:>7} {row['p95']:>7} {row['p99']:>7}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,16 +1,6 @@
-const { spawn } = require('child_process');
-const path = require('path');
-const { log } = require('./simpleLogger');
+const { request } = require('../utils/npaiWorker');
 
-module.exports = (prompt) => new Promise((resolve, reject) => {
-  const py = spawn('python', [path.join(__dirname, '../npai.py'), prompt]);
-
-  let stdout = '';
-  const echo = (buf) => log.python(buf.toString().trim());
-
-  py.stdout.on('data', (d) => { stdout += d.toString(); echo(d); });
-  py.stderr.on('data', echo);
-
-  py.on('close', (code) =>
-    code === 0 ? resolve(stdout) : reject(new Error(`python exit ${code}`)));
-});
\ No newline at end of file
+// Run a prompt through the shared npai worker and resolve with the JSON text
+// the one-shot `python npai.py <prompt>` used to print.
+module.exports = (prompt) =>
+  request('pipeline', { message: prompt }).then((result) => JSON.stringify(result));
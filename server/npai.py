@@ -1,107 +1,1345 @@
 import sys
-import base64
-import google.generativeai as genai
-from openai import OpenAI
+import time
+# Taken before the other imports so --profile-startup can report their cost
+STARTUP_STARTED = time.perf_counter()
 import os
-import requests
+import importlib.util
 import json
+import io
+import mmap
 import re
-
-# Configure APIs
-genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
-
-client = OpenAI(
-    api_key=os.getenv("XAI_API_KEY"),
-    base_url="https://api.x.ai/v1"
-)
-
-# Helper Functions
-def analyze_with_grok(prompt):
-    """Send a prompt to Grok 3 and return the response."""
+import difflib
+import hashlib
+import sqlite3
+import tempfile
+import random
+import math
+from collections import deque
+from urllib.parse import urlsplit
+from email.utils import parsedate_to_datetime
+import socketserver
+import threading
+import contextvars
+from contextlib import contextmanager
+from types import SimpleNamespace
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait
+
+try:
+    import fcntl
+except ImportError:
+    # No flock on Windows; the rate limiter then only coordinates threads within one process
+    fcntl = None
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    # Pillow is only needed for photo hashing and downscaling; photos are still analysed without it
+    Image = ImageOps = None
+
+# Seconds spent in each startup step; provider SDKs add theirs on first use
+startup_timings = {"imports": round(time.perf_counter() - STARTUP_STARTED, 4)}
+
+@contextmanager
+def startup_step(name: str):
+    """Time one startup step into startup_timings."""
+    started = time.perf_counter()
     try:
-        response = client.chat.completions.create(
-            model="grok-3-latest",
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "You are a transformation engine that strictly follows instructions and outputs "
-                        "only in the specified format without any extra commentary or blank sub-messages."
+        yield
+    finally:
+        startup_timings[name] = round(time.perf_counter() - started, 4)
+
+# Read once; debug output is checked on every line of every stage
+DEBUG_MODE = os.getenv('DEBUG_MODE') == 'true'
+
+# Pipeline settings
+WORKER_THREADS = int(os.getenv("NPAI_WORKER_THREADS", "4"))
+# Upper bound on concurrent category prompt calls per batch
+MAX_CONCURRENCY = int(os.getenv("NPAI_MAX_CONCURRENCY", "8"))
+# Send each category prompt once with all of its lines instead of once per line
+GROUP_CATEGORIES = os.getenv("NPAI_GROUP_CATEGORIES") == 'true'
+# Minimum similarity for matching a grouped reply line back to its source line
+GROUP_MATCH_THRESHOLD = float(os.getenv("NPAI_GROUP_MATCH_THRESHOLD", "0.6"))
+# Stream prompt_1 -> prompt_2 -> prompt_3 -> category prompts line by line instead of stage by stage
+STREAMING = os.getenv("NPAI_STREAMING") == 'true'
+# Streamed lines are passed to prompt_2 and prompt_3 in micro-batches of up to this many lines, or
+# whatever has arrived this many seconds after the first, so streaming doesn't multiply the calls
+STREAM_BATCH_SIZE = int(os.getenv("NPAI_STREAM_BATCH_SIZE", "4"))
+STREAM_BATCH_WAIT = float(os.getenv("NPAI_STREAM_BATCH_WAIT", "0.5"))
+# "staged" runs prompt_1 -> prompt_2 -> prompt_3 -> category prompts; "fused" does it all in one structured call
+ENGINE = os.getenv("NPAI_ENGINE", "staged")
+# Keyword table used to classify repair tasks without a Grok call
+RECONDITIONER_RULES_PATH = os.getenv(
+    "NPAI_RECONDITIONER_RULES",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "config", "reconditioner_rules.json")
+)
+# Make/model alias table used to expand vehicle shorthand without prompt_2
+VEHICLE_ALIASES_PATH = os.getenv(
+    "NPAI_VEHICLE_ALIASES",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "config", "vehicle_aliases.json")
+)
+# Known yard and reconditioner locations used by the deterministic extractors
+LOCATIONS_PATH = os.getenv(
+    "NPAI_LOCATIONS",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "config", "locations.json")
+)
+# Drop chat lines prompt_1 would discard ("ok", "nah thats okay", emoji) before any LLM call
+CHATTER_FILTER = os.getenv("NPAI_CHATTER_FILTER", "true") == 'true'
+CHATTER_RULES_PATH = os.getenv(
+    "NPAI_CHATTER_RULES",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "config", "chatter_filter.json")
+)
+# Written by --train-chatter-filter from the bot's log
+CHATTER_MODEL_PATH = os.getenv(
+    "NPAI_CHATTER_MODEL",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "config", "chatter_model.json")
+)
+# A line is only dropped on the model's word when it is at least this sure; raise it to keep recall high
+CHATTER_THRESHOLD = float(os.getenv("NPAI_CHATTER_THRESHOLD", "0.95"))
+
+# Metrics settings
+# Optional file receiving per-run metrics: "jsonl" appends one line per run, "prometheus" rewrites running totals
+METRICS_FILE = os.getenv("NPAI_METRICS_FILE")
+METRICS_FORMAT = os.getenv("NPAI_METRICS_FORMAT", "jsonl")
+# USD per million (prompt, cached prompt, completion) tokens, for cost estimates
+LLM_PRICES = {
+    "grok": (
+        float(os.getenv("NPAI_GROK_PRICE_PROMPT", "3.0")),
+        float(os.getenv("NPAI_GROK_PRICE_CACHED", "0.75")),
+        float(os.getenv("NPAI_GROK_PRICE_COMPLETION", "15.0"))
+    ),
+    "gemini": (
+        float(os.getenv("NPAI_GEMINI_PRICE_PROMPT", "0.075")),
+        float(os.getenv("NPAI_GEMINI_PRICE_CACHED", "0.01875")),
+        float(os.getenv("NPAI_GEMINI_PRICE_COMPLETION", "0.3"))
+    )
+}
+
+# Response cache settings
+CACHE_PATH = os.getenv("NPAI_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".npai_cache.sqlite3"))
+CACHE_MAX_ENTRIES = int(os.getenv("NPAI_CACHE_MAX_ENTRIES", "5000"))
+CACHE_TTL = int(os.getenv("NPAI_CACHE_TTL", str(7 * 24 * 60 * 60)))
+CACHE_BYPASS = os.getenv("NPAI_CACHE_BYPASS") == 'true'
+# Photos whose perceptual hashes differ by at most this many bits reuse the cached description.
+# Exact matches only by default: two same-coloured cars shot from the same angle can land a few
+# bits apart, and a near hit would hand one car's rego to the other.
+PHOTO_HASH_THRESHOLD = int(os.getenv("NPAI_PHOTO_HASH_THRESHOLD", "0"))
+PHOTO_CACHE_MAX_ENTRIES = int(os.getenv("NPAI_PHOTO_CACHE_MAX_ENTRIES", "2000"))
+# Reuse results for re-worded repeats ("take the ranger to als" / "Ranger to Al's pls") that mention the same
+# entities. Off by default: trigram similarity can't tell "needs new tyres" from "needs new brakes"
+SEMANTIC_CACHE = os.getenv("NPAI_SEMANTIC_CACHE", "false") == 'true'
+# Minimum estimated Jaccard similarity of the normalised texts' character trigrams
+SEMANTIC_THRESHOLD = float(os.getenv("NPAI_SEMANTIC_THRESHOLD", "0.7"))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("NPAI_SEMANTIC_CACHE_MAX_ENTRIES", "2000"))
+# Concurrent identical Grok prompts or photos share one in-flight call instead of each making it
+SINGLE_FLIGHT = os.getenv("NPAI_SINGLE_FLIGHT", "true") == 'true'
+# Upper bound on concurrent Gemini calls when analysing a media group
+PHOTO_CONCURRENCY = int(os.getenv("NPAI_PHOTO_CONCURRENCY", "4"))
+# Downloads larger than this are refused rather than buffered
+MAX_IMAGE_BYTES = int(os.getenv("NPAI_MAX_IMAGE_BYTES", str(20 * 1024 * 1024)))
+# Photos are downscaled so their longest side is at most this many pixels before upload
+IMAGE_MAX_SIDE = int(os.getenv("NPAI_IMAGE_MAX_SIDE", "1280"))
+IMAGE_QUALITY = int(os.getenv("NPAI_IMAGE_QUALITY", "80"))
+
+# Grok retry and hedging settings
+GROK_MAX_RETRIES = int(os.getenv("NPAI_GROK_MAX_RETRIES", "4"))
+GROK_BACKOFF_BASE = float(os.getenv("NPAI_GROK_BACKOFF_BASE", "0.5"))
+GROK_BACKOFF_MAX = float(os.getenv("NPAI_GROK_BACKOFF_MAX", "20"))
+# Longest Retry-After we are willing to honour before giving up on the wait
+GROK_RETRY_AFTER_MAX = float(os.getenv("NPAI_GROK_RETRY_AFTER_MAX", "60"))
+# Send a duplicate request when an attempt runs past the observed p95 latency
+GROK_HEDGE = os.getenv("NPAI_GROK_HEDGE") == 'true'
+GROK_HEDGE_MIN_SAMPLES = int(os.getenv("NPAI_GROK_HEDGE_MIN_SAMPLES", "20"))
+GROK_LATENCY_WINDOW = 200
+RETRYABLE_STATUS_CODES = (408, 429)
+
+# Provider rate limit settings; off unless turned on with the account's real quotas below
+RATE_LIMIT = os.getenv("NPAI_RATE_LIMIT", "false") == 'true'
+# (requests, tokens) per minute each provider allows this key; 0 (the default) leaves that dimension unlimited
+RATE_LIMITS = {
+    "grok": (int(os.getenv("NPAI_GROK_RPM", "0")), int(os.getenv("NPAI_GROK_TPM", "0"))),
+    "gemini": (int(os.getenv("NPAI_GEMINI_RPM", "0")), int(os.getenv("NPAI_GEMINI_TPM", "0")))
+}
+# Share of each quota we spend, leaving room for clock drift and other clients of the same key
+RATE_LIMIT_HEADROOM = float(os.getenv("NPAI_RATE_LIMIT_HEADROOM", "0.9"))
+# Bucket state shared by every npai process on the host, kept out of the source tree
+RATE_LIMIT_PATH = os.getenv("NPAI_RATE_LIMIT_PATH", os.path.join(tempfile.gettempdir(), "npai_ratelimit.json"))
+# Longest a call queues for quota before going out anyway and leaving any 429 to the retry loop
+RATE_LIMIT_MAX_WAIT = float(os.getenv("NPAI_RATE_LIMIT_MAX_WAIT", "60"))
+# Reply tokens reserved up front; the real count is settled once the provider reports usage
+RATE_LIMIT_REPLY_TOKENS = int(os.getenv("NPAI_RATE_LIMIT_REPLY_TOKENS", "300"))
+# How long every process holds off Gemini after a 429; Grok's own Retry-After or backoff is used for Grok
+RATE_LIMIT_COOLDOWN = float(os.getenv("NPAI_RATE_LIMIT_COOLDOWN", "10"))
+# Gemini bills a photo at a flat token count whatever its size
+GEMINI_IMAGE_TOKENS = 258
+
+# HTTP connection pool settings
+HTTP_POOL_SIZE = int(os.getenv("NPAI_HTTP_POOL_SIZE", "16"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("NPAI_HTTP_KEEPALIVE_EXPIRY", "60"))
+# HTTP/2 needs the optional h2 package; without it httpx stays on HTTP/1.1 keep-alive
+HTTP2_ENABLED = os.getenv("NPAI_HTTP2", "true") == 'true' and importlib.util.find_spec("h2") is not None
+# (connect, read) timeouts in seconds, overridable per host with NPAI_HTTP_TIMEOUTS="host=connect/read,..."
+HTTP_DEFAULT_TIMEOUT = (5.0, 10.0)
+HTTP_TIMEOUTS = {
+    "api.x.ai": (5.0, 120.0),
+    "api.telegram.org": (5.0, 20.0),
+}
+for _override in filter(None, os.getenv("NPAI_HTTP_TIMEOUTS", "").split(",")):
+    _host, _, _timeouts = _override.partition("=")
+    _connect, _, _read = _timeouts.partition("/")
+    HTTP_TIMEOUTS[_host.strip()] = (float(_connect), float(_read or _connect))
+
+def http_timeout(url: str) -> tuple:
+    """Return the (connect, read) timeout configured for the URL's host."""
+    return HTTP_TIMEOUTS.get(urlsplit(url).hostname, HTTP_DEFAULT_TIMEOUT)
+
+# Provider SDKs and clients are created on first use, so a run that never calls a provider never imports it.
+# The endpoint overrides point both providers at local stand-ins (see bench_npai.py).
+GEMINI_ENDPOINT = os.getenv("NPAI_GEMINI_ENDPOINT")
+XAI_BASE_URL = os.getenv("XAI_BASE_URL", "https://api.x.ai/v1")
+http_session = None
+grok_client = None
+gemini_model = None
+provider_lock = threading.Lock()
+PROVIDER_STARTUP_STEPS = ("import:requests", "init:http_session", "import:openai", "init:grok_client",
+                          "import:google.generativeai", "init:gemini_model")
+
+def get_http_session():
+    """Shared keep-alive pool for plain HTTP downloads."""
+    global http_session
+    if http_session is not None:
+        return http_session
+    with provider_lock:
+        if http_session is None:
+            with startup_step("import:requests"):
+                import requests
+                from requests.adapters import HTTPAdapter
+            with startup_step("init:http_session"):
+                session = requests.Session()
+                session.mount("https://", HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE))
+                session.mount("http://", HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE))
+            http_session = session
+    return http_session
+
+def get_grok_client():
+    """The process-wide Grok (OpenAI-compatible) client."""
+    global grok_client
+    if grok_client is not None:
+        return grok_client
+    with provider_lock:
+        if grok_client is None:
+            with startup_step("import:openai"):
+                import httpx
+                from openai import OpenAI
+            with startup_step("init:grok_client"):
+                grok_connect_timeout, grok_read_timeout = http_timeout(XAI_BASE_URL)
+                grok_client = OpenAI(
+                    api_key=os.getenv("XAI_API_KEY"),
+                    base_url=XAI_BASE_URL,
+                    # Retries are handled by call_grok so every attempt is counted and backoff is ours
+                    max_retries=0,
+                    http_client=httpx.Client(
+                        http2=HTTP2_ENABLED,
+                        limits=httpx.Limits(
+                            max_connections=HTTP_POOL_SIZE,
+                            max_keepalive_connections=HTTP_POOL_SIZE,
+                            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+                        ),
+                        timeout=httpx.Timeout(grok_read_timeout, connect=grok_connect_timeout)
                     )
-                },
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=4096,
-            temperature=0
-        )
-        return response.choices[0].message.content.strip()
+                )
+    return grok_client
+
+def get_gemini_model():
+    """One model object for the process; the SDK keeps its channel open between calls."""
+    global gemini_model
+    if gemini_model is not None:
+        return gemini_model
+    with provider_lock:
+        if gemini_model is None:
+            with startup_step("import:google.generativeai"):
+                import google.generativeai as genai
+            with startup_step("init:gemini_model"):
+                if GEMINI_ENDPOINT:
+                    genai.configure(api_key=os.getenv("GOOGLE_API_KEY"), transport="rest",
+                                    client_options={"api_endpoint": GEMINI_ENDPOINT})
+                else:
+                    genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+                gemini_model = genai.GenerativeModel("gemini-1.5-flash")
+    return gemini_model
+
+GROK_MODEL = "grok-3-latest"
+GROK_SYSTEM_PROMPT = (
+    "You are a transformation engine that strictly follows instructions and outputs "
+    "only in the specified format without any extra commentary or blank sub-messages."
+)
+GROK_MAX_TOKENS = 4096
+
+# Response Cache
+class ResponseCache:
+    """Persistent content-addressed cache with TTL and LRU eviction, stored in SQLite."""
+
+    def __init__(self, path: str, max_entries: int, ttl: int, table: str = "responses"):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.table = table
+        self.stats = {"hits": 0, "misses": 0, "expired": 0, "writes": 0, "evictions": 0}
+        self._lock = threading.Lock()
+        self._conn = None
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        """Hash the parts that fully determine a response into a cache key."""
+        digest = hashlib.sha256()
+        for part in parts:
+            digest.update(str(part).encode("utf-8"))
+            digest.update(b"\x00")
+        return digest.hexdigest()
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._conn.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_accessed ON {self.table} (accessed)")
+            self._conn.commit()
+        return self._conn
+
+    def get(self, key: str):
+        """Return the cached value for key, or None on a miss or expired entry."""
+        now = time.time()
+        try:
+            with self._lock:
+                conn = self._connection()
+                row = conn.execute(f"SELECT value, created FROM {self.table} WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    self.stats["misses"] += 1
+                    return None
+                value, created = row
+                if self.ttl and now - created > self.ttl:
+                    conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                    conn.commit()
+                    self.stats["expired"] += 1
+                    self.stats["misses"] += 1
+                    return None
+                conn.execute(f"UPDATE {self.table} SET accessed = ? WHERE key = ?", (now, key))
+                conn.commit()
+                self.stats["hits"] += 1
+                return value
+        except sqlite3.Error as e:
+            if DEBUG_MODE:
+                print(f"Cache read failed: {e}", file=sys.stderr)
+            self.stats["misses"] += 1
+            return None
+
+    def set(self, key: str, value: str):
+        """Store value under key and evict the least recently used entries over the size bound."""
+        now = time.time()
+        try:
+            with self._lock:
+                conn = self._connection()
+                conn.execute(
+                    f"INSERT OR REPLACE INTO {self.table} (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                    (key, value, now, now)
+                )
+                self.stats["writes"] += 1
+                count = conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+                if count > self.max_entries:
+                    conn.execute(
+                        f"DELETE FROM {self.table} WHERE key IN "
+                        f"(SELECT key FROM {self.table} ORDER BY accessed ASC LIMIT ?)",
+                        (count - self.max_entries,)
+                    )
+                    self.stats["evictions"] += count - self.max_entries
+                conn.commit()
+        except sqlite3.Error as e:
+            if DEBUG_MODE:
+                print(f"Cache write failed: {e}", file=sys.stderr)
+
+    def clear(self):
+        """Remove every entry from the cache."""
+        with self._lock:
+            conn = self._connection()
+            conn.execute(f"DELETE FROM {self.table}")
+            conn.commit()
+
+class PhotoHashCache(ResponseCache):
+    """Photo descriptions keyed by perceptual hash, matched within a Hamming-distance threshold."""
+
+    def __init__(self, path: str, max_entries: int, ttl: int, threshold: int, table: str = "photo_hashes"):
+        super().__init__(path, max_entries, ttl, table)
+        self.threshold = threshold
+        self.stats["near_hits"] = 0
+
+    def lookup(self, image_hash: int):
+        """Return the description of the closest cached photo within the threshold, or None."""
+        exact = self.get(f"{image_hash:016x}")
+        if exact is not None or self.threshold <= 0:
+            return exact
+        now = time.time()
+        try:
+            with self._lock:
+                conn = self._connection()
+                rows = conn.execute(f"SELECT key, value, created FROM {self.table}").fetchall()
+                best_key, best_value, best_distance = None, None, self.threshold + 1
+                for key, value, created in rows:
+                    if self.ttl and now - created > self.ttl:
+                        continue
+                    distance = bin(int(key, 16) ^ image_hash).count("1")
+                    if distance < best_distance:
+                        best_key, best_value, best_distance = key, value, distance
+                if best_key is None:
+                    return None
+                conn.execute(f"UPDATE {self.table} SET accessed = ? WHERE key = ?", (now, best_key))
+                conn.commit()
+                # The exact-key probe above already counted a miss
+                self.stats["misses"] -= 1
+                self.stats["hits"] += 1
+                self.stats["near_hits"] += 1
+                if DEBUG_MODE:
+                    print(f"Photo hash cache near hit at distance {best_distance}", file=sys.stderr)
+                return best_value
+        except sqlite3.Error as e:
+            if DEBUG_MODE:
+                print(f"Photo cache read failed: {e}", file=sys.stderr)
+            return None
+
+    def store(self, image_hash: int, description: str):
+        """Remember the description for a photo hash."""
+        self.set(f"{image_hash:016x}", description)
+
+with startup_step("init:caches"):
+    response_cache = ResponseCache(CACHE_PATH, CACHE_MAX_ENTRIES, CACHE_TTL)
+    photo_cache = PhotoHashCache(CACHE_PATH, PHOTO_CACHE_MAX_ENTRIES, CACHE_TTL, PHOTO_HASH_THRESHOLD)
+
+# Provider Rate Limits
+class RateLimiter:
+    """Request and token buckets per provider, shared between processes through a locked JSON state file.
+
+    Callers queue on tickets and are served in arrival order, so a large prompt is not starved by small ones.
+    """
+    # A waiter that has not polled for this long (its process died) loses its place in the queue
+    STALE_AFTER = 5.0
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, path: str, limits: dict, headroom: float):
+        self.path = path
+        self.limits = {
+            provider: (rpm * headroom, tpm * headroom) for provider, (rpm, tpm) in limits.items() if rpm > 0 or tpm > 0
+        }
+        self.stats = {"acquired": 0, "waits": 0, "wait_seconds": 0.0, "timeouts": 0, "throttled": 0}
+        self._lock = threading.Lock()
+        self._tickets = iter(range(1, sys.maxsize))
+        # Used when the state file cannot be opened, so limiting still holds within this process
+        self._local_state = {}
+
+    @contextmanager
+    def _state(self):
+        """Yield the shared state under an exclusive lock and write it back afterwards."""
+        with self._lock:
+            try:
+                handle = open(self.path, "a+")
+            except OSError as e:
+                if DEBUG_MODE:
+                    print(f"Rate limit state unavailable, limiting this process only: {e}", file=sys.stderr)
+                yield self._local_state
+                return
+            with handle:
+                if fcntl is not None:
+                    fcntl.flock(handle, fcntl.LOCK_EX)
+                handle.seek(0)
+                try:
+                    state = json.loads(handle.read() or "{}")
+                except ValueError:
+                    state = {}
+                yield state
+                handle.seek(0)
+                handle.truncate()
+                handle.write(json.dumps(state))
+
+    def _bucket(self, state: dict, provider: str, now: float) -> dict:
+        """Return the provider's bucket, refilled for the time since it was last touched."""
+        rpm, tpm = self.limits[provider]
+        bucket = state.setdefault(provider, {"requests": rpm, "tokens": tpm, "updated": now, "blocked_until": 0, "queue": []})
+        elapsed = max(now - bucket["updated"], 0)
+        bucket["requests"] = min(rpm, bucket["requests"] + elapsed * rpm / 60)
+        bucket["tokens"] = min(tpm, bucket["tokens"] + elapsed * tpm / 60)
+        bucket["updated"] = now
+        return bucket
+
+    def _shortfall(self, bucket: dict, provider: str, tokens: int, now: float) -> float:
+        """Seconds until the bucket can cover one request of `tokens` tokens."""
+        rpm, tpm = self.limits[provider]
+        wait = max(bucket["blocked_until"] - now, 0)
+        if rpm > 0 and bucket["requests"] < 1:
+            wait = max(wait, (1 - bucket["requests"]) * 60 / rpm)
+        if tpm > 0 and bucket["tokens"] < tokens:
+            wait = max(wait, (tokens - bucket["tokens"]) * 60 / tpm)
+        return wait
+
+    def acquire(self, provider: str, tokens: int = 0) -> int:
+        """Wait for the provider's quota to cover one request of about `tokens` tokens and take it.
+
+        Returns the tokens reserved, to be passed to settle() once the real usage is known.
+        """
+        if provider not in self.limits:
+            return 0
+        rpm, tpm = self.limits[provider]
+        tokens = min(tokens, tpm) if tpm > 0 else 0
+        ticket = f"{os.getpid()}-{next(self._tickets)}"
+        started = time.monotonic()
+        while True:
+            with self._state() as state:
+                now = time.time()
+                bucket = self._bucket(state, provider, now)
+                queue = [entry for entry in bucket["queue"] if entry[0] == ticket or now - entry[1] < self.STALE_AFTER]
+                if not any(entry[0] == ticket for entry in queue):
+                    queue.append([ticket, now])
+                wait = self._shortfall(bucket, provider, tokens, now) if queue[0][0] == ticket else self.POLL_INTERVAL
+                timed_out = wait > 0 and time.monotonic() - started >= RATE_LIMIT_MAX_WAIT
+                if wait <= 0 or timed_out:
+                    bucket["requests"] -= 1
+                    bucket["tokens"] -= tokens
+                    queue = [entry for entry in queue if entry[0] != ticket]
+                else:
+                    queue = [[entry[0], now] if entry[0] == ticket else entry for entry in queue]
+                bucket["queue"] = queue
+                if wait <= 0 or timed_out:
+                    waited = time.monotonic() - started
+                    self.stats["acquired"] += 1
+                    if waited >= self.POLL_INTERVAL:
+                        self.stats["waits"] += 1
+                        self.stats["wait_seconds"] = round(self.stats["wait_seconds"] + waited, 3)
+                    if timed_out:
+                        self.stats["timeouts"] += 1
+                        if DEBUG_MODE:
+                            print(f"Gave up waiting for {provider} quota after {waited:.1f}s", file=sys.stderr)
+                    return tokens
+            time.sleep(min(wait, 1.0))
+
+    def settle(self, provider: str, reserved: int, used: int):
+        """Correct the token bucket once a call reports how many tokens it really used.
+
+        Pass used=0 when the call failed, so the whole reservation is given back.
+        """
+        if provider not in self.limits or self.limits[provider][1] <= 0 or used == reserved:
+            return
+        with self._state() as state:
+            bucket = self._bucket(state, provider, time.time())
+            bucket["tokens"] -= used - reserved
+
+    def throttle(self, provider: str, delay: float):
+        """Hold every process off the provider for `delay` seconds after it answered 429."""
+        if provider not in self.limits:
+            return
+        with self._state() as state:
+            now = time.time()
+            bucket = self._bucket(state, provider, now)
+            bucket["blocked_until"] = max(bucket["blocked_until"], now + delay)
+            self.stats["throttled"] += 1
+
+    def report(self) -> dict:
+        return {**self.stats, "limits": {provider: list(limits) for provider, limits in self.limits.items()}}
+
+with startup_step("init:rate_limiter"):
+    rate_limiter = RateLimiter(RATE_LIMIT_PATH, RATE_LIMITS if RATE_LIMIT else {}, RATE_LIMIT_HEADROOM)
+
+def usage_tokens(usage) -> int:
+    """Prompt plus completion tokens of one call, or 0 when the provider did not report usage."""
+    if usage is None:
+        return 0
+    return (getattr(usage, "prompt_tokens", 0) or 0) + (getattr(usage, "completion_tokens", 0) or 0)
+
+def grok_tokens_estimate(messages: list) -> int:
+    """Tokens to reserve for a Grok call before sending it."""
+    return sum(estimate_tokens(message["content"]) for message in messages) + RATE_LIMIT_REPLY_TOKENS
+
+# Single-Flight Calls
+class SingleFlight:
+    """Runs one call per key at a time; callers arriving while it is in flight wait for its result.
+
+    Works for any threads in the process, so pipeline pool threads and worker request handlers share calls.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.stats = {}
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, kind: str, key: str, fn):
+        """Return fn()'s result, or the result of the identical call already in flight under (kind, key).
+
+        A failure is raised to the caller that made the call and to every caller waiting on it.
+        """
+        if not self.enabled:
+            return fn()
+        with self._lock:
+            stats = self.stats.setdefault(kind, {"calls": 0, "coalesced": 0})
+            future = self._calls.get((kind, key))
+            leader = future is None
+            if leader:
+                future = self._calls[(kind, key)] = Future()
+                stats["calls"] += 1
+            else:
+                stats["coalesced"] += 1
+        if not leader:
+            if DEBUG_MODE:
+                print(f"Waiting on identical in-flight {kind} call", file=sys.stderr)
+            count_avoided("single_flight")
+            return future.result()
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[(kind, key)]
+
+    def report(self) -> dict:
+        with self._lock:
+            return {kind: dict(stats) for kind, stats in self.stats.items()}
+
+single_flight = SingleFlight(SINGLE_FLIGHT)
+
+# Resilient Grok Calls
+class GrokError(Exception):
+    """Raised when Grok could not produce a response after all retries."""
+
+grok_stats = {"calls": 0, "attempts": 0, "retries": 0, "failures": 0, "hedged": 0, "hedge_wins": 0}
+grok_latencies = deque(maxlen=GROK_LATENCY_WINDOW)
+grok_stats_lock = threading.Lock()
+hedge_executor = None
+retryable_error_types = None
+
+def get_hedge_executor():
+    """The pool hedged attempts run on, created the first time a call is hedged."""
+    global hedge_executor
+    if hedge_executor is not None:
+        return hedge_executor
+    with provider_lock:
+        if hedge_executor is None:
+            hedge_executor = ThreadPoolExecutor(max_workers=2 * MAX_CONCURRENCY + WORKER_THREADS)
+    return hedge_executor
+
+def get_retryable_error_types() -> tuple:
+    """Transport-level exception types worth retrying, from whichever of the SDKs can be imported."""
+    global retryable_error_types
+    if retryable_error_types is not None:
+        return retryable_error_types
+    types = [ConnectionError, TimeoutError]
+    try:
+        import openai
+        types.append(openai.APIConnectionError)
+    except ImportError:
+        pass
+    try:
+        import httpx
+        types.append(httpx.TransportError)
+    except ImportError:
+        pass
+    retryable_error_types = tuple(types)
+    return retryable_error_types
+
+SPAN_COUNTERS = ("calls", "prompt_tokens", "cached_tokens", "completion_tokens", "cost_usd", "retries", "cache_hits")
+
+def cached_prompt_tokens(usage) -> int:
+    """Prompt tokens the provider served from its prefix cache, when it reports them."""
+    details = getattr(usage, "prompt_tokens_details", None)
+    return (getattr(details, "cached_tokens", 0) or 0) if details is not None else 0
+
+class RunMetrics:
+    """LLM calls, tokens, cost and timing spans recorded on behalf of one pipeline run."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.completion_tokens = 0
+        self.llm_seconds = 0.0
+        self.cost_usd = 0.0
+        self.retries = 0
+        self.cache_hits = 0
+        self.avoided_calls = {}
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def record_call(self, seconds: float, usage=None, provider: str = "grok"):
+        prompt_tokens = (getattr(usage, "prompt_tokens", 0) or 0) if usage is not None else 0
+        completion_tokens = (getattr(usage, "completion_tokens", 0) or 0) if usage is not None else 0
+        cached_tokens = min(cached_prompt_tokens(usage), prompt_tokens)
+        prompt_price, cached_price, completion_price = LLM_PRICES.get(provider, (0.0, 0.0, 0.0))
+        cost = ((prompt_tokens - cached_tokens) * prompt_price + cached_tokens * cached_price
+                + completion_tokens * completion_price) / 1_000_000
+        with self._lock:
+            self.calls += 1
+            self.llm_seconds += seconds
+            self.prompt_tokens += prompt_tokens
+            self.cached_tokens += cached_tokens
+            self.completion_tokens += completion_tokens
+            self.cost_usd += cost
+            current = span_var.get()
+            if current is not None:
+                current["calls"] += 1
+                current["prompt_tokens"] += prompt_tokens
+                current["cached_tokens"] += cached_tokens
+                current["completion_tokens"] += completion_tokens
+                current["cost_usd"] += cost
+
+    def record_event(self, name: str):
+        """Count a retry or cache hit on the run and on the innermost open span."""
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+            current = span_var.get()
+            if current is not None:
+                current[name] += 1
+
+    def record_avoided(self, source: str):
+        """Count an LLM call that a local fast path made unnecessary."""
+        with self._lock:
+            self.avoided_calls[source] = self.avoided_calls.get(source, 0) + 1
+
+    def add_span(self, record: dict):
+        record["cost_usd"] = round(record["cost_usd"], 6)
+        with self._lock:
+            self.spans.append(record)
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "prompt_tokens": self.prompt_tokens,
+                "cached_tokens": self.cached_tokens,
+                "completion_tokens": self.completion_tokens,
+                "total_tokens": self.prompt_tokens + self.completion_tokens,
+                "llm_seconds": round(self.llm_seconds, 3),
+                "cost_usd": round(self.cost_usd, 6),
+                "retries": self.retries,
+                "cache_hits": self.cache_hits,
+                "avoided_calls": dict(self.avoided_calls)
+            }
+
+    def report(self) -> dict:
+        """Return every span in start order plus per-stage totals."""
+        with self._lock:
+            spans = sorted(self.spans, key=lambda record: record["start"])
+        stages = {}
+        for record in spans:
+            stage = stages.setdefault(record["name"], dict({"count": 0, "seconds": 0.0}, **{key: 0 for key in SPAN_COUNTERS}))
+            stage["count"] += 1
+            stage["seconds"] = round(stage["seconds"] + record["seconds"], 3)
+            for key in SPAN_COUNTERS:
+                stage[key] = round(stage[key] + record[key], 6)
+        return {"spans": spans, "stages": stages}
+
+# Per-run state; in_context() carries it into pool threads
+run_metrics_var = contextvars.ContextVar("npai_run_metrics", default=None)
+cache_bypass_var = contextvars.ContextVar("npai_cache_bypass", default=False)
+span_var = contextvars.ContextVar("npai_span", default=None)
+
+@contextmanager
+def span(name: str, **attributes):
+    """Time a stage of the current run; LLM calls, retries and cache hits inside it are attributed to it."""
+    metrics = run_metrics_var.get()
+    if metrics is None:
+        yield None
+        return
+    record = dict({"name": name, "start": round(time.monotonic() - metrics.started, 3)}, **attributes)
+    record.update({key: 0 for key in SPAN_COUNTERS})
+    token = span_var.set(record)
+    started = time.monotonic()
+    try:
+        yield record
     except Exception as e:
-        if os.getenv('DEBUG_MODE') == 'true':
-            print(f"Error communicating with Grok: {e}", file=sys.stderr)
-        return "Error processing message"
-        
+        record["error"] = str(e)
+        raise
+    finally:
+        record["seconds"] = round(time.monotonic() - started, 3)
+        span_var.reset(token)
+        metrics.add_span(record)
+
+def record_event(name: str):
+    """Count a retry or cache hit on the current run, if there is one."""
+    metrics = run_metrics_var.get()
+    if metrics is not None:
+        metrics.record_event(name)
+
+# Running totals behind the Prometheus metrics file
+metrics_totals = {"runs": 0, "latency": 0.0, "usage": {}, "stages": {}, "avoided_calls": {}}
+metrics_file_lock = threading.Lock()
+
+def prometheus_label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def prometheus_text() -> str:
+    """Render metrics_totals in the Prometheus text exposition format."""
+    lines = [
+        "# HELP npai_runs_total Pipeline runs.", "# TYPE npai_runs_total counter",
+        f"npai_runs_total {metrics_totals['runs']}",
+        "# HELP npai_latency_seconds_total Wall-clock time spent in pipeline runs.",
+        "# TYPE npai_latency_seconds_total counter",
+        f"npai_latency_seconds_total {round(metrics_totals['latency'], 3)}"
+    ]
+    for key, value in metrics_totals["usage"].items():
+        lines += [f"# TYPE npai_{key}_total counter", f"npai_{key}_total {round(value, 6)}"]
+    for key in ("count", "seconds") + SPAN_COUNTERS:
+        lines.append(f"# TYPE npai_stage_{key}_total counter")
+        lines += [
+            f'npai_stage_{key}_total{{stage="{prometheus_label(stage)}"}} {round(totals[key], 6)}'
+            for stage, totals in metrics_totals["stages"].items()
+        ]
+    lines.append("# TYPE npai_avoided_calls_total counter")
+    lines += [
+        f'npai_avoided_calls_total{{source="{prometheus_label(source)}"}} {count}'
+        for source, count in metrics_totals["avoided_calls"].items()
+    ]
+    return "\n".join(lines) + "\n"
+
+def export_metrics(output: dict):
+    """Write one run's usage and spans to NPAI_METRICS_FILE, if configured."""
+    if not METRICS_FILE:
+        return
+    usage = output.get("usage", {})
+    report = output.get("metrics", {})
+    try:
+        with metrics_file_lock:
+            if METRICS_FORMAT == "prometheus":
+                metrics_totals["runs"] += 1
+                metrics_totals["latency"] += usage.get("latency", 0)
+                for key in ("calls", "prompt_tokens", "cached_tokens", "completion_tokens", "llm_seconds", "cost_usd", "retries", "cache_hits"):
+                    metrics_totals["usage"][key] = metrics_totals["usage"].get(key, 0) + usage.get(key, 0)
+                for source, count in usage.get("avoided_calls", {}).items():
+                    metrics_totals["avoided_calls"][source] = metrics_totals["avoided_calls"].get(source, 0) + count
+                for stage, totals in report.get("stages", {}).items():
+                    running = metrics_totals["stages"].setdefault(stage, {key: 0 for key in totals})
+                    for key, value in totals.items():
+                        running[key] += value
+                # Textfile collectors may read at any moment, so swap the whole file in at once
+                temp_path = f"{METRICS_FILE}.tmp"
+                with open(temp_path, "w", encoding="utf-8") as metrics_file:
+                    metrics_file.write(prometheus_text())
+                os.replace(temp_path, METRICS_FILE)
+            else:
+                with open(METRICS_FILE, "a", encoding="utf-8") as metrics_file:
+                    metrics_file.write(json.dumps({
+                        "time": round(time.time(), 3),
+                        "engine": output.get("engine"),
+                        "error": output.get("error"),
+                        "usage": usage,
+                        **report
+                    }) + "\n")
+    except OSError as e:
+        if DEBUG_MODE:
+            print(f"Could not write metrics to {METRICS_FILE}: {e}", file=sys.stderr)
+
+def in_context(fn):
+    """Wrap fn so pool threads run it in a copy of the caller's context (run metrics, cache bypass)."""
+    context = contextvars.copy_context()
+    return lambda *args: context.copy().run(fn, *args)
+
+def count_grok(name: str, amount: int = 1):
+    """Increment one of the grok_stats counters."""
+    with grok_stats_lock:
+        grok_stats[name] += amount
+
+def grok_latency_p95():
+    """Return the p95 of recent successful attempt latencies, or None until there are enough samples."""
+    with grok_stats_lock:
+        samples = sorted(grok_latencies)
+    if len(samples) < GROK_HEDGE_MIN_SAMPLES:
+        return None
+    return samples[int(0.95 * (len(samples) - 1))]
+
+def is_retryable(error: Exception) -> bool:
+    """Connection problems, timeouts, rate limits and server errors are worth another attempt."""
+    if isinstance(error, get_retryable_error_types()):
+        return True
+    status = getattr(error, "status_code", None)
+    return status is not None and (status in RETRYABLE_STATUS_CODES or status >= 500)
+
+def retry_delay(error: Exception, attempt: int) -> float:
+    """Honour Retry-After when the server sends one, otherwise use capped exponential backoff with full jitter."""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    retry_after = None
+    try:
+        if headers.get("retry-after-ms"):
+            retry_after = float(headers["retry-after-ms"]) / 1000
+        elif headers.get("retry-after"):
+            value = headers["retry-after"]
+            try:
+                retry_after = float(value)
+            except ValueError:
+                retry_after = parsedate_to_datetime(value).timestamp() - time.time()
+    except (TypeError, ValueError):
+        retry_after = None
+    if retry_after is not None:
+        return min(max(retry_after, 0), GROK_RETRY_AFTER_MAX)
+    return random.uniform(0, min(GROK_BACKOFF_MAX, GROK_BACKOFF_BASE * 2 ** attempt))
+
+def grok_attempt(messages: list, **options):
+    """Make one chat completion request and record its latency."""
+    reserved = rate_limiter.acquire("grok", grok_tokens_estimate(messages))
+    # A failed attempt used no tokens, so its reservation goes back before any retry reserves again
+    used = 0
+    started = time.monotonic()
+    try:
+        response = get_grok_client().chat.completions.create(
+            model=GROK_MODEL,
+            messages=messages,
+            max_tokens=GROK_MAX_TOKENS,
+            temperature=0,
+            **options
+        )
+        used = usage_tokens(getattr(response, "usage", None)) or reserved
+    finally:
+        rate_limiter.settle("grok", reserved, used)
+    with grok_stats_lock:
+        grok_latencies.append(time.monotonic() - started)
+    return response
+
+def hedged_grok_attempt(messages: list, **options):
+    """Make one attempt, firing a duplicate request if the first outlives the p95 latency."""
+    hedge_after = grok_latency_p95() if GROK_HEDGE else None
+    if hedge_after is None:
+        return grok_attempt(messages, **options)
+    primary = get_hedge_executor().submit(in_context(lambda: grok_attempt(messages, **options)))
+    done, _ = wait([primary], timeout=hedge_after)
+    if done:
+        return primary.result()
+    count_grok("hedged")
+    backup = get_hedge_executor().submit(in_context(lambda: grok_attempt(messages, **options)))
+    errors = []
+    for future in as_completed([primary, backup]):
+        try:
+            response = future.result()
+        except Exception as e:
+            errors.append(e)
+            continue
+        if future is backup:
+            count_grok("hedge_wins")
+        return response
+    raise errors[0]
+
+def call_grok(messages: list, **options):
+    """Call Grok with bounded retries, raising GrokError instead of returning placeholder text."""
+    count_grok("calls")
+    call_started = time.monotonic()
+    for attempt in range(GROK_MAX_RETRIES + 1):
+        count_grok("attempts")
+        started = time.monotonic()
+        try:
+            response = hedged_grok_attempt(messages, **options)
+            if DEBUG_MODE:
+                print(f"Grok attempt {attempt + 1} ok in {time.monotonic() - started:.2f}s", file=sys.stderr)
+            metrics = run_metrics_var.get()
+            if metrics is not None:
+                metrics.record_call(time.monotonic() - call_started, getattr(response, "usage", None))
+            return response
+        except Exception as e:
+            retryable = is_retryable(e)
+            if DEBUG_MODE:
+                print(f"Grok attempt {attempt + 1} failed in {time.monotonic() - started:.2f}s "
+                      f"(retryable: {retryable}): {e}", file=sys.stderr)
+            if not retryable or attempt == GROK_MAX_RETRIES:
+                count_grok("failures")
+                raise GrokError(f"Grok call failed after {attempt + 1} attempt(s): {e}") from e
+            count_grok("retries")
+            record_event("retries")
+            delay = retry_delay(e, attempt)
+            if getattr(e, "status_code", None) == 429:
+                rate_limiter.throttle("grok", delay)
+            time.sleep(delay)
+
+def stream_grok_lines(prompt, use_cache=True, system_prompt=GROK_SYSTEM_PROMPT, prompt_name=None):
+    """Yield Grok's response one complete line at a time as the streamed completion arrives.
+
+    Retries only happen before the first line is yielded; after that a failure raises GrokError.
+    """
+    use_cache = use_cache and not CACHE_BYPASS and not cache_bypass_var.get()
+    cache_key = ResponseCache.make_key(GROK_MODEL, system_prompt, GROK_MAX_TOKENS, 0, prompt)
+    if use_cache:
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            record_event("cache_hits")
+            for line in cached.split("\n"):
+                if line.strip():
+                    yield line
+            return
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": prompt}
+    ]
+    count_grok("calls")
+    call_started = time.monotonic()
+    metrics = run_metrics_var.get()
+    for attempt in range(GROK_MAX_RETRIES + 1):
+        count_grok("attempts")
+        yielded = False
+        usage = None
+        reserved = 0
+        settled = False
+        try:
+            reserved = rate_limiter.acquire("grok", grok_tokens_estimate(messages))
+            stream = get_grok_client().chat.completions.create(
+                model=GROK_MODEL,
+                messages=messages,
+                max_tokens=GROK_MAX_TOKENS,
+                temperature=0,
+                stream=True,
+                # The final chunk then carries token usage for the run metrics
+                stream_options={"include_usage": True}
+            )
+            lines = []
+            buffer = ""
+            for chunk in stream:
+                usage = getattr(chunk, "usage", None) or usage
+                if not chunk.choices:
+                    continue
+                buffer += chunk.choices[0].delta.content or ""
+                while "\n" in buffer:
+                    line, buffer = buffer.split("\n", 1)
+                    lines.append(line)
+                    if line.strip():
+                        yielded = True
+                        yield line
+            lines.append(buffer)
+            if buffer.strip():
+                yield buffer
+            rate_limiter.settle("grok", reserved, usage_tokens(usage) or reserved)
+            settled = True
+            if use_cache:
+                response_cache.set(cache_key, "\n".join(lines).strip())
+            if metrics is not None:
+                metrics.record_call(time.monotonic() - call_started, usage)
+            record_prompt_usage(prompt_name, usage)
+            return
+        except Exception as e:
+            if not settled:
+                rate_limiter.settle("grok", reserved, usage_tokens(usage) if yielded else 0)
+            retryable = is_retryable(e) and not yielded
+            if DEBUG_MODE:
+                print(f"Grok stream attempt {attempt + 1} failed (retryable: {retryable}): {e}", file=sys.stderr)
+            if not retryable or attempt == GROK_MAX_RETRIES:
+                count_grok("failures")
+                raise GrokError(f"Grok stream failed after {attempt + 1} attempt(s): {e}") from e
+            count_grok("retries")
+            record_event("retries")
+            delay = retry_delay(e, attempt)
+            if getattr(e, "status_code", None) == 429:
+                rate_limiter.throttle("grok", delay)
+            time.sleep(delay)
+
+# Helper Functions
+def analyze_with_grok(prompt, use_cache=True, response_format=None, system_prompt=GROK_SYSTEM_PROMPT, prompt_name=None):
+    """Send a prompt to Grok 3 and return the response, serving repeats from the response cache.
+
+    Raises GrokError when every retry fails, so callers never mistake an error for model output.
+    """
+    use_cache = use_cache and not CACHE_BYPASS and not cache_bypass_var.get()
+    cache_key = ResponseCache.make_key(
+        GROK_MODEL, system_prompt, GROK_MAX_TOKENS, 0, prompt,
+        json.dumps(response_format, sort_keys=True) if response_format else ""
+    )
+    if use_cache:
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            record_event("cache_hits")
+            return cached
+    options = {"response_format": response_format} if response_format else {}
+
+    def ask():
+        response = call_grok([
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": prompt}
+        ], **options)
+        record_prompt_usage(prompt_name, getattr(response, "usage", None))
+        content = response.choices[0].message.content.strip()
+        if use_cache:
+            response_cache.set(cache_key, content)
+        return content
+
+    return single_flight.do("grok", cache_key, ask)
+
 def download_image(url):
-    """Download an image from a URL to a temporary file."""
+    """Stream an image from a URL into memory, refusing anything larger than MAX_IMAGE_BYTES."""
     try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        temp_path = f"temp_image_{os.getpid()}.jpg"
-        with open(temp_path, "wb") as f:
-            f.write(response.content)
-        return temp_path
+        with get_http_session().get(url, timeout=http_timeout(url), stream=True) as response:
+            response.raise_for_status()
+            declared_size = int(response.headers.get("Content-Length") or 0)
+            if declared_size > MAX_IMAGE_BYTES:
+                raise ValueError(f"image is {declared_size} bytes, limit is {MAX_IMAGE_BYTES}")
+            chunks = []
+            size = 0
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                chunks.append(chunk)
+                size += len(chunk)
+                if size > MAX_IMAGE_BYTES:
+                    raise ValueError(f"image exceeds {MAX_IMAGE_BYTES} bytes")
+        # One join into immutable bytes, which io.BytesIO and hashlib then read without copying again
+        return b"".join(chunks)
     except Exception as e:
-        if os.getenv('DEBUG_MODE') == 'true':
+        if DEBUG_MODE:
             print(f"Failed to download image from {url}: {e}", file=sys.stderr)
         return None
 
-def analyze_photo(photo_path: str) -> str:
-    """Analyze a photo using Gemini and return a description."""
+image_stats = {"images": 0, "recompressed": 0, "bytes_in": 0, "bytes_out": 0}
+image_stats_lock = threading.Lock()
+
+IMAGE_SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+)
+
+def detect_mime_type(image_data) -> str:
+    """Work out the image MIME type from its magic bytes, defaulting to JPEG."""
+    header = bytes(image_data[:16])
+    for signature, mime_type in IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return mime_type
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "image/webp"
+    if header[4:8] == b"ftyp" and header[8:12] in (b"heic", b"heix", b"mif1", b"msf1"):
+        return "image/heic"
+    return "image/jpeg"
+
+def open_image(image_data):
+    """Decode image bytes (or an mmap) with Pillow, returning None if Pillow is missing or decoding fails."""
+    if Image is None:
+        return None
+    try:
+        if isinstance(image_data, mmap.mmap):
+            # An mmap is already a seekable file object, so PIL can decode it without a copy
+            image_data.seek(0)
+            stream = image_data
+        else:
+            stream = io.BytesIO(image_data)
+        image = Image.open(stream)
+        image.load()
+        return image
+    except Exception as e:
+        if DEBUG_MODE:
+            print(f"Could not decode photo: {e}", file=sys.stderr)
+        return None
+
+def perceptual_hash(image):
+    """Return a 64-bit difference hash of a decoded image."""
+    pixels = list(image.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+    image_hash = 0
+    for row in range(8):
+        for col in range(8):
+            image_hash = (image_hash << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return image_hash
+
+def prepare_image(image_data, image=None):
+    """Downscale and recompress a photo for upload, returning (payload bytes, MIME type).
+
+    The original (possibly an mmap) is only copied into bytes when it is the payload that gets sent.
+    """
+    mime_type = detect_mime_type(image_data)
+    payload = image_data
+    if image is not None:
+        try:
+            prepared = ImageOps.exif_transpose(image)
+            if max(prepared.size) > IMAGE_MAX_SIDE:
+                prepared.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.LANCZOS)
+            buffer = io.BytesIO()
+            prepared.convert("RGB").save(buffer, format="JPEG", quality=IMAGE_QUALITY, optimize=True)
+            # Keep the original when recompression doesn't help (already small, or an unsupported upload type)
+            if buffer.tell() < len(payload) or mime_type not in ("image/jpeg", "image/png", "image/webp"):
+                payload, mime_type = buffer.getvalue(), "image/jpeg"
+        except Exception as e:
+            if DEBUG_MODE:
+                print(f"Could not recompress photo, sending original: {e}", file=sys.stderr)
+    with image_stats_lock:
+        image_stats["images"] += 1
+        image_stats["bytes_in"] += len(image_data)
+        image_stats["bytes_out"] += len(payload)
+        if len(payload) != len(image_data):
+            image_stats["recompressed"] += 1
+    if DEBUG_MODE:
+        print(f"Photo upload size: {len(image_data)} -> {len(payload)} bytes ({mime_type})", file=sys.stderr)
+    # The Gemini SDK needs real bytes for inline data
+    return payload if isinstance(payload, bytes) else bytes(payload), mime_type
+
+def analyze_photo(photo_path: str, use_cache: bool = True) -> str:
+    """Analyze a photo file using Gemini, reading it through mmap rather than copying it into memory."""
     if not photo_path or not os.path.exists(photo_path):
-        if os.getenv('DEBUG_MODE') == 'true':
+        if DEBUG_MODE:
             print("Photo file not found or not provided", file=sys.stderr)
         return "Photo Analysis: Car (file not found)"
 
     try:
         with open(photo_path, "rb") as image_file:
-            image_data = image_file.read()
-
-        image = {
-            "mime_type": "image/jpeg",
-            "data": base64.b64encode(image_data).decode("utf-8")
-        }
-
-        prompt = (
-            "You are an expert in vehicle identification. Analyze the provided image and describe it concisely. "
-            "If it’s a vehicle, include these details if visible or identifiable:\n"
-            "- Make (e.g., Mitsubishi, Toyota)\n"
-            "- Model (e.g., Triton, Corolla)\n"
-            "- Badge/Trim (e.g., SR5, XR6)\n"
-            "- Color (e.g., blue, white)\n"
-            "- Descriptive features (e.g., bullbar, canopy)\n"
-            "- Registration/license plate number (rego, if visible, e.g., 123ABC)\n"
-            "Format vehicle responses as a single string starting with 'Photo:', e.g., 'Photo: Blue Mitsubishi Triton SR5 rego 123ABC with bullbar'. "
-            "Omit any details not identifiable, keeping it short. "
-            "If the vehicle cannot be identified, return 'Photo: Car'. "
-            "If the image is not a full vehicle (e.g., a car part, check engine light, invoice, oil or fluid - Brown or Black = Oil, Pink or Green = Coolent, Red = Brake Fluid), return a brief description starting with 'Photo Analysis: ', "
-            "e.g., 'Photo Analysis: Check engine light', 'Photo Analysis: Motor oil', 'Photo Analysis: Invoice for Unique Automotive'. "
-            "Keep all responses concise—no lengthy descriptions."
-        )
+            with mmap.mmap(image_file.fileno(), 0, access=mmap.ACCESS_READ) as image_data:
+                return analyze_image(image_data, use_cache)
+    except Exception as e:
+        if DEBUG_MODE:
+            print(f"Photo analysis error: {e}", file=sys.stderr)
+        return "Photo Analysis: Car"
 
-        model = genai.GenerativeModel("gemini-1.5-flash")
-        response = model.generate_content([prompt, {"inline_data": image}])
-        return response.text.strip()
+def analyze_image(image_data, use_cache: bool = True) -> str:
+    """Analyze in-memory image bytes (or an mmap) using Gemini, reusing descriptions of near-duplicate photos."""
+    try:
+        use_cache = use_cache and not CACHE_BYPASS and not cache_bypass_var.get()
+        decoded = open_image(image_data)
+        image_hash = perceptual_hash(decoded) if use_cache and decoded is not None else None
+        if image_hash is not None:
+            cached = photo_cache.lookup(image_hash)
+            if cached is not None:
+                record_event("cache_hits")
+                return cached
+
+        def describe():
+            # Gemini takes raw bytes for inline data, so there is no base64 round trip here
+            payload, mime_type = prepare_image(image_data, decoded)
+            image = {
+                "mime_type": mime_type,
+                "data": payload
+            }
+
+            prompt = (
+                "You are an expert in vehicle identification. Analyze the provided image and describe it concisely. "
+                "If it’s a vehicle, include these details if visible or identifiable:\n"
+                "- Make (e.g., Mitsubishi, Toyota)\n"
+                "- Model (e.g., Triton, Corolla)\n"
+                "- Badge/Trim (e.g., SR5, XR6)\n"
+                "- Color (e.g., blue, white)\n"
+                "- Descriptive features (e.g., bullbar, canopy)\n"
+                "- Registration/license plate number (rego, if visible, e.g., 123ABC)\n"
+                "Format vehicle responses as a single string starting with 'Photo:', e.g., 'Photo: Blue Mitsubishi Triton SR5 rego 123ABC with bullbar'. "
+                "Omit any details not identifiable, keeping it short. "
+                "If the vehicle cannot be identified, return 'Photo: Car'. "
+                "If the image is not a full vehicle (e.g., a car part, check engine light, invoice, oil or fluid - Brown or Black = Oil, Pink or Green = Coolent, Red = Brake Fluid), return a brief description starting with 'Photo Analysis: ', "
+                "e.g., 'Photo Analysis: Check engine light', 'Photo Analysis: Motor oil', 'Photo Analysis: Invoice for Unique Automotive'. "
+                "Keep all responses concise—no lengthy descriptions."
+            )
+
+            reserved = rate_limiter.acquire("gemini", estimate_tokens(prompt) + GEMINI_IMAGE_TOKENS + RATE_LIMIT_REPLY_TOKENS)
+            started = time.monotonic()
+            try:
+                response = get_gemini_model().generate_content([prompt, {"inline_data": image}])
+            except Exception as e:
+                rate_limiter.settle("gemini", reserved, 0)
+                # google.api_core's ResourceExhausted carries the HTTP status as .code
+                if getattr(e, "code", None) == 429:
+                    rate_limiter.throttle("gemini", RATE_LIMIT_COOLDOWN)
+                raise
+            usage = getattr(response, "usage_metadata", None)
+            rate_limiter.settle("gemini", reserved, getattr(usage, "total_token_count", 0) or reserved)
+            metrics = run_metrics_var.get()
+            if metrics is not None:
+                metrics.record_call(time.monotonic() - started, SimpleNamespace(
+                    prompt_tokens=getattr(usage, "prompt_token_count", 0),
+                    completion_tokens=getattr(usage, "candidates_token_count", 0),
+                    prompt_tokens_details=SimpleNamespace(cached_tokens=getattr(usage, "cached_content_token_count", 0))
+                ), provider="gemini")
+            description = response.text.strip()
+            if image_hash is not None:
+                photo_cache.store(image_hash, description)
+            return description
+
+        # Keyed on the exact bytes, so only the same photo (e.g. forwarded twice) shares a call
+        return single_flight.do("photo", hashlib.sha256(image_data).hexdigest(), describe)
     except Exception as e:
-        if os.getenv('DEBUG_MODE') == 'true':
+        if DEBUG_MODE:
             print(f"Photo analysis error: {e}", file=sys.stderr)
         return "Photo Analysis: Car"
 
+def analyze_photo_source(source: str) -> str:
+    """Analyze a photo given either a local path or an http(s) URL."""
+    if not source or not source.startswith(("http://", "https://")):
+        return analyze_photo(source)
+    image_data = download_image(source)
+    if image_data is None:
+        return "Photo Analysis: Car (file not found)"
+    return analyze_image(image_data)
+
+def analyze_photos(sources: list, max_concurrency: int = None) -> list:
+    """Analyze several photos (paths or URLs) concurrently and return their descriptions in input order."""
+    if not sources:
+        return []
+    workers = max(1, min(max_concurrency or PHOTO_CONCURRENCY, len(sources)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(analyze_photo_source, sources))
+
+# Prompt Templates
+# Per-template usage, so the provider's prefix-cache hit rate can be watched template by template
+prompt_stats = {}
+prompt_stats_lock = threading.Lock()
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about four bytes per token), good enough for sizing prompt prefixes."""
+    return (len(text.encode("utf-8")) + 3) // 4
+
+def record_prompt_usage(name: str, usage):
+    """Add one call's prompt and cached-prefix token counts to prompt_stats."""
+    if name is None:
+        return
+    prompt_tokens = (getattr(usage, "prompt_tokens", 0) or 0) if usage is not None else 0
+    with prompt_stats_lock:
+        stats = prompt_stats.setdefault(name, {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0})
+        stats["calls"] += 1
+        stats["prompt_tokens"] += prompt_tokens
+        stats["cached_tokens"] += min(cached_prompt_tokens(usage), prompt_tokens)
+
+class PromptTemplate:
+    """A prompt whose instructions form a fixed system message, with only the payload in the user turn.
+
+    The system message is built once at import and is byte-identical on every call, so the provider
+    can serve it from its prompt prefix cache.
+    """
+
+    def __init__(self, name: str, instructions: str, lead: str = "", response_format: dict = None):
+        self.name = name
+        self.system = f"{GROK_SYSTEM_PROMPT}\n\n{instructions.strip()}"
+        self.lead = lead
+        self.response_format = response_format
+        self.prefix_tokens = estimate_tokens(self.system)
+
+    def user_content(self, payload: str) -> str:
+        return f"{self.lead}\n{payload}" if self.lead else payload
+
+    def run(self, payload: str, stream: bool = False):
+        """Send the payload; returns the reply text, or a line generator when streaming."""
+        content = self.user_content(payload)
+        if stream:
+            return stream_grok_lines(content, system_prompt=self.system, prompt_name=self.name)
+        return analyze_with_grok(content, response_format=self.response_format,
+                                 system_prompt=self.system, prompt_name=self.name)
+
+    def report(self) -> dict:
+        with prompt_stats_lock:
+            stats = dict(prompt_stats.get(self.name, {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0}))
+        stats["prefix_tokens"] = self.prefix_tokens
+        stats["prefix_cache_hit_rate"] = (
+            round(stats["cached_tokens"] / stats["prompt_tokens"], 3) if stats["prompt_tokens"] else None
+        )
+        return stats
+
+PROMPT_TEMPLATES = {}
+
+def register_prompt(name: str, instructions: str, **options) -> PromptTemplate:
+    """Build a PromptTemplate and add it to PROMPT_TEMPLATES."""
+    template = PromptTemplate(name, instructions, **options)
+    PROMPT_TEMPLATES[name] = template
+    return template
+
 # Prompt Definitions
-def prompt_1(original_message):
-    """Prompt 1: Basic parsing of a car yard message into concise summaries with persistent senders."""
-    prompt = f"""
+PROMPT_1 = register_prompt("prompt_1", """
 You are analyzing a simple message from a car yard group chat. The input is formatted as 'Sender: Message' or 'Sender: Photo Analysis'. Some lines may start with '[PHOTO]' to indicate they came from a photo analysis. Every line should have a sender; propagate the last known sender (e.g., 'Christian') until a new sender appears. Use 'Unknown' only if no sender has been specified yet.
 
 Summarise the main points from the batched messages, ensuring every line has a sender. Preserve the '[PHOTO]' marker if present.
+Each input line ends with a source tag such as [L3]. End every output line with the tags of the input lines it came from, e.g. [L3], or [L3,L4] when it combines two lines.
 
 Rules:
 1. If something is listed on multiple lines, for example:
@@ -262,15 +1500,13 @@ In this example its important because it means to still take the Liberty even th
     - Christian: Black Ranger XLT back seats need a clean 
 
 15. If nothing is actionable, return nothing
+""", lead="Now, process:")
 
-Now, process:
-{original_message}
-"""
-    return analyze_with_grok(prompt)
+def prompt_1(original_message, stream=False):
+    """Prompt 1: Basic parsing of a car yard message into concise summaries with persistent senders."""
+    return PROMPT_1.run(original_message, stream)
 
-def prompt_2(original_message):
-    """Prompt 2: Refine the summaries"""
-    prompt = f"""
+PROMPT_2 = register_prompt("prompt_2", """
 1. Add the entire name for the car if mentioned. For example:
 - X5 to BMW X5
 - Falcon to Ford Falcon
@@ -286,7 +1522,7 @@ Output:
 *Notice how we didn't create a new line for the Isuzu MUX because that car is part of the condition, not the action. Only split lines for the action.
 
 3. Preserve the sender from each line.
-4. Preserve the '[PHOTO]' marker if present.
+4. Preserve the '[PHOTO]' marker if present, and the source tag at the end of the line (e.g. [L3]) on every line made from it.
 5. Preserve relvant information like Colour and general descriptive words, Conditions ("When John has the <car> ready")
 
 6. Car Makes and Models - Only Makes and Models sold in Australia and use the proper names  
@@ -295,15 +1531,13 @@ Caddy = Volkswagen Caddy NOT Cadilac
 Prado = Toyota Landcruiser Prado NOT Toyota Prado
 Colorado = Holden Colorado NOT Chevrolet
 Challenger = Mitsubishi Challenger NOT Dodge Challenger 
+""", lead="Now process:")
 
-Now process: 
-{original_message}
-"""
-    return analyze_with_grok(prompt)
+def prompt_2(original_message, stream=False):
+    """Prompt 2: Refine the summaries"""
+    return PROMPT_2.run(original_message, stream)
 
-def prompt_3(original_message):
-    """Prompt 3: Categorize the refined summaries"""
-    prompt = f"""
+PROMPT_3 = register_prompt("prompt_3", """
 You are provided with sub-messages from a car yard group chat, each prefixed with a sender (e.g., 'Christian:', 'Unknown:'). Some messages may start with '[PHOTO]' to indicate they came from a photo analysis. For each sub-message, assign exactly one category from the following list:
 - Ready: Car(s) are ready.
 - Drop Off: Car(s) need to be dropped off, picked up, or swapped. For example: "Take the Isuzu D-MAX to Capital" 
@@ -372,15 +1606,14 @@ For example
 Rule 9: If refers to something needing a clean, this is a To Do category NOT Car Repairs
 
 Output: 
-- [PHOTO] <Name of sender>:<summary>:<Category> (preserve the [PHOTO] marker if present in the input)
-    
-{original_message}
-"""
-    return analyze_with_grok(prompt)
+- [PHOTO] <Name of sender>:<summary> [L3]:<Category> (preserve the [PHOTO] marker if present in the input, and the source tag such as [L3] at the end of the summary)
+""")
 
-def prompt_ready(sub_message):
-    """Prompt for Ready category"""
-    prompt = f"""
+def prompt_3(original_message, stream=False):
+    """Prompt 3: Categorize the refined summaries"""
+    return PROMPT_3.run(original_message, stream)
+
+PROMPT_READY = register_prompt("prompt_ready", """
 For each line create a list. Lists will then be used to update our inventory list.
 Index 1 - Make (ford, holden, toyota)
 Index 2 - Model (civic, Landcruiser Prado, Megane)
@@ -419,13 +1652,13 @@ Output
 - Christian: Silver Nissan Pathfinder with bullbar, rego 1MJ3VS is ready at AKS : [Nissan, Pathfinder, , Silver with bullbar, 1MJ3VS, AKS, Ready]
 
 Rule 2: If there is a list within the car for example in the notes index "tonneau cover too small, back seats need cleaning" so it doesn't mess up the indexing use the word "and" so ""tonneau cover too small and back seats need cleaning"
-{sub_message}
-"""
-    return analyze_with_grok(prompt)
+""")
 
-def prompt_drop_off(sub_message):
-    """Prompt for Drop Off category"""
-    prompt = f"""
+def prompt_ready(sub_message):
+    """Prompt for Ready category"""
+    return PROMPT_READY.run(sub_message)
+
+PROMPT_DROP_OFF = register_prompt("prompt_drop_off", """
 For each line create a list. Lists will then be used to update our inventory list.
 Index 1 - Make (ford, holden, toyota)
 Index 2 - Model (civic, Landcruiser Prado, Megane)
@@ -470,13 +1703,13 @@ Another Example:
   - Christian:If the Holden Colorado sells, use it to pick up the Volkswagen Amarok at Unique : [Holden, Colorado, , , , , Unique, When the Amarok is ready]
 
 Rule 2: If there is a list within the car for example in the notes index "tonneau cover too small, back seats need cleaning" so it doesn't mess up the indexing use the word "and" so ""tonneau cover too small and back seats need cleaning"
-{sub_message}
-"""
-    return analyze_with_grok(prompt)
+""")
 
-def prompt_customer_appointment(sub_message):
-    """Prompt for Customer Appointment category"""
-    prompt = f"""
+def prompt_drop_off(sub_message):
+    """Prompt for Drop Off category"""
+    return PROMPT_DROP_OFF.run(sub_message)
+
+PROMPT_CUSTOMER_APPOINTMENT = register_prompt("prompt_customer_appointment", """
 For each line create a list. Lists will then be used to update our customer appointment list.
 Index 1 - Make (ford, holden, toyota)
 Index 2 - Model (civic, Landcruiser Prado, Megane)
@@ -504,14 +1737,13 @@ Output
 - Christian: Customer coming to pick up the sold Kia Optima today at 4:40pm : [Kia, Optima, , , , , today, 4:40pm, Sold Customer Pickup, Delivery]
 
 Rule 1: If there is a list within the car for example in the notes index "tonneau cover too small, back seats need cleaning" so it doesn't mess up the indexing use the word "and" so ""tonneau cover too small and back seats need cleaning"
+""")
 
-{sub_message}
-"""
-    return analyze_with_grok(prompt)
+def prompt_customer_appointment(sub_message):
+    """Prompt for Customer Appointment category"""
+    return PROMPT_CUSTOMER_APPOINTMENT.run(sub_message)
 
-def prompt_reconditioning_appointment(sub_message):
-    """Prompt for Reconditioning Appointment category"""
-    prompt = f"""
+PROMPT_RECONDITIONING_APPOINTMENT = register_prompt("prompt_reconditioning_appointment", """
 For each line create a list. Lists will then be used to update our reconditioner appointment list.
 Index 1 - Make (ford, holden, toyota)
 Index 2 - Model (civic, Landcruiser Prado, Megane)
@@ -529,14 +1761,13 @@ Output
 - Joseph: Rick coming to do Ford Territory seats today : [Ford, Territory, , Gold, , Rick, Today, , Seats]
 
 Rule 1: If there is a list within the car for example in the notes index "tonneau cover too small, back seats need cleaning" so it doesn't mess up the indexing use the word "and" so ""tonneau cover too small and back seats need cleaning"
+""")
 
-{sub_message}
-"""
-    return analyze_with_grok(prompt)
+def prompt_reconditioning_appointment(sub_message):
+    """Prompt for Reconditioning Appointment category"""
+    return PROMPT_RECONDITIONING_APPOINTMENT.run(sub_message)
 
-def prompt_car_repairs(sub_message):
-    """Prompt for Car Repairs category"""
-    prompt = f"""
+PROMPT_CAR_REPAIRS = register_prompt("prompt_car_repairs", """
 For each line create a list. Lists will then be used to update our internal car repair list and create reconditioner appointments.
 Index 1 - Make (ford, holden, toyota)
 Index 2 - Model (civic, Landcruiser Prado, Megane)
@@ -559,15 +1790,14 @@ Example
 - Christian: Black Ford Ranger XLT tonneau cover is too small : [Ford, Ranger, XLT, Black, , Tonneau cover too small, ]
 
 PLEASE ENSURE ALL INDEXES ARE CORRECT 
+""")
 
-{sub_message}
-"""
-    return analyze_with_grok(prompt)
+def prompt_car_repairs(sub_message):
+    """Prompt for Car Repairs category"""
+    return PROMPT_CAR_REPAIRS.run(sub_message)
 
-def prompt_reconditioner_category(repair_task):
-    """Prompt to classify a repair task into a reconditioner category and assign a reconditioner"""
-    prompt = f"""
-You are analyzing a car repair task to determine the appropriate reconditioner category and assign a reconditioner. The task is: "{repair_task}".
+PROMPT_RECONDITIONER_CATEGORY = register_prompt("prompt_reconditioner_category", """
+You are analyzing a car repair task to determine the appropriate reconditioner category and assign a reconditioner. The task is given at the end.
 
 Available reconditioner categories and their associated reconditioners:
 - interior minor: Rick
@@ -620,15 +1850,13 @@ Output: [Body, Technician]
 
 Task: "Replace dashboard on Subaru Liberty"
 Output: [Interior Major, Technician]
+""", lead="Now process:")
 
-Now process:
-{repair_task}
-"""
-    return analyze_with_grok(prompt).strip('[]').split(', ')
+def prompt_reconditioner_category(repair_task):
+    """Prompt to classify a repair task into a reconditioner category and assign a reconditioner"""
+    return PROMPT_RECONDITIONER_CATEGORY.run(repair_task).strip('[]').split(', ')
 
-def prompt_location_update(sub_message):
-    """Prompt for Location Update category"""
-    prompt = f"""
+PROMPT_LOCATION_UPDATE = register_prompt("prompt_location_update", """
 For each line create a list. Lists will then be used to update our inventory list.
 Index 1 - Make (ford, holden, toyota)
 Index 2 - Model (civic, Landcruiser Prado, Megane)
@@ -657,14 +1885,13 @@ Output
 - Christian: James is taking the Holden Colorado to Al's : [Holden, Colorado, , , , , Al's, ]
 - Christian: James is picking up the Toyota Corolla from Al's : [Toyota, Corolla, , , , Al's, with James, ]
 - Christian: Silver Nissan Pathfinder with bullbar, rego 1MJ3VS is at Al's : [Nissan, Pathfinder, , Silver with bullbar, 1MJ3VS, , Al's, ]
+""")
 
-{sub_message}
-"""
-    return analyze_with_grok(prompt)
+def prompt_location_update(sub_message):
+    """Prompt for Location Update category"""
+    return PROMPT_LOCATION_UPDATE.run(sub_message)
 
-def prompt_to_do(sub_message):
-    """Prompt for To Do category"""
-    prompt = f"""
+PROMPT_TO_DO = register_prompt("prompt_to_do", """
 For each line create a list. Lists will then be used to update our to do list.
 Index 1 - Make (e.g ford, holden, toyota)
 Index 2 - Model (e.g civic, Landcruiser Prado, Megane)
@@ -688,14 +1915,13 @@ Example
 - Christian: Black Ford Ranger XLT back seats need a clean
 Output 
 - Christian: Black Ford Ranger XLT back seats need a clean : [Ford, Ranger, XLT, Black, , Back seats need a clean]
+""")
 
-{sub_message}
-"""
-    return analyze_with_grok(prompt)
+def prompt_to_do(sub_message):
+    """Prompt for To Do category"""
+    return PROMPT_TO_DO.run(sub_message)
 
-def prompt_notes(sub_message):
-    """Prompt for Notes category"""
-    prompt = f"""
+PROMPT_NOTES = register_prompt("prompt_notes", """
 For each line create a list. Lists will then be used to update our to do list.
 Index 1 - Make (ford, holden, toyota)
 Index 2 - Model (civic, Landcruiser Prado, Megane)
@@ -725,14 +1951,13 @@ Example
  - Christian: Let's not squeeze cars in anymore. We should set the yard up so that one person can get cars out on their own
 Output
  - Christian: Let's not squeeze cars in anymore. We should set the yard up so that one person can get cars out on their own : [ , , , , , Let's not squeeze cars in anymore. We should set the yard up so that one person can get cars out on their own]
+""")
 
-{sub_message}
-"""
-    return analyze_with_grok(prompt)
+def prompt_notes(sub_message):
+    """Prompt for Notes category"""
+    return PROMPT_NOTES.run(sub_message)
 
-def prompt_sold(sub_message):
-    """Prompt for Sold category"""
-    prompt = f"""
+PROMPT_SOLD = register_prompt("prompt_sold", """
 For each line create a list. Lists will then be used to update our sold cars list.
 Index 1 - Make (ford, holden, toyota)
 Index 2 - Model (civic, Landcruiser Prado, Megane)
@@ -754,47 +1979,1676 @@ Another Example:
 - James: Navara D22 white, sold at unique
 Output:
 - James: Navara D22 white, sold at unique : [Nissan, Navara, D22, White, , Sold]
+""")
+
+def prompt_sold(sub_message):
+    """Prompt for Sold category"""
+    return PROMPT_SOLD.run(sub_message)
+
+# Local Reconditioner Rules
+class FastPathStats:
+    """How often a local fast path answered on its own versus falling back to Grok."""
+
+    def __init__(self):
+        self.counts = {"local": 0, "llm": 0}
+        self._lock = threading.Lock()
+
+    def count(self, source: str, amount: int = 1):
+        with self._lock:
+            self.counts[source] = self.counts.get(source, 0) + amount
+
+    def report(self) -> dict:
+        with self._lock:
+            total = self.counts["local"] + self.counts["llm"]
+            return dict(self.counts, hit_rate=round(self.counts["local"] / total, 3) if total else None)
+
+def count_avoided(source: str):
+    """Record on the current run that a local fast path saved a Grok call."""
+    metrics = run_metrics_var.get()
+    if metrics is not None:
+        metrics.record_avoided(source)
+
+class ReconditionerRules:
+    """The prompt_reconditioner_category keyword table, compiled into one case-insensitive matcher."""
+
+    def __init__(self, config: dict):
+        fallback = config.get("fallback", {})
+        self.fallback = [fallback.get("category", "other"), fallback.get("reconditioner", "Technician")]
+        self.keywords = {}
+        for rule in config.get("categories", []):
+            for keyword in rule.get("keywords", []):
+                self.keywords.setdefault(keyword.lower(), (rule["category"], rule["reconditioner"]))
+        # Longest keywords first so "wheel bearing" wins over "wheel" and "panel replacement" over "panel"
+        alternation = "|".join(re.escape(keyword) for keyword in sorted(self.keywords, key=len, reverse=True))
+        self.pattern = re.compile(rf"(?<![\w/])(?:{alternation})(?![\w/])", re.IGNORECASE) if self.keywords else None
+        self.stats = FastPathStats()
+
+    @classmethod
+    def load(cls, path: str):
+        """Load rules from a JSON file; a missing or broken file leaves every task to the LLM."""
+        try:
+            with open(path, encoding="utf-8") as rules_file:
+                return cls(json.load(rules_file))
+        except (OSError, ValueError) as e:
+            if DEBUG_MODE:
+                print(f"Could not load reconditioner rules from {path}: {e}", file=sys.stderr)
+            return cls({})
+
+    def classify(self, repair_task: str):
+        """Return [category, reconditioner] when the task's keywords all point at one category, else None."""
+        if self.pattern is None:
+            return None
+        matches = {self.keywords[match.group(0).lower()] for match in self.pattern.finditer(repair_task)}
+        if len(matches) != 1:
+            return None
+        return list(matches.pop())
+
+with startup_step("init:reconditioner_rules"):
+    reconditioner_rules = ReconditionerRules.load(RECONDITIONER_RULES_PATH)
+
+def classify_reconditioner(repair_task: str) -> list:
+    """Classify a repair task locally when the rules are unambiguous, otherwise ask Grok."""
+    local = reconditioner_rules.classify(repair_task)
+    if local is not None:
+        reconditioner_rules.stats.count("local")
+        count_avoided("reconditioner_rules")
+        return local
+    reconditioner_rules.stats.count("llm")
+    return prompt_reconditioner_category(repair_task)
+
+# Vehicle Alias Index
+ALIAS_TOKEN_PATTERN = re.compile(r"[A-Za-z0-9]+(?:-[A-Za-z0-9]+)*")
+SENDER_PREFIX_PATTERN = re.compile(r"^(\s*(?:-\s*)?(?:\[PHOTO\]\s*)?[A-Za-z][\w .'-]{0,30}:\s*)?(.*)$", re.DOTALL)
+# Unmatched tokens shaped like a model code (SV6, i30, 120i) mean the index is missing a vehicle
+MODEL_CODE_PATTERN = re.compile(r"^(?:[a-z]{1,3}\d{1,3}[a-z]?|\d{3}[a-z]{1,2})$")
+# Words that suggest a line is about several cars, which prompt_2 may need to split
+MULTI_VEHICLE_WORDS = {"both", "these", "those", "cars", "utes", "vehicles"}
+MULTI_VEHICLE_PATTERN = re.compile(r"(?:\band|&)\s+(?:the|a|an)\b", re.IGNORECASE)
+FUZZY_MIN_LENGTH = 6
+# Plate-shaped tokens (letters and digits, 5 to 7 long) count as a rego beside a model name
+PLATE_TOKEN_PATTERN = re.compile(r"^(?=[a-z]*\d)(?=\d*[a-z])[a-z0-9]{5,7}$")
+# A bare model name is the line's subject when only a determiner and/or an instruction verb come before
+# it and the next word doesn't make it a verb or abstract noun ("patrol the yard", "an accord on parking");
+# one that opens the line needs a predicate or destination straight after it ("Accord needs tyres", "Ranger to Al's")
+SUBJECT_DETERMINERS = {"the", "a", "an", "that", "this", "his", "her", "my", "our", "your", "their"}
+SUBJECT_VERBS = {"take", "move", "bring", "drop", "pick", "send", "get", "grab", "park", "wash", "clean", "detail", "fix"}
+SUBJECT_PREDICATES = {"is", "was", "has", "had", "needs", "needed", "will", "can", "should", "going", "goes", "to", "at"}
+NOT_SUBJECT_FOLLOWERS = SUBJECT_DETERMINERS | {"on", "of", "for", "from", "with", "up", "out", "it", "them"}
+
+def within_one_edit(a: str, b: str) -> bool:
+    """True when a and b differ by at most one insertion, deletion, substitution or adjacent swap."""
+    if a == b:
+        return True
+    if len(a) == len(b):
+        diffs = [i for i in range(len(a)) if a[i] != b[i]]
+        if len(diffs) == 1:
+            return True
+        return (len(diffs) == 2 and diffs[1] == diffs[0] + 1
+                and a[diffs[0]] == b[diffs[1]] and a[diffs[1]] == b[diffs[0]])
+    if abs(len(a) - len(b)) != 1:
+        return False
+    shorter, longer = sorted((a, b), key=len)
+    return any(longer[:i] + longer[i + 1:] == shorter for i in range(len(longer)))
+
+class VehicleAliasIndex:
+    """Australian make/model/badge aliases for expanding vehicle shorthand the way prompt_2 does."""
+
+    def __init__(self, config: dict):
+        make_aliases = config.get("make_aliases", {})
+        self.aliases = {}
+        self.makes = {}
+        self.bare_aliases = set()
+        self.vehicles = {}
+        for vehicle in config.get("vehicles", []):
+            make = vehicle["make"]
+            model = " ".join(filter(None, [vehicle["model"], vehicle.get("badge")]))
+            canonical = f"{make} {model}"
+            self.vehicles[canonical] = (make, vehicle["model"], vehicle.get("badge", ""))
+            make_names = [make] + [alias for alias, target in make_aliases.items() if target == make]
+            for make_name in make_names:
+                self.makes.setdefault(self.key(make_name)[1], make)
+                self.vehicles.setdefault(make, (make, "", ""))
+            # Each alias also matches with any spelling of the make in front; the bare model only does
+            # when it is listed as an alias, so entries like Mazda "3" don't match every number
+            for alias in vehicle.get("aliases", []):
+                self.add(alias, canonical)
+                joined = self.key(alias)[1]
+                if not any(c.isdigit() for c in joined):
+                    self.bare_aliases.add(joined)
+            for alias in vehicle.get("aliases", []) + [model]:
+                for make_name in make_names:
+                    self.add(f"{make_name} {alias}", canonical)
+        self.max_tokens = max((key.count(" ") + 1 for key in self.aliases), default=0)
+        self.fuzzy_candidates = {}
+        for key, canonical in self.aliases.items():
+            if " " not in key and len(key) >= FUZZY_MIN_LENGTH:
+                self.fuzzy_candidates.setdefault(key[0], []).append((key, canonical))
+        self.stats = FastPathStats()
+
+    @classmethod
+    def load(cls, path: str):
+        """Load aliases from a JSON file; a missing or broken file sends every line to prompt_2."""
+        try:
+            with open(path, encoding="utf-8") as aliases_file:
+                return cls(json.load(aliases_file))
+        except (OSError, ValueError) as e:
+            if DEBUG_MODE:
+                print(f"Could not load vehicle aliases from {path}: {e}", file=sys.stderr)
+            return cls({})
+
+    @staticmethod
+    def key(text: str) -> tuple:
+        """Return the spaced and joined lookup keys for text, ignoring case and hyphens."""
+        words = [word.replace("-", "") for word in ALIAS_TOKEN_PATTERN.findall(text.lower())]
+        return " ".join(words), "".join(words)
+
+    def add(self, alias: str, canonical: str):
+        for key in set(self.key(alias)):
+            self.aliases.setdefault(key, canonical)
+
+    def fuzzy_lookup(self, word: str):
+        """Match a single misspelt word against the long single-word aliases, if exactly one vehicle fits."""
+        if len(word) < FUZZY_MIN_LENGTH:
+            return None
+        found = {
+            canonical for alias, canonical in self.fuzzy_candidates.get(word[0], ())
+            if within_one_edit(word, alias)
+        }
+        return found.pop() if len(found) == 1 else None
+
+    def beside_vehicle_detail(self, words: list, i: int) -> bool:
+        """True when the word at i has a make, colour or rego right next to it."""
+        before = words[i - 1] if i > 0 else ""
+        after = words[i + 1] if i + 1 < len(words) else ""
+        if before in self.makes or COLOUR_PATTERN.fullmatch(before):
+            return True
+        return any(word == "rego" or PLATE_TOKEN_PATTERN.match(word) for word in (before, after))
+
+    def is_subject(self, words: list, i: int) -> bool:
+        """True when the word at i is what the line is about ("The patrol is ready", "Take the patrol")."""
+        lead = words[:i]
+        determined = bool(lead) and lead[-1] in SUBJECT_DETERMINERS
+        if determined:
+            lead = lead[:-1]
+        if lead and not (len(lead) == 1 and lead[0] in SUBJECT_VERBS):
+            return False
+        after = words[i + 1] if i + 1 < len(words) else ""
+        if not lead and not determined:
+            return after in SUBJECT_PREDICATES
+        return after not in NOT_SUBJECT_FOLLOWERS
+
+    def scan(self, text: str) -> tuple:
+        """Return the (start, end, canonical) vehicle spans in text and the words left unmatched.
+
+        Bare model names that double as everyday words ("accord", "patrol", "focus") only count when a
+        make, colour or rego sits beside them or they are the line's subject; a misspelt one needs the
+        make, colour or rego.
+        """
+        tokens = [(m.start(), m.end(), m.group(0).lower().replace("-", "")) for m in ALIAS_TOKEN_PATTERN.finditer(text)]
+        words = [token[2] for token in tokens]
+        spans = []
+        unmatched = []
+        i = 0
+        while i < len(tokens):
+            match = None
+            # Longest alias first; a multi-word alias may only span whitespace
+            for n in range(min(self.max_tokens, len(tokens) - i), 0, -1):
+                window = tokens[i:i + n]
+                if any(text[a[1]:b[0]].strip() for a, b in zip(window, window[1:])):
+                    continue
+                window_words = [token[2] for token in window]
+                canonical = self.aliases.get(" ".join(window_words)) or self.aliases.get("".join(window_words))
+                if canonical:
+                    match = (n, canonical)
+                    break
+            if match and match[0] == 1 and words[i] in self.bare_aliases:
+                if not (self.beside_vehicle_detail(words, i) or self.is_subject(words, i)):
+                    match = None
+            if match is None:
+                canonical = self.makes.get(words[i])
+                if canonical is None and self.beside_vehicle_detail(words, i):
+                    canonical = self.fuzzy_lookup(words[i])
+                if canonical:
+                    match = (1, canonical)
+            if match is None:
+                unmatched.append(words[i])
+                i += 1
+                continue
+            n, canonical = match
+            spans.append((tokens[i][0], tokens[i + n - 1][1], canonical))
+            i += n
+        return spans, unmatched
+
+    def expand_line(self, line: str):
+        """Expand the vehicle in one summary line, or return None when prompt_2 is still needed.
+
+        A line is only settled locally when it mentions exactly one known vehicle, has no
+        unknown model codes and nothing ("both", "and the ...") suggesting several cars to split.
+        """
+        prefix, body = SENDER_PREFIX_PATTERN.match(line).groups()
+        spans, unmatched = self.scan(body)
+        if len({canonical for _, _, canonical in spans}) != 1:
+            return None
+        if MULTI_VEHICLE_PATTERN.search(body) or any(word in MULTI_VEHICLE_WORDS or (MODEL_CODE_PATTERN.match(word) and not word.endswith(("am", "pm")))
+               for word in unmatched):
+            return None
+        for start, end, canonical in reversed(spans):
+            body = body[:start] + canonical + body[end:]
+        return (prefix or "") + body
+
+with startup_step("init:vehicle_aliases"):
+    vehicle_index = VehicleAliasIndex.load(VEHICLE_ALIASES_PATH)
+
+def expand_summary(summary: str) -> str:
+    """Produce prompt_2's output, expanding vehicles locally and sending only unsettled lines to prompt_2."""
+    lines = [line for line in summary.split("\n") if line.strip()]
+    expanded = []
+    for line in lines:
+        # Source tags would read as unknown model codes, so expand without them and put them back
+        text, line_ids = split_line_tags(line)
+        local = vehicle_index.expand_line(text)
+        expanded.append(tag_line(local, line_ids) if local is not None else None)
+    unresolved = [line for line, result in zip(lines, expanded) if result is None]
+    vehicle_index.stats.count("local", len(lines) - len(unresolved))
+    vehicle_index.stats.count("llm", len(unresolved))
+    if not unresolved:
+        count_avoided("vehicle_aliases")
+        return "\n".join(expanded)
+    if DEBUG_MODE:
+        print(f"Vehicle aliases settled {len(lines) - len(unresolved)} of {len(lines)} lines", file=sys.stderr)
+    refined = prompt_2("\n".join(unresolved)).strip()
+    slots = place_refined_lines(lines, expanded, [line for line in refined.split("\n") if line.strip()])
+    output = []
+    for index, result in enumerate(expanded):
+        output.extend([result] if result is not None else slots[index])
+    return "\n".join(output)
+
+def place_refined_lines(lines: list, expanded: list, refined: list) -> dict:
+    """Map each of prompt_2's lines back to the unsettled input line it came from, by its [L<n>] tags.
+
+    Returns {index of unsettled line: refined lines}, so the summary can be rebuilt in input order.
+    Splits of one line stay together; untagged lines follow the previous placement.
+    """
+    pending = [index for index, result in enumerate(expanded) if result is None]
+    slot_ids = {index: set(split_line_tags(lines[index])[1]) for index in pending}
+    slots = {index: [] for index in pending}
+    previous = pending[0]
+    for line in refined:
+        line_ids = set(split_line_tags(line)[1])
+        candidates = [index for index in pending if line_ids & slot_ids[index]]
+        later = [index for index in candidates if index >= previous]
+        if not candidates:
+            choice = previous
+        elif any(not slots[index] for index in later):
+            choice = next(index for index in later if not slots[index])
+        elif previous in candidates:
+            choice = previous
+        else:
+            choice = later[0] if later else candidates[0]
+        slots[choice].append(line)
+        previous = choice
+    return slots
+
+# Fused Engine
+CATEGORY_FIELDS = {
+    "Ready": ["make", "model", "badge", "description", "rego", "location", "ready_status", "notes"],
+    "Drop Off": ["make", "model", "badge", "description", "rego", "current_location", "next_location", "notes"],
+    "Customer Appointment": ["make", "model", "badge", "description", "rego", "customer_name", "day", "time", "notes", "delivery"],
+    "Reconditioning Appointment": ["make", "model", "badge", "description", "rego", "reconditioner_name", "day", "time", "notes"],
+    "Car Repairs": ["make", "model", "badge", "description", "rego", "repair_task", "notes"],
+    "Location Update": ["make", "model", "badge", "description", "rego", "old_location", "new_location", "notes"],
+    "To Do": ["make", "model", "badge", "description", "rego", "task"],
+    "Notes": ["make", "model", "badge", "description", "rego", "notes"],
+    "Sold": ["make", "model", "badge", "description", "rego", "sold"]
+}
+
+FUSED_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "npai_batch",
+        "schema": {
+            "type": "object",
+            "properties": {
+                "records": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "sender": {"type": "string"},
+                            "summary": {"type": "string"},
+                            "category": {"type": "string", "enum": list(CATEGORY_FIELDS)},
+                            "from_photo": {"type": "boolean"},
+                            "sources": {"type": "array", "items": {"type": "string"}},
+                            "fields": {
+                                "type": "object",
+                                "properties": {
+                                    name: {"type": "string"}
+                                    for name in dict.fromkeys(f for fields in CATEGORY_FIELDS.values() for f in fields)
+                                }
+                            },
+                            "reconditioner": {
+                                "type": "object",
+                                "properties": {"category": {"type": "string"}, "name": {"type": "string"}}
+                            }
+                        },
+                        "required": ["sender", "summary", "category", "fields"]
+                    }
+                }
+            },
+            "required": ["records"]
+        }
+    }
+}
+
+FUSED_FIELD_LINES = "\n".join(f"- {category}: {', '.join(fields)}" for category, fields in CATEGORY_FIELDS.items())
+
+PROMPT_FUSED = register_prompt("prompt_fused", """
+You are processing a batch of messages from a car yard group chat. Lines are formatted 'Sender: Message'; lines starting with '[PHOTO]' came from a photo analysis. Return JSON only, matching the provided schema.
+
+Step 1 - Summarise: produce one record per actionable statement. Propagate the last known sender to lines without one ('Unknown' if none yet). Split lists ("Clean: - Triton - GTI") into one record per item. Skip chatter and anything not actionable ("fuck", "nah thats okay"). If nothing is actionable return {"records": []}.
+Step 2 - Refine: use full Australian make and model names (XR6 = Ford Falcon XR6, Prado = Toyota Landcruiser Prado, Liberty = Subaru Liberty, Caddy = Volkswagen Caddy, Colorado = Holden Colorado, Challenger = Mitsubishi Challenger). If one statement applies the same action to several cars, create a record per car; cars that are only part of a condition ("when Capital has the MUX ready") do not get their own record. Keep colours, descriptive words and conditions.
+Step 3 - Categorise each record as exactly one of: Ready, Drop Off, Customer Appointment, Reconditioning Appointment, Location Update, To Do, Notes, Car Repairs, Sold. A statement that fits two categories (e.g. "ix35 pickup at bjm - it should be ready later today" is Drop Off and Ready; a car going somewhere for a service or RWC is Location Update or Drop Off and Car Repairs) becomes one record per category. Mobile reconditioners (Rick, Jan/Jian/Gian/Gan, Ermin, Richo, National, Bill/Billie, Keith, Chinamen/Jack, Browny/Darrel/Daz) or anyone coming to do repairs means Reconditioning Appointment. "Someone coming to see/pick up <car>" or a car being delivered is Customer Appointment. "Lets bring in <car>" and anything needing a clean is To Do. A person or place having nothing ready in general is Notes.
+Step 4 - Fields: fill "fields" for the record's category using only these keys (leave unknown values out):
+""" + FUSED_FIELD_LINES + """
+Make is the manufacturer, or "Car" when no specific car is named. Rego is only the registration (e.g. 1HU4SH), never descriptive words; descriptive features such as 'with bullbar' go in description. A picked-up car with no destination has new_location "with <sender>"; "back from <place>" means new_location "Northpoint"; a drop off with no destination has next_location "Picked up". Customer appointments with no day use day "Could be today"; delivery is "Delivery" for sold-car pickups. Join lists inside a field with "and", not commas.
+Step 5 - Car Repairs records also get "reconditioner": {"category", "name"} from: interior minor/Rick (seat, upholstery, interior clean), dents/Ermin (dent, panel, bodywork), auto electrical/Jan (electrical, wiring, brake lights, indicator, relay), battery/Brad Floyd, A/C/Peter Mode (AC, air conditioning, compressor, regas), Windscreen/National, Tint/Richo, Touch Up/Browny (paint, touch up, scratch), wheels/Keith (wheel, rim, tyre damage), Mechanic/Technician (engine, transmission, suspension, wheel bearing), Body/Technician (bumper, panel replacement, body repair), Interior Major/Technician (dashboard, seat replacement, major interior), otherwise other/Technician.
+Set "from_photo" true only for records that came from a '[PHOTO]' line.
+Each input line ends with a source tag such as [L3]; list the IDs of the lines a record came from in "sources" (e.g. ["L3"]).
+
+""", lead="Messages:", response_format=FUSED_RESPONSE_FORMAT)
+
+def prompt_fused(original_message):
+    """Fused prompt: summarise, expand names, categorise and extract fields in a single structured call."""
+    return PROMPT_FUSED.run(original_message)
 
+# Category Records
+CATEGORY_LINE_PATTERN = re.compile(
+    r"^(?P<message>.+?)\s*:\s*\[(?P<values>[^\[\]]*)\]\s*(?::\s*\[(?P<reconditioner>[^\[\]]*)\])?\s*$"
+)
+# Free-text fields that absorb stray commas when a reply has more values than the category has fields
+FREE_TEXT_FIELDS = {"notes", "task"}
+
+class RecordValidationError(ValueError):
+    """A category reply line that could not be turned into a record."""
+
+class CategoryRecord:
+    """One parsed category line. Each category's subclass holds its CATEGORY_FIELDS as slots, in order."""
+    __slots__ = ("message", "from_photo", "reconditioner", "sources")
+    category = None
+    fields = ()
+
+    def __init__(self, message: str, values: list, from_photo: bool = False, reconditioner: dict = None, sources=()):
+        self.message = message
+        # IDs of the input lines this record came from
+        self.sources = list(sources)
+        for i, name in enumerate(self.fields):
+            setattr(self, name, values[i] if i < len(values) else "")
+        # Only set fromPhoto to true if there is a rego and it came from a photo
+        self.from_photo = bool(from_photo and self.rego)
+        self.reconditioner = reconditioner
+
+    @property
+    def data(self) -> list:
+        return [getattr(self, name) for name in self.fields]
+
+    def as_dict(self) -> dict:
+        """Return the {message, data, fromPhoto, reconditioner, sources} shape databaseUpdate.js reads."""
+        record = {"message": self.message, "data": self.data, "fromPhoto": self.from_photo, "sources": self.sources}
+        if self.reconditioner:
+            record["reconditioner"] = self.reconditioner
+        return record
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.message!r}, {self.data!r})"
+
+RECORD_TYPES = {
+    category: type(
+        f"{category.replace(' ', '')}Record",
+        (CategoryRecord,),
+        {"__slots__": tuple(fields), "category": category, "fields": tuple(fields)}
+    )
+    for category, fields in CATEGORY_FIELDS.items()
+}
+
+def split_values(values: str) -> list:
+    """Split the inside of a reply list, accepting a JSON array body as well as bare comma-separated text."""
+    if '"' in values:
+        try:
+            parsed = json.loads(f"[{values}]")
+            return [str(value).strip() for value in parsed]
+        except ValueError:
+            pass
+    return [value.strip().strip('"').strip() for value in values.split(",")]
+
+def parse_category_line(category: str, line: str, is_from_photo: bool = False):
+    """Parse one 'Message : [values]' reply line (with an optional ' : [category, reconditioner]') into a record.
+
+    Raises RecordValidationError instead of guessing when the line can't be mapped onto the category's fields.
+    """
+    record_type = RECORD_TYPES[category]
+    match = CATEGORY_LINE_PATTERN.match(line.strip())
+    if not match:
+        raise RecordValidationError("Expected 'Message : [list]'")
+    values = split_values(match.group("values"))
+    if len(values) > len(record_type.fields):
+        if record_type.fields[-1] not in FREE_TEXT_FIELDS:
+            raise RecordValidationError(f"{len(values)} values for {len(record_type.fields)} {category} fields")
+        last = len(record_type.fields) - 1
+        values = values[:last] + [", ".join(value for value in values[last:] if value)]
+    reconditioner = None
+    if match.group("reconditioner") is not None:
+        parts = [part.strip().strip("'\"") for part in match.group("reconditioner").split(",")]
+        if len(parts) != 2 or not all(parts):
+            raise RecordValidationError("Expected reconditioner as [category, reconditioner]")
+        reconditioner = {"category": parts[0], "reconditioner": parts[1]}
+    return record_type(match.group("message").strip(), values, is_from_photo, reconditioner)
+
+# Deterministic Extractors
+REGO_PATTERN = re.compile(
+    r"\brego(?:istration)?(?:\s+(?:is|number|no\.?))?[\s:#.-]*([A-Za-z0-9]{1,4}(?:-?[A-Za-z0-9]{1,4})?)\b",
+    re.IGNORECASE
+)
+TIME_PATTERN = re.compile(r"\b(\d{1,2}(?::\d{2})?)\s?(am|pm)\b", re.IGNORECASE)
+DAY_PATTERN = re.compile(
+    r"\b(today|tonight|tomorrow|this arvo|this afternoon|this morning|"
+    r"monday|tuesday|wednesday|thursday|friday|saturday|sunday)\b",
+    re.IGNORECASE
+)
+COLOUR_PATTERN = re.compile(
+    r"\b(white|black|grey|gray|silver|blue|red|green|yellow|orange|gold|brown|maroon|purple|beige|bronze)\b",
+    re.IGNORECASE
+)
+# Which preposition in front of a known location fills which location field
+LOCATION_ROLES = {
+    "location": ("at", "in", ""),
+    "new_location": ("at", "in", "to"),
+    "next_location": ("to",),
+    "current_location": ("from",),
+    "old_location": ("from",)
+}
+# Categories whose simplest lines can be built without a category prompt: (required words, allowed words)
+SIMPLE_LINE_WORDS = {
+    "Ready": ({"ready"}, {"the", "is", "are", "now", "ready", "at", "it", "its", "s", "all"}),
+    "Location Update": (set(), {"the", "is", "now", "at", "in", "parked", "currently", "sitting"})
+}
+extractor_stats = FastPathStats()
+
+class LocationGazetteer:
+    """Known locations and their spellings, compiled into one case-insensitive matcher."""
+
+    def __init__(self, config: dict):
+        self.names = {}
+        for location in config.get("locations", []):
+            for alias in location.get("aliases", []) + [location["name"]]:
+                self.names.setdefault(alias.lower(), location["name"])
+        alternation = "|".join(re.escape(alias) for alias in sorted(self.names, key=len, reverse=True))
+        self.pattern = re.compile(
+            rf"(?:\b(?P<preposition>at|to|from|in)\s+(?:the\s+)?)?(?<![\w'])(?P<name>{alternation})(?![\w'])",
+            re.IGNORECASE
+        ) if self.names else None
+
+    @classmethod
+    def load(cls, path: str):
+        """Load locations from a JSON file; a missing or broken file disables location extraction."""
+        try:
+            with open(path, encoding="utf-8") as locations_file:
+                return cls(json.load(locations_file))
+        except (OSError, ValueError) as e:
+            if DEBUG_MODE:
+                print(f"Could not load locations from {path}: {e}", file=sys.stderr)
+            return cls({})
+
+    def canonical(self, value: str) -> str:
+        """Return the gazetteer spelling of a location, or the value unchanged if it isn't known."""
+        return self.names.get(value.strip().replace("\u2019", "'").lower(), value)
+
+    def find(self, text: str) -> list:
+        """Return (span, preposition, name) for every known location mentioned in text."""
+        if self.pattern is None:
+            return []
+        return [
+            (match.span(), (match.group("preposition") or "").lower(), self.names[match.group("name").lower()])
+            for match in self.pattern.finditer(text)
+        ]
+
+with startup_step("init:locations"):
+    location_gazetteer = LocationGazetteer.load(LOCATIONS_PATH)
+
+def normalise_rego(rego: str) -> str:
+    return re.sub(r"[\s-]", "", rego).upper()
+
+def extract_fields(text: str) -> dict:
+    """Pull the rego, known locations, day, time and colour out of a line without asking Grok.
+
+    "residue" is the text with everything extracted blanked out, for deciding if a line is simple.
+    """
+    text = text.replace("\u2019", "'")
+    fields = {"rego": "", "locations": [], "day": "", "time": "", "colour": ""}
+    covered = []
+    rego = next((match for match in REGO_PATTERN.finditer(text) if any(c.isdigit() for c in match.group(1))), None)
+    if rego:
+        fields["rego"] = rego.group(1).upper()
+        covered.append(rego.span())
+    for span, preposition, name in location_gazetteer.find(text):
+        fields["locations"].append((preposition, name))
+        covered.append(span)
+    time_match = TIME_PATTERN.search(text)
+    if time_match:
+        fields["time"] = time_match.group(1) + time_match.group(2).lower()
+        covered.append(time_match.span())
+    day_match = DAY_PATTERN.search(text)
+    if day_match:
+        day = day_match.group(1).lower()
+        fields["day"] = day.capitalize() if day.endswith("day") and day != "today" else day
+        covered.append(day_match.span())
+    colour_match = COLOUR_PATTERN.search(text)
+    if colour_match:
+        fields["colour"] = colour_match.group(1).capitalize()
+        covered.append(colour_match.span())
+    residue = list(text)
+    for start, end in covered:
+        residue[start:end] = " " * (end - start)
+    fields["residue"] = "".join(residue)
+    return fields
+
+def verify_record(record, is_from_photo: bool) -> int:
+    """Check a parsed category record against the extractors, fixing regos and filling blank fields.
+
+    Returns the number of fields changed.
+    """
+    fields = extract_fields(record.message)
+    changed = 0
+    for name in record.fields:
+        value = new_value = getattr(record, name)
+        if name == "rego":
+            if fields["rego"]:
+                if normalise_rego(value) != normalise_rego(fields["rego"]):
+                    new_value = fields["rego"]
+            elif value and (not any(c.isdigit() for c in value)
+                            or normalise_rego(value) not in normalise_rego(record.message)):
+                # Not a plate, or not in the message at all
+                new_value = ""
+        elif name in LOCATION_ROLES:
+            if value:
+                new_value = location_gazetteer.canonical(value)
+            else:
+                found = {location for preposition, location in fields["locations"] if preposition in LOCATION_ROLES[name]}
+                if len(found) == 1:
+                    new_value = found.pop()
+        elif name in ("day", "time") and not value:
+            new_value = fields[name]
+        if new_value != value:
+            setattr(record, name, new_value)
+            changed += 1
+    record.from_photo = bool(is_from_photo and record.rego)
+    return changed
+
+def settle_entry_locally(entry: dict):
+    """Build the record for a simple Ready or Location Update line without a category prompt, or return None."""
+    category = entry["category"]
+    if category not in SIMPLE_LINE_WORDS:
+        return None
+    summary = entry["sub_message"].split(": ", 1)[-1]
+    fields = extract_fields(summary)
+    if fields["time"] or fields["day"] or len(fields["locations"]) > 1:
+        return None
+    spans, unmatched = vehicle_index.scan(fields["residue"])
+    vehicles = {canonical for _, _, canonical in spans}
+    if len(vehicles) != 1:
+        return None
+    make, model, badge = vehicle_index.vehicles[vehicles.pop()]
+    required, allowed = SIMPLE_LINE_WORDS[category]
+    if not model or not required <= set(unmatched) or not set(unmatched) <= allowed:
+        return None
+    location = fields["locations"][0] if fields["locations"] else None
+    if category == "Ready":
+        if location and location[0] not in LOCATION_ROLES["location"]:
+            return None
+        data = [make, model, badge, fields["colour"], fields["rego"], location[1] if location else "", "Ready", ""]
+    else:
+        if not location or location[0] not in ("at", "in"):
+            return None
+        data = [make, model, badge, fields["colour"], fields["rego"], "", location[1], ""]
+    if DEBUG_MODE:
+        print(f"Settled {category} line locally: {entry['sub_message']} -> {data}", file=sys.stderr)
+    record = RECORD_TYPES[category](f"- {entry['sub_message']}", data, entry["is_from_photo"], sources=entry["sources"])
+    return [(entry["idx"], category, [record])]
+
+# Chatter Filter
+CHATTER_TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+CHATTER_CLASSES = ("chatter", "actionable")
+# The model is ignored until both classes have this many training lines
+CHATTER_MIN_TRAINING_LINES = 50
+# Longer lines almost always carry an instruction, so the model only judges short ones
+CHATTER_MODEL_MAX_TOKENS = 8
+# A logged message line counts as actionable when this share of its words reappears in prompt_1's output
+CHATTER_LABEL_OVERLAP = 0.5
+LOG_RECORD_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}T[\d:.]+Z - \[(?P<level>[A-Z]+)\] (?P<message>.*)$")
+
+def chatter_tokens(text: str) -> list:
+    return CHATTER_TOKEN_PATTERN.findall(text.lower().replace("'", "").replace("\u2019", ""))
+
+def chatter_ngrams(tokens: list) -> list:
+    """Unigrams plus bigrams over the line with start and end markers."""
+    padded = ["<s>"] + tokens + ["</s>"]
+    return tokens + [f"{a} {b}" for a, b in zip(padded, padded[1:])]
+
+class ChatterFilter:
+    """Rules plus a naive Bayes n-gram model that spot chat lines prompt_1 would return nothing for.
+
+    Lines with any sign of an instruction (a vehicle, location, rego, time, number or keep word) are
+    never dropped, and neither are photo lines or lines without a sender. Listed acknowledgements,
+    reactions and short replies ("cheers", "nice", "nah thats okay") are dropped by rule, except while
+    a question earlier in the batch is still unanswered: then even "nice" may be the answer ("is the
+    Hilux ready?" / "nice, yep"), so they are kept for prompt_1 to merge.
+    """
+
+    def __init__(self, rules: dict, model: dict = None):
+        self.phrases = {" ".join(chatter_tokens(phrase)) for phrase in rules.get("chatter_phrases", [])}
+        self.reply_phrases = {" ".join(chatter_tokens(phrase)) for phrase in rules.get("reply_phrases", [])}
+        self.question_words = {word.lower() for word in rules.get("question_words", [])}
+        self.keep_words = {word.lower() for word in rules.get("keep_words", [])}
+        lines = (model or {}).get("lines", {})
+        self.model = model if all(lines.get(c, 0) >= CHATTER_MIN_TRAINING_LINES for c in CHATTER_CLASSES) else None
+        if self.model is not None:
+            ngrams = self.model["ngrams"]
+            self.totals = {c: sum(ngrams[c].values()) for c in CHATTER_CLASSES}
+            self.vocabulary = len(set(ngrams["chatter"]) | set(ngrams["actionable"]))
+            self.priors = {c: math.log(lines[c] / sum(lines[k] for k in CHATTER_CLASSES)) for c in CHATTER_CLASSES}
+        self.stats = FastPathStats()
+
+    @classmethod
+    def load(cls, rules_path: str, model_path: str):
+        """Load the rules and trained model; a missing model leaves only the rules, missing rules disable both."""
+        try:
+            with open(rules_path, encoding="utf-8") as rules_file:
+                rules = json.load(rules_file)
+        except (OSError, ValueError) as e:
+            if DEBUG_MODE:
+                print(f"Could not load chatter rules from {rules_path}: {e}", file=sys.stderr)
+            return cls({})
+        model = None
+        try:
+            with open(model_path, encoding="utf-8") as model_file:
+                model = json.load(model_file)
+        except (OSError, ValueError) as e:
+            if DEBUG_MODE:
+                print(f"No chatter model loaded from {model_path}: {e}", file=sys.stderr)
+        return cls(rules, model)
+
+    def chatter_probability(self, tokens: list) -> float:
+        """Posterior probability that a line with these tokens is chatter, with add-one smoothing."""
+        scores = {}
+        for c in CHATTER_CLASSES:
+            counts = self.model["ngrams"][c]
+            denominator = self.totals[c] + self.vocabulary
+            scores[c] = self.priors[c] + sum(math.log((counts.get(g, 0) + 1) / denominator) for g in chatter_ngrams(tokens))
+        return 1 / (1 + math.exp(max(-50.0, min(50.0, scores["actionable"] - scores["chatter"]))))
+
+    def has_signal(self, content: str, tokens: list) -> bool:
+        """True when the line mentions anything an instruction would."""
+        if any(token in self.keep_words or any(ch.isdigit() for ch in token) for token in tokens):
+            return True
+        if REGO_PATTERN.search(content) or TIME_PATTERN.search(content) or DAY_PATTERN.search(content):
+            return True
+        if location_gazetteer.find(content):
+            return True
+        spans, unmatched = vehicle_index.scan(content)
+        return bool(spans) or any(MODEL_CODE_PATTERN.match(word) for word in unmatched)
+
+    def is_question(self, line: str) -> bool:
+        """True when a line asks something a later line in the batch may answer."""
+        content = SENDER_PREFIX_PATTERN.match(line.strip()).group(2).strip()
+        tokens = chatter_tokens(content)
+        return content.endswith("?") or bool(tokens and tokens[0] in self.question_words)
+
+    def is_phrase(self, line: str) -> bool:
+        """True when a line's text is one of the listed acknowledgements or short replies."""
+        phrase = " ".join(chatter_tokens(SENDER_PREFIX_PATTERN.match(line.strip()).group(2)))
+        return phrase in self.phrases or phrase in self.reply_phrases
+
+    def classify(self, line: str, threshold: float = None, pending_question: bool = False):
+        """Return why a line is chatter ("no_text", "phrase" or "model"), or None to keep it.
+
+        With pending_question set, listed phrases are kept because prompt_1 needs them to merge context.
+        """
+        prefix, content = SENDER_PREFIX_PATTERN.match(line.strip()).groups()
+        if not prefix or "[PHOTO]" in prefix:
+            return None
+        tokens = chatter_tokens(content)
+        if not tokens:
+            return "no_text"
+        if self.is_phrase(line):
+            return None if pending_question else "phrase"
+        if self.model is None or len(tokens) > CHATTER_MODEL_MAX_TOKENS or self.has_signal(content, tokens):
+            return None
+        threshold = CHATTER_THRESHOLD if threshold is None else threshold
+        return "model" if self.chatter_probability(tokens) >= threshold else None
+
+    def filter_lines(self, lines: list, threshold: float = None) -> tuple:
+        """Split (line_id, line) pairs into those to keep and (line_id, line, reason) for those dropped."""
+        kept = []
+        dropped = []
+        pending_question = False
+        for line_id, line in lines:
+            reason = self.classify(line, threshold, pending_question)
+            if reason is None:
+                kept.append((line_id, line))
+            else:
+                dropped.append((line_id, line, reason))
+                self.stats.count(f"dropped_{reason}")
+            # Short replies may trail a question one after another; a line with substance answers it
+            if self.is_question(line):
+                pending_question = True
+            elif reason is None and not self.is_phrase(line):
+                pending_question = False
+        self.stats.count("lines", len(lines))
+        return kept, dropped
+
+with startup_step("init:chatter_filter"):
+    chatter_filter = ChatterFilter.load(CHATTER_RULES_PATH, CHATTER_MODEL_PATH)
+
+def label_logged_lines(log_lines) -> list:
+    """Label each logged "Message:" line of a batch by whether prompt_1 kept it, for training.
+
+    Batches whose pipeline failed are skipped; a batch with no prompt_1 output was all chatter.
+    """
+    records = []
+    for raw in log_lines:
+        match = LOG_RECORD_PATTERN.match(raw.rstrip("\n"))
+        if match:
+            records.append(match.group("message").replace("[Telegram] ", "", 1))
+        elif records:
+            # Multi-line log messages (prompt outputs) continue without a timestamp
+            records[-1] += "\n" + raw.rstrip("\n")
+    labelled = []
+    batch = None
+    for record in records + ["Message: "]:
+        if record.startswith("Message: "):
+            if batch is not None and batch["closed"]:
+                if not batch["failed"]:
+                    output_tokens = set(chatter_tokens(batch["prompt1"]))
+                    for line in batch["lines"]:
+                        prefix, content = SENDER_PREFIX_PATTERN.match(line).groups()
+                        if not prefix or "[PHOTO]" in prefix:
+                            continue
+                        tokens = chatter_tokens(content)
+                        overlap = sum(1 for t in tokens if t in output_tokens) / len(tokens) if tokens else 0
+                        labelled.append((tokens, "actionable" if overlap >= CHATTER_LABEL_OVERLAP else "chatter"))
+                batch = None
+            if batch is None:
+                batch = {"lines": [], "prompt1": "", "failed": False, "closed": False}
+            batch["lines"].append(record[len("Message: "):])
+        elif batch is not None:
+            batch["closed"] = True
+            if record.startswith("Prompt 1 output: "):
+                batch["prompt1"] = record[len("Prompt 1 output: "):]
+            elif record.startswith("npai pipeline error: ") and "Unable to parse input" not in record:
+                batch["failed"] = True
+    return labelled
+
+def train_chatter_model(log_paths: list) -> dict:
+    """Count n-grams per class over labelled log lines and write the model to CHATTER_MODEL_PATH."""
+    model = {"lines": {c: 0 for c in CHATTER_CLASSES}, "ngrams": {c: {} for c in CHATTER_CLASSES}}
+    for path in log_paths:
+        with open(path, encoding="utf-8", errors="replace") as log_file:
+            for tokens, label in label_logged_lines(log_file):
+                model["lines"][label] += 1
+                counts = model["ngrams"][label]
+                for gram in chatter_ngrams(tokens):
+                    counts[gram] = counts.get(gram, 0) + 1
+    temp_path = f"{CHATTER_MODEL_PATH}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as model_file:
+        json.dump(model, model_file)
+    os.replace(temp_path, CHATTER_MODEL_PATH)
+    return {
+        "path": CHATTER_MODEL_PATH,
+        "lines": model["lines"],
+        "ngrams": {c: len(model["ngrams"][c]) for c in CHATTER_CLASSES},
+        "usable": all(model["lines"][c] >= CHATTER_MIN_TRAINING_LINES for c in CHATTER_CLASSES)
+    }
 
-{sub_message}
-"""
-    return analyze_with_grok(prompt)
+# Semantic Cache
+MINHASH_PERMUTATIONS = 64
+# 16 bands of 4 rows: texts at Jaccard 0.7 share a band with probability ~0.99, at 0.3 with ~0.12
+MINHASH_BANDS = 16
+MINHASH_PRIME = (1 << 61) - 1
+_minhash_random = random.Random(0x6E706169)
+MINHASH_COEFFICIENTS = [
+    (_minhash_random.randrange(1, MINHASH_PRIME), _minhash_random.randrange(0, MINHASH_PRIME))
+    for _ in range(MINHASH_PERMUTATIONS)
+]
+# Politeness and filler that never changes what an instruction means
+SEMANTIC_FILLER_WORDS = {"pls", "plz", "please", "the", "a", "an", "can", "could", "you", "u", "mate", "guys", "just", "thanks", "thx", "cheers"}
+NEGATION_WORDS = {"not", "no", "dont", "doesnt", "isnt", "wont", "cant", "never", "nah", "aint", "hasnt", "havent", "wasnt"}
+
+def semantic_text(text: str) -> tuple:
+    """Normalise a message for similarity and pull out the entities two matching messages must share.
+
+    Vehicles and locations are replaced by their canonical names, filler words are dropped and the
+    entities (senders, vehicles, located places, regos, numbers, days, times, colours, negations) come back
+    as a sorted tuple of "kind:value" strings.
+    """
+    entities = set()
+    lines = []
+    for line in text.replace("\u2019", "'").split("\n"):
+        if not line.strip():
+            continue
+        prefix, content = SENDER_PREFIX_PATTERN.match(line.strip()).groups()
+        if prefix:
+            entities.add("sender:" + " ".join(chatter_tokens(prefix)))
+        replacements = []
+        for start, end, canonical in vehicle_index.scan(content)[0]:
+            entities.add("vehicle:" + canonical.lower())
+            replacements.append((start, end, canonical))
+        # The preposition decides which location field a place fills, so "at Al's" and "to Al's" differ
+        for (start, end), preposition, name in location_gazetteer.find(content):
+            entities.add(f"location:{preposition}:{name.lower()}")
+            replacements.append((start, end, f"{preposition} {name}".strip()))
+        for pattern, kind in ((REGO_PATTERN, "rego"), (TIME_PATTERN, "time"), (DAY_PATTERN, "day"), (COLOUR_PATTERN, "colour")):
+            entities.update(f"{kind}:{match.group(0).lower()}" for match in pattern.finditer(content))
+        # Apply replacements right to left so earlier offsets stay valid; overlapping matches keep the first
+        normalised = content
+        last_start = len(content) + 1
+        for start, end, canonical in sorted(replacements, reverse=True):
+            if end <= last_start:
+                normalised = normalised[:start] + f" {canonical} " + normalised[end:]
+                last_start = start
+        tokens = [token for token in chatter_tokens(normalised) if token not in SEMANTIC_FILLER_WORDS]
+        entities.update(f"number:{token}" for token in tokens if any(ch.isdigit() for ch in token))
+        entities.update(f"negation:{token}" for token in tokens if token in NEGATION_WORDS)
+        lines.append(" ".join(tokens))
+    return "\n".join(lines), tuple(sorted(entities))
+
+def minhash_signature(text: str) -> list:
+    """MinHash over the character trigrams of text."""
+    padded = f" {text} "
+    shingles = {padded[i:i + 3] for i in range(max(1, len(padded) - 2))}
+    hashes = [int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big") for shingle in shingles]
+    return [min((a * h + b) % MINHASH_PRIME for h in hashes) for a, b in MINHASH_COEFFICIENTS]
+
+class SemanticCache(ResponseCache):
+    """Results for near-duplicate messages, found through MinHash LSH over normalised text.
+
+    Entries live in SQLite like the response cache; the LSH band index is rebuilt in memory from the
+    table on first use. A match needs the same kind, identical entities and an estimated similarity of
+    at least the threshold; with same_tokens it also needs the same set of normalised words, so only
+    reorderings, filler and alias spellings differ.
+    """
+
+    def __init__(self, path: str, max_entries: int, ttl: int, threshold: float, table: str = "semantic"):
+        super().__init__(path, max_entries, ttl, table)
+        self.threshold = threshold
+        self.stats.update({"near_hits": 0, "entity_mismatches": 0})
+        self._index = None
+        self._signatures = {}
+        self._index_lock = threading.Lock()
+
+    def _bands(self, signature: list) -> list:
+        rows = MINHASH_PERMUTATIONS // MINHASH_BANDS
+        return [(band, tuple(signature[band * rows:(band + 1) * rows])) for band in range(MINHASH_BANDS)]
+
+    def _add_to_index(self, key: str, signature: list):
+        self._signatures[key] = signature
+        for band in self._bands(signature):
+            self._index.setdefault(band, set()).add(key)
+
+    def _ensure_index(self):
+        """Build the band index from the persisted entries the first time it is needed."""
+        if self._index is not None:
+            return
+        self._index = {}
+        try:
+            with self._lock:
+                rows = self._connection().execute(f"SELECT key, value FROM {self.table}").fetchall()
+        except sqlite3.Error as e:
+            if DEBUG_MODE:
+                print(f"Semantic cache load failed: {e}", file=sys.stderr)
+            return
+        for key, value in rows:
+            try:
+                self._add_to_index(key, json.loads(value)["signature"])
+            except (ValueError, KeyError):
+                continue
+
+    def lookup(self, kind: str, text: str, same_tokens: bool = False):
+        """Return (value, similarity) for the closest cached message of this kind, or None."""
+        normalised, entities = semantic_text(text)
+        tokens = sorted(set(normalised.split()))
+        if not normalised:
+            return None
+        signature = minhash_signature(normalised)
+        with self._index_lock:
+            self._ensure_index()
+            candidates = set()
+            for band in self._bands(signature):
+                candidates |= self._index.get(band, set())
+            scored = sorted(
+                ((sum(a == b for a, b in zip(signature, self._signatures[key])) / MINHASH_PERMUTATIONS, key)
+                 for key in candidates if key in self._signatures),
+                reverse=True
+            )
+        for similarity, key in scored:
+            if similarity < self.threshold:
+                break
+            entry = self._read(key)
+            if entry is None:
+                # Expired or evicted since the index was built
+                with self._index_lock:
+                    self._signatures.pop(key, None)
+                continue
+            if entry["kind"] != kind:
+                continue
+            if entry["entities"] != list(entities):
+                self.stats["entity_mismatches"] += 1
+                continue
+            if same_tokens and entry.get("tokens") != tokens:
+                continue
+            self.stats["hits"] += 1
+            if similarity < 1:
+                self.stats["near_hits"] += 1
+            return entry["value"], round(similarity, 3)
+        self.stats["misses"] += 1
+        return None
+
+    def _read(self, key: str):
+        """Load one entry, honouring the TTL and refreshing its LRU position, without touching the stats."""
+        now = time.time()
+        try:
+            with self._lock:
+                conn = self._connection()
+                row = conn.execute(f"SELECT value, created FROM {self.table} WHERE key = ?", (key,)).fetchone()
+                if row is None or (self.ttl and now - row[1] > self.ttl):
+                    return None
+                conn.execute(f"UPDATE {self.table} SET accessed = ? WHERE key = ?", (now, key))
+                conn.commit()
+                return json.loads(row[0])
+        except (sqlite3.Error, ValueError) as e:
+            if DEBUG_MODE:
+                print(f"Semantic cache read failed: {e}", file=sys.stderr)
+            return None
+
+    def store(self, kind: str, text: str, value):
+        """Remember a JSON-serialisable result for a message."""
+        normalised, entities = semantic_text(text)
+        if not normalised:
+            return
+        signature = minhash_signature(normalised)
+        key = self.make_key(kind, normalised, entities)
+        self.set(key, json.dumps({
+            "kind": kind, "entities": list(entities), "tokens": sorted(set(normalised.split())),
+            "signature": signature, "value": value
+        }))
+        with self._index_lock:
+            self._ensure_index()
+            self._add_to_index(key, signature)
+
+with startup_step("init:semantic_cache"):
+    semantic_cache = SemanticCache(CACHE_PATH, SEMANTIC_CACHE_MAX_ENTRIES, CACHE_TTL, SEMANTIC_THRESHOLD)
+
+def semantic_cache_enabled() -> bool:
+    return SEMANTIC_CACHE and not CACHE_BYPASS and not cache_bypass_var.get()
 
 # Orchestration
-def run_pipeline(original_message: str, media_url: str = None) -> dict:
+# Every input line is tagged "[L<n>]" at its end; the prompts carry the tags through each stage
+LINE_TAG_PATTERN = re.compile(r"\s*\[#?(L\d+(?:\s*,\s*#?L\d+)*)\]")
+
+def split_line_tags(line: str) -> tuple:
+    """Return the line without its source tags and the line IDs they name, in order."""
+    ids = []
+    for match in LINE_TAG_PATTERN.finditer(line):
+        for line_id in match.group(1).split(","):
+            line_id = line_id.strip().lstrip("#")
+            if line_id not in ids:
+                ids.append(line_id)
+    return LINE_TAG_PATTERN.sub("", line).rstrip(), ids
+
+def tag_line(line: str, ids: list) -> str:
+    return f"{line} [{','.join(ids)}]" if ids else line
+
+def number_input_lines(message: str) -> tuple:
+    """Give every non-empty input line an ID; returns the (line_id, line) pairs and the sources table.
+
+    The table maps each ID to its text, whether it came from a photo, a content hash and its index
+    among the message's raw lines, so attribution is a dictionary lookup and callers can tell when a
+    source line has changed.
+    """
+    lines = []
+    sources = {}
+    for index, line in enumerate(message.split("\n")):
+        line = line.strip()
+        if not line:
+            continue
+        line_id = f"L{len(lines) + 1}"
+        lines.append((line_id, line))
+        sources[line_id] = {
+            "text": line,
+            "from_photo": line.startswith("[PHOTO]"),
+            "hash": hashlib.sha256(line.encode("utf-8")).hexdigest()[:16],
+            "line": index
+        }
+    return lines, sources
+
+def tag_message(message: str, lines: list, sources: dict) -> str:
+    """Rebuild message with each kept line tagged in place, keeping its blank lines and line breaks.
+
+    Lines missing from lines (dropped as chatter) are left out; everything else keeps its position,
+    so a list like "Clean:\n- Triton" reaches prompt_1 in the shape it was sent.
+    """
+    tagged = {sources[line_id]["line"]: tag_line(line, [line_id]) for line_id, line in lines}
+    raw_lines = message.split("\n")
+    return "\n".join(
+        tagged.get(index, "") for index, raw in enumerate(raw_lines) if index in tagged or not raw.strip()
+    ).strip("\n")
+
+def guess_line_ids(text: str, sources: dict) -> list:
+    """Recover the source of an output line the model dropped its [L<n>] tag from.
+
+    The source whose words are most fully repeated in the line wins, if at least half of them are and
+    no other source scores as well; otherwise the line stays unattributed.
+    """
+    words = set(chatter_tokens(text)) - SEMANTIC_FILLER_WORDS
+    scores = []
+    for line_id, source in sources.items():
+        content = SENDER_PREFIX_PATTERN.match(source["text"]).group(2)
+        source_words = set(chatter_tokens(content)) - SEMANTIC_FILLER_WORDS
+        if source_words:
+            scores.append((len(source_words & words) / len(source_words), line_id))
+    scores.sort(reverse=True)
+    if not scores or scores[0][0] < 0.5 or (len(scores) > 1 and scores[1][0] == scores[0][0]):
+        return []
+    return [scores[0][1]]
+
+CATEGORY_PROMPTS = {
+    "Ready": prompt_ready,
+    "Drop Off": prompt_drop_off,
+    "Customer Appointment": prompt_customer_appointment,
+    "Reconditioning Appointment": prompt_reconditioning_appointment,
+    "Car Repairs": prompt_car_repairs,
+    "Location Update": prompt_location_update,
+    "To Do": prompt_to_do,
+    "Notes": prompt_notes,
+    "Sold": prompt_sold
+}
+
+def parse_prompt3_line(idx: int, line: str, sources: dict):
+    """Split a prompt_3 output line into its category, sub-message and source line IDs, or return None if malformed."""
+    if not line.strip():
+        return None
+    line, line_ids = split_line_tags(line)
+    if not line_ids:
+        line_ids = guess_line_ids(line.rsplit(":", 1)[0], sources)
+    # A tagged line is from a photo when any of its sources is; untagged lines fall back to the [PHOTO] marker
+    is_from_photo = any(sources.get(line_id, {}).get("from_photo") for line_id in line_ids) or "[PHOTO]" in line
+    # Remove [PHOTO] for parsing but preserve the flag
+    clean_line = line.replace("[PHOTO] ", "").replace("[PHOTO]", "")
+    parts = clean_line.rsplit(":", 2)
+    if len(parts) != 3:
+        if DEBUG_MODE:
+            print(f"Malformed line: {line}", file=sys.stderr)
+        return None
+    sender, summary, category = parts
+    # Remove leading dash and space from sender, if present
+    sender = sender.strip().lstrip("- ").strip()
+    # Trim category to remove any leading/trailing spaces
+    category = category.strip()
+    if category not in CATEGORY_PROMPTS:
+        if DEBUG_MODE:
+            print(f"Unknown category: '{category}'", file=sys.stderr)
+        return None
+    # Construct sub_message without the leading dash
+    sub_message = f"{sender}: {summary}"
+    if DEBUG_MODE:
+        print(f"Processing category: '{category}', sub_message: {sub_message}", file=sys.stderr)
+    if DEBUG_MODE:
+        print(f"Line {idx}: {line}, is_from_photo: {is_from_photo}, sources: {line_ids}", file=sys.stderr)
+    return {"idx": idx, "category": category, "sub_message": sub_message, "is_from_photo": is_from_photo, "sources": line_ids}
+
+def attach_reconditioners(result: str) -> str:
+    """Append the reconditioner classification to every 'Message : List' line of a Car Repairs result."""
+    def attach(line):
+        if " : " not in line:
+            return line
+        # Analyze repair task for reconditioner category
+        repair_task = line.split(" : ")[1].strip().lstrip('[').rstrip(']').split(',')[5].strip()
+        if not repair_task:
+            return line
+        try:
+            with span("reconditioner"):
+                reconditioner_result = classify_reconditioner(repair_task)
+        except GrokError as e:
+            # databaseUpdate.js falls back to other/Technician when no reconditioner is attached
+            if DEBUG_MODE:
+                print(f"Reconditioner classification failed for '{repair_task}': {e}", file=sys.stderr)
+            return line
+        if DEBUG_MODE:
+            print(f"Reconditioner category result: {reconditioner_result}", file=sys.stderr)
+        # Append reconditioner info to the result
+        return f"{line} : [{', '.join(reconditioner_result)}]"
+
+    lines = [line for line in result.split("\n") if line.strip()]
+    if len(lines) <= 1:
+        return "\n".join(attach(line) for line in lines)
+    with ThreadPoolExecutor(max_workers=min(MAX_CONCURRENCY, len(lines))) as executor:
+        return "\n".join(executor.map(in_context(attach), lines))
+
+def normalise_message(message: str) -> str:
+    """Normalise a 'Sender: summary' string so category replies can be matched back to their source line."""
+    message = message.replace("[PHOTO]", "").strip().lstrip("- ").strip().lower()
+    message = re.sub(r"\s*:\s*", ": ", message, count=1)
+    return re.sub(r"\s+", " ", message).rstrip(" .")
+
+def split_grouped_reply(reply: str, entries: list) -> list:
+    """Assign each 'Message : List' line of a grouped category reply to the source entry it belongs to."""
+    assigned = [[] for _ in entries]
+    keys = [normalise_message(entry["sub_message"]) for entry in entries]
+    unmatched = []
+    for line in reply.split("\n"):
+        if " : " not in line:
+            continue
+        key = normalise_message(line.split(" : ", 1)[0])
+        candidates = [i for i, k in enumerate(keys) if k == key]
+        if not candidates:
+            scores = [difflib.SequenceMatcher(None, key, k).ratio() for k in keys]
+            best = max(range(len(keys)), key=lambda i: scores[i])
+            if scores[best] >= GROUP_MATCH_THRESHOLD:
+                candidates = [best]
+        if candidates:
+            # Prefer a source line that has no reply yet so duplicated messages pair up in order
+            target = next((i for i in candidates if not assigned[i]), candidates[0])
+            assigned[target].append(line)
+        else:
+            unmatched.append(line)
+    # Anything left over is paired with the remaining source lines by position
+    for line in unmatched:
+        target = next((i for i, lines in enumerate(assigned) if not lines), None)
+        if target is None:
+            if DEBUG_MODE:
+                print(f"Unassigned grouped reply line: {line}", file=sys.stderr)
+            continue
+        assigned[target].append(line)
+    return ["\n".join(lines) for lines in assigned]
+
+def process_category_line(entry: dict, failures: list):
+    """Run the category prompt for one prompt_3 line and return [(idx, category, parsed records)]."""
+    category = entry["category"]
+    category_prompt = CATEGORY_PROMPTS[category]
+    local = settle_entry_locally(entry)
+    if local is not None:
+        extractor_stats.count("local")
+        count_avoided("extractors")
+        return local
+    extractor_stats.count("llm")
+    cached = settle_entry_from_cache(entry, failures)
+    if cached is not None:
+        count_avoided("semantic_cache")
+        return cached
+    try:
+        if DEBUG_MODE:
+            print(f"Calling {category_prompt.__name__} with: {entry['sub_message']}", file=sys.stderr)
+        with span(f"category:{category}", lines=1):
+            result = category_prompt(entry["sub_message"])
+        if category == "Car Repairs":
+            result = attach_reconditioners(result)
+        return [(entry["idx"], category, parse_and_remember(entry, result, failures))]
+    except Exception as e:
+        if DEBUG_MODE:
+            print(f"Failed to process line: {entry['sub_message']} - {str(e)}", file=sys.stderr)
+        failures.append({"category": category, "message": entry["sub_message"], "error": str(e)})
+        return []
+
+def process_category_group(category: str, entries: list, failures: list):
+    """Run one category prompt over every line of that category and split the reply back per line."""
+    category_prompt = CATEGORY_PROMPTS[category]
+    sub_messages = "\n".join(f"- {entry['sub_message']}" for entry in entries)
+    try:
+        if DEBUG_MODE:
+            print(f"Calling {category_prompt.__name__} with {len(entries)} lines: {sub_messages}", file=sys.stderr)
+        with span(f"category:{category}", lines=len(entries)):
+            reply = category_prompt(sub_messages)
+        if category == "Car Repairs":
+            reply = attach_reconditioners(reply)
+        return [
+            (entry["idx"], category, parse_and_remember(entry, result, failures))
+            for entry, result in zip(entries, split_grouped_reply(reply, entries))
+        ]
+    except Exception as e:
+        if DEBUG_MODE:
+            print(f"Failed to process {category} group - {str(e)}", file=sys.stderr)
+        failures.extend({"category": category, "message": entry["sub_message"], "error": str(e)} for entry in entries)
+        return []
+
+def settle_entry_from_cache(entry: dict, failures: list):
+    """Reuse the category reply given for a near-duplicate line, or return None."""
+    if not semantic_cache_enabled():
+        return None
+    hit = semantic_cache.lookup(f"category:{entry['category']}", entry["sub_message"])
+    if hit is None:
+        return None
+    if DEBUG_MODE:
+        print(f"Semantic cache hit ({hit[1]}) for: {entry['sub_message']}", file=sys.stderr)
+    records = parse_category_result(entry["category"], hit[0], entry["is_from_photo"], failures)
+    for record in records:
+        record.sources = list(entry["sources"])
+    return [(entry["idx"], entry["category"], records)]
+
+def parse_and_remember(entry: dict, result: str, failures: list) -> list:
+    """Parse a category reply for one line and keep it for near-duplicates if every line of it was valid."""
+    line_failures = []
+    records = parse_category_result(entry["category"], result, entry["is_from_photo"], line_failures)
+    failures.extend(line_failures)
+    for record in records:
+        record.sources = list(entry["sources"])
+    if records and not line_failures and semantic_cache_enabled():
+        semantic_cache.store(f"category:{entry['category']}", entry["sub_message"], result)
+    return records
+
+def parse_category_result(category: str, result: str, is_from_photo: bool, failures: list) -> list:
+    """Parse a category prompt result, logging empty results and reporting invalid lines in failures."""
+    if DEBUG_MODE:
+        print(f"Result from category prompt: {result}", file=sys.stderr)
+    if not result:
+        if DEBUG_MODE:
+            print(f"No result returned from category prompt for {category}", file=sys.stderr)
+        return []
+    parsed_output = parse_category_output(result, category, is_from_photo, failures)
+    corrected = sum(verify_record(record, is_from_photo) for record in parsed_output)
+    if corrected:
+        extractor_stats.count("corrected", corrected)
+    if DEBUG_MODE:
+        print(f"Parsed output for {category}: {parsed_output}", file=sys.stderr)
+    return parsed_output
+
+def run_category_prompts(entries: list, failures: list, max_concurrency: int = None, grouped: bool = False) -> list:
+    """Run category prompts for parsed prompt_3 entries concurrently and return results in line order."""
+    if grouped:
+        # Simple lines are settled locally, then from near-duplicates, so each category call only carries what needs Grok
+        settled = []
+        groups = {}
+        sources = {}
+        extracted = 0
+        for entry in entries:
+            local = settle_entry_locally(entry)
+            if local is not None:
+                settled.extend(local)
+                extracted += 1
+                sources.setdefault(entry["category"], set()).add("extractors")
+                continue
+            cached = settle_entry_from_cache(entry, failures)
+            if cached is not None:
+                settled.extend(cached)
+                sources.setdefault(entry["category"], set()).add("semantic_cache")
+            else:
+                groups.setdefault(entry["category"], []).append(entry)
+        extractor_stats.count("local", extracted)
+        extractor_stats.count("llm", len(entries) - extracted)
+        for category in set(sources) - set(groups):
+            count_avoided("semantic_cache" if "semantic_cache" in sources[category] else "extractors")
+        # One call per category, carrying every line of that category
+        tasks = [(process_category_group, (category, group, failures)) for category, group in groups.items()]
+    else:
+        settled = []
+        tasks = [(process_category_line, (entry, failures)) for entry in entries]
+    if not tasks:
+        return sorted(settled, key=lambda item: item[0])
+    workers = max(1, min(max_concurrency or MAX_CONCURRENCY, len(tasks)))
+    # Category calls are independent; results are re-sorted into the original line order
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        task_results = list(executor.map(in_context(lambda task: task[0](*task[1])), tasks))
+    return sorted(settled + [item for results in task_results for item in results], key=lambda item: item[0])
+
+def run_staged_chain(original_message: str, sources: dict, failures: list, max_concurrency: int = None, grouped: bool = None) -> dict:
+    """Run prompt_1, prompt_2 and prompt_3 to completion one after another, then the category prompts."""
+    # Run initial three prompts; a Grok failure stops the chain and is reported instead of parsed
+    chain = {"prompt1": "", "prompt2": "", "prompt3": "", "line_results": [], "error": None}
+    try:
+        with span("prompt_1"):
+            chain["prompt1"] = prompt_1(original_message) if original_message.strip() else ""
+        if DEBUG_MODE:
+            print(f"Prompt 1 output: {chain['prompt1']}", file=sys.stderr)
+        with span("prompt_2"):
+            chain["prompt2"] = expand_summary(chain["prompt1"]) if chain["prompt1"].strip() else ""
+        if DEBUG_MODE:
+            print(f"Prompt 2 output: {chain['prompt2']}", file=sys.stderr)
+        with span("prompt_3"):
+            chain["prompt3"] = prompt_3(chain["prompt2"]) if chain["prompt2"].strip() else ""
+        if DEBUG_MODE:
+            print(f"Prompt 3 output: {chain['prompt3']}", file=sys.stderr)
+    except GrokError as e:
+        chain["error"] = str(e)
+        if DEBUG_MODE:
+            print(f"Pipeline stopped: {chain['error']}", file=sys.stderr)
+
+    if chain["prompt3"].strip():
+        entries = [
+            entry for entry in (
+                parse_prompt3_line(idx, line, sources)
+                for idx, line in enumerate(chain["prompt3"].split("\n"))
+            ) if entry
+        ]
+        if grouped is None:
+            grouped = GROUP_CATEGORIES
+        chain["line_results"] = run_category_prompts(entries, failures, max_concurrency, grouped)
+    return chain
+
+class MicroBatch:
+    """Collects streamed items and hands them to flush() in groups, by size, by age or on close()."""
+
+    def __init__(self, flush, max_size: int, max_wait: float):
+        self.flush = flush
+        self.max_size = max(1, max_size)
+        self.max_wait = max_wait
+        self._items = []
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def _take(self) -> list:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        items, self._items = self._items, []
+        return items
+
+    def add(self, item):
+        # flush() runs under the lock so close() cannot return while a timed flush is still submitting
+        with self._lock:
+            self._items.append(item)
+            if len(self._items) >= self.max_size:
+                self.flush(self._take())
+            elif self._timer is None:
+                self._timer = threading.Timer(self.max_wait, self._expire)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _expire(self):
+        with self._lock:
+            self._timer = None
+            if self._items:
+                self.flush(self._take())
+
+    def close(self) -> bool:
+        """Flush whatever is left; returns whether there was anything."""
+        with self._lock:
+            items = self._take()
+            if items:
+                self.flush(items)
+            return bool(items)
+
+def source_slot(line: str, slots: list, previous):
+    """Pick the key of the input line a streamed output line came from, matching their [L<n>] tags.
+
+    slots holds (key, line IDs) in input order; untagged or unmatched lines follow the previous pick.
+    """
+    line_ids = set(split_line_tags(line)[1])
+    candidates = [key for key, slot_ids in slots if line_ids & slot_ids]
+    later = [key for key in candidates if key >= previous]
+    return later[0] if later else candidates[0] if candidates else previous
+
+def run_streamed_chain(original_message: str, sources: dict, failures: list, max_concurrency: int = None) -> dict:
+    """Run the prompt chain with streamed completions, handing finished lines on to the next stage.
+
+    Lines reach prompt_2 and prompt_3 in small micro-batches (STREAM_BATCH_SIZE lines or STREAM_BATCH_WAIT
+    seconds), so a categorised line reaches its category prompt while the earlier stages are still
+    generating later lines, without paying for a prompt_2 and prompt_3 call per line. If prompt_1 fails
+    the run stops like the staged chain does: queued batches are dropped and running streams stop early.
+    """
+    chain = {"prompt1": "", "prompt2": "", "prompt3": "", "line_results": [], "error": None}
+    if not original_message.strip():
+        return chain
+    started = time.monotonic()
+    prompt2_lines = {}
+    prompt3_lines = {}
+    line_results = []
+    first_record = []
+    futures = []
+    prompt2_calls = []
+    stopped = threading.Event()
+    state_lock = threading.Lock()
+    executor = ThreadPoolExecutor(max_workers=max(1, max_concurrency or MAX_CONCURRENCY))
+
+    def submit(fn, *args):
+        with state_lock:
+            if not stopped.is_set():
+                futures.append(executor.submit(in_context(fn), *args))
+
+    def categorise(entry):
+        if stopped.is_set():
+            return
+        results = process_category_line(entry, failures)
+        with state_lock:
+            line_results.extend(results)
+            if not first_record and any(records for _, _, records in results):
+                first_record.append(time.monotonic() - started)
+
+    def emit(stage: str, items: list):
+        """Stream one micro-batch of (key, line) through a prompt, yielding each output line with its key."""
+        counts = {}
+        previous = items[0][0]
+        slots = [(key, set(split_line_tags(line)[1])) for key, line in items]
+        prompt = prompt_2 if stage == "prompt_2" else prompt_3
+        with span(stage, lines=len(items)):
+            for output in prompt("\n".join(line for _, line in items), stream=True):
+                if stopped.is_set():
+                    return
+                previous = source_slot(output, slots, previous)
+                counts[previous] = counts.get(previous, -1) + 1
+                yield previous + (counts[previous],), output
+
+    def refine(items):
+        # Streams do their own retries; a failure here only loses this batch's branch
+        try:
+            for key, refined in emit("prompt_3", items):
+                with state_lock:
+                    prompt3_lines[key] = refined
+                entry = parse_prompt3_line(key, refined, sources)
+                if entry:
+                    submit(categorise, entry)
+        except GrokError as e:
+            failures.extend({"category": "prompt_3", "message": line, "error": str(e)} for _, line in items)
+
+    def expand(items):
+        unresolved = []
+        for key, line in items:
+            text, line_ids = split_line_tags(line)
+            local = vehicle_index.expand_line(text)
+            if local is None:
+                unresolved.append((key, line))
+                continue
+            local = tag_line(local, line_ids)
+            vehicle_index.stats.count("local")
+            with state_lock:
+                prompt2_lines[key + (0,)] = local
+            refine_batch.add((key + (0,), local))
+        vehicle_index.stats.count("llm", len(unresolved))
+        if not unresolved or stopped.is_set():
+            return
+        prompt2_calls.append(len(unresolved))
+        try:
+            for key, expanded in emit("prompt_2", unresolved):
+                with state_lock:
+                    prompt2_lines[key] = expanded
+                refine_batch.add((key, expanded))
+        except GrokError as e:
+            failures.extend({"category": "prompt_2", "message": line, "error": str(e)} for _, line in unresolved)
+
+    # Wrapped here so timed flushes from timer threads still run in this run's context
+    expand_batch = MicroBatch(in_context(lambda items: submit(expand, items)), STREAM_BATCH_SIZE, STREAM_BATCH_WAIT)
+    refine_batch = MicroBatch(in_context(lambda items: submit(refine, items)), STREAM_BATCH_SIZE, STREAM_BATCH_WAIT)
+
+    prompt1_lines = []
+    try:
+        with span("prompt_1"):
+            for i, line in enumerate(prompt_1(original_message, stream=True)):
+                prompt1_lines.append(line)
+                expand_batch.add(((i,), line))
+    except GrokError as e:
+        chain["error"] = str(e)
+        stopped.set()
+        with state_lock:
+            for future in futures:
+                future.cancel()
+    # Keep waiting until no stage has queued any new work, flushing partial batches stage by stage
+    while True:
+        with state_lock:
+            pending = list(futures)
+        wait(pending)
+        flushed = any(batch.close() for batch in (expand_batch, refine_batch))
+        with state_lock:
+            if not flushed and len(futures) == len(pending):
+                break
+    executor.shutdown()
+    # Counted once per run, as expand_summary does when every line resolves locally
+    if prompt1_lines and not stopped.is_set() and not prompt2_calls:
+        count_avoided("vehicle_aliases")
+    chain["prompt1"] = "\n".join(prompt1_lines)
+    chain["prompt2"] = "\n".join(prompt2_lines[key] for key in sorted(prompt2_lines))
+    chain["prompt3"] = "\n".join(prompt3_lines[key] for key in sorted(prompt3_lines))
+    chain["line_results"] = sorted(line_results, key=lambda item: item[0])
+    chain["timings"] = {
+        "time_to_first_record": round(first_record[0], 3) if first_record else None,
+        "total": round(time.monotonic() - started, 3)
+    }
+    if DEBUG_MODE:
+        print(f"Streamed chain timings: {chain['timings']}", file=sys.stderr)
+    return chain
+
+def run_fused_chain(original_message: str, sources: dict, failures: list) -> dict:
+    """Run the fused single-call engine and shape its records like the staged engine's output."""
+    chain = {"prompt1": "", "prompt2": "", "prompt3": "", "line_results": [], "error": None}
+    if not original_message.strip():
+        return chain
+    try:
+        with span("fused"):
+            reply = prompt_fused(original_message)
+    except GrokError as e:
+        chain["error"] = str(e)
+        return chain
+    try:
+        records = json.loads(reply).get("records", [])
+    except (ValueError, AttributeError) as e:
+        chain["error"] = f"Fused engine returned invalid JSON: {e}"
+        return chain
+    has_photo = "[PHOTO]" in original_message
+    categorised = []
+    for idx, record in enumerate(records):
+        category = record.get("category")
+        if category not in CATEGORY_FIELDS:
+            failures.append({"category": str(category), "message": record.get("summary", ""), "error": "Unknown category"})
+            continue
+        sender = (record.get("sender") or "Unknown").strip()
+        message = f"{sender}: {(record.get('summary') or '').strip()}"
+        fields = record.get("fields") or {}
+        data = [str(fields.get(name) or "").strip() for name in CATEGORY_FIELDS[category]]
+        reconditioner = record.get("reconditioner")
+        if category == "Car Repairs" and reconditioner:
+            reconditioner = {
+                "category": reconditioner.get("category") or "other",
+                "reconditioner": reconditioner.get("name") or "Technician"
+            }
+        else:
+            reconditioner = None
+        line_ids = [str(line_id).lstrip("#") for line_id in record.get("sources") or [] if str(line_id).lstrip("#") in sources]
+        line_ids = line_ids or guess_line_ids(message, sources)
+        from_photo = any(sources[line_id]["from_photo"] for line_id in line_ids) if line_ids else record.get("from_photo")
+        entry = RECORD_TYPES[category](message, data, has_photo and from_photo, reconditioner, line_ids)
+        categorised.append(tag_line(f"- {'[PHOTO] ' if from_photo else ''}{message}", line_ids) + f": {category}")
+        chain["line_results"].append((idx, category, [entry]))
+    chain["prompt3"] = "\n".join(categorised)
+    return chain
+
+def run_pipeline(original_message: str, media_url: str = None, max_concurrency: int = None, grouped: bool = None,
+                 streaming: bool = None, engine: str = None, use_cache: bool = True, filter_chatter: bool = None) -> dict:
     """Process the incoming message through prompts and return structured JSON."""
-    if os.getenv('DEBUG_MODE') == 'true':
+    started = time.monotonic()
+    metrics = RunMetrics()
+    metrics_token = run_metrics_var.set(metrics)
+    bypass_token = cache_bypass_var.set(not use_cache)
+    try:
+        output = run_engine(original_message, media_url, max_concurrency, grouped, streaming, engine, filter_chatter)
+    finally:
+        run_metrics_var.reset(metrics_token)
+        cache_bypass_var.reset(bypass_token)
+    output["usage"] = dict(metrics.as_dict(), latency=round(time.monotonic() - started, 3))
+    output["metrics"] = metrics.report()
+    export_metrics(output)
+    return output
+
+def run_engine(original_message: str, media_url: str, max_concurrency: int, grouped: bool, streaming: bool, engine: str,
+               filter_chatter: bool = None) -> dict:
+    """Photo handling, the selected prompt engine and category merging behind run_pipeline."""
+    if DEBUG_MODE:
         print(f"Raw input received: {original_message}", file=sys.stderr)
 
     # Track photo messages explicitly
     photo_messages = []
+    prefix_lines = 0
     if media_url:
-        photo_path = download_image(media_url)
-        if photo_path:
-            photo_analysis = analyze_photo(photo_path)
-            os.remove(photo_path)
-            if os.getenv('DEBUG_MODE') == 'true':
+        with span("download"):
+            image_data = download_image(media_url)
+        if image_data is not None:
+            with span("photo_analysis"):
+                photo_analysis = analyze_image(image_data)
+            if DEBUG_MODE:
                 print(f"Photo analysis result: {photo_analysis}", file=sys.stderr)
             # Prepend photo analysis with sender from the message, with [PHOTO] marker
             first_sender = original_message.split(": ", 1)[0] if ": " in original_message else "Unknown"
             photo_message = f"[PHOTO] {first_sender}: {photo_analysis}"
             photo_messages.append(photo_message)
             original_message = f"{photo_message}\n\n{original_message}"
-
-    # Keep track of which messages are from photos
-    message_lines = original_message.split('\n')
-    photo_message_indices = [i for i, line in enumerate(message_lines) if '[PHOTO]' in line]
-
-    # Run initial three prompts
-    output_prompt1 = prompt_1(original_message) if original_message.strip() else ""
-    if os.getenv('DEBUG_MODE') == 'true':
-        print(f"Prompt 1 output: {output_prompt1}", file=sys.stderr)
-    output_prompt2 = prompt_2(output_prompt1) if output_prompt1.strip() else ""
-    if os.getenv('DEBUG_MODE') == 'true':
-        print(f"Prompt 2 output: {output_prompt2}", file=sys.stderr)
-    output_prompt3 = prompt_3(output_prompt2) if output_prompt2.strip() else ""
-    if os.getenv('DEBUG_MODE') == 'true':
-        print(f"Prompt 3 output: {output_prompt3}", file=sys.stderr)
+            prefix_lines = photo_message.count("\n") + 2
+
+    # Every input line and photo gets an ID that records carry back out, so attribution is a lookup
+    lines, sources = number_input_lines(original_message)
+
+    # Drop chatter lines; a batch that was nothing but chatter never reaches the LLM
+    dropped = []
+    filtering = CHATTER_FILTER if filter_chatter is None else filter_chatter
+    if filtering:
+        with span("chatter_filter"):
+            lines, dropped = chatter_filter.filter_lines(lines)
+        if DEBUG_MODE and dropped:
+            print(f"Chatter filter dropped: {dropped}", file=sys.stderr)
+    short_circuited = bool(dropped) and not lines
+    line_ids = [line_id for line_id, _ in lines]
+    original_message = tag_message(original_message, lines, sources)
+    if short_circuited:
+        chatter_filter.stats.count("local")
+        count_avoided("chatter_filter")
+    elif filtering:
+        chatter_filter.stats.count("llm")
+
+    # A re-worded repeat of an earlier text-only batch reuses its whole result
+    semantic_hit = None
+    use_semantic = not short_circuited and not photo_messages and semantic_cache_enabled()
+    if use_semantic:
+        with span("semantic_cache"):
+            # A whole batch replays every record, so one changed word ("booked" / "cancelled") must miss
+            semantic_hit = semantic_cache.lookup("pipeline", "\n".join(line for _, line in lines), same_tokens=True)
+        # The cached records name the earlier batch's line IDs, which only map across when the line counts agree
+        if semantic_hit is not None and len(semantic_hit[0].get("line_ids", [])) != len(line_ids):
+            semantic_hit = None
+
+    failures = []
+    engine = engine or ENGINE
+    if streaming is None:
+        streaming = STREAMING
+    if short_circuited:
+        chain = {"prompt1": "", "prompt2": "", "prompt3": "", "line_results": [], "error": None}
+    elif semantic_hit is not None:
+        count_avoided("semantic_cache")
+        remap = dict(zip(semantic_hit[0]["line_ids"], line_ids))
+        chain = dict(semantic_hit[0], line_results=[], error=None)
+        chain["categories"] = {
+            category: [dict(record, sources=[remap.get(line_id, line_id) for line_id in record.get("sources", [])])
+                       for record in records]
+            for category, records in semantic_hit[0]["categories"].items()
+        }
+    elif engine == "fused":
+        chain = run_fused_chain(original_message, sources, failures)
+    elif streaming:
+        chain = run_streamed_chain(original_message, sources, failures, max_concurrency)
+    else:
+        chain = run_staged_chain(original_message, sources, failures, max_concurrency, grouped)
 
     # Process category-specific prompts
     category_outputs = {
@@ -808,182 +3662,219 @@ def run_pipeline(original_message: str, media_url: str = None) -> dict:
         "Notes": [],
         "Sold": []
     }
-
-    if output_prompt3.strip():
-        for idx, line in enumerate(output_prompt3.split("\n")):
-            if line.strip():
-                try:
-                    # Check if the line starts with [PHOTO]
-                    is_from_photo = line.startswith("[PHOTO]")
-                    # Remove [PHOTO] for parsing but preserve the flag
-                    clean_line = line.replace("[PHOTO] ", "") if is_from_photo else line
-                    parts = clean_line.rsplit(":", 2)
-                    if len(parts) == 3:
-                        sender, summary, category = parts
-                        # Remove leading dash and space from sender, if present
-                        sender = sender.strip().lstrip("- ").strip()
-                        # Trim category to remove any leading/trailing spaces
-                        category = category.strip()
-                        # Construct sub_message without the leading dash
-                        sub_message = f"{sender}: {summary}"
-                        if os.getenv('DEBUG_MODE') == 'true':
-                            print(f"Processing category: '{category}', sub_message: {sub_message}", file=sys.stderr)
-                        # Determine if this message corresponds to a photo message
-                        summary_without_sender = summary.strip()
-                        is_from_photo = any(summary_without_sender in pm.split(": ", 1)[1] for pm in photo_messages)
-                        if os.getenv('DEBUG_MODE') == 'true':
-                            print(f"Line {idx}: {line}, is_from_photo: {is_from_photo}, summary: {summary_without_sender}", file=sys.stderr)
-                            print(f"Photo messages to compare: {photo_messages}", file=sys.stderr)
-                        result = None
-                        if category == "Ready":
-                            if os.getenv('DEBUG_MODE') == 'true':
-                                print(f"Calling prompt_ready with: {sub_message}", file=sys.stderr)
-                            result = prompt_ready(sub_message)
-                        elif category == "Drop Off":
-                            if os.getenv('DEBUG_MODE') == 'true':
-                                print(f"Calling prompt_drop_off with: {sub_message}", file=sys.stderr)
-                            result = prompt_drop_off(sub_message)
-                        elif category == "Customer Appointment":
-                            if os.getenv('DEBUG_MODE') == 'true':
-                                print(f"Calling prompt_customer_appointment with: {sub_message}", file=sys.stderr)
-                            result = prompt_customer_appointment(sub_message)
-                        elif category == "Reconditioning Appointment":
-                            if os.getenv('DEBUG_MODE') == 'true':
-                                print(f"Calling prompt_reconditioning_appointment with: {sub_message}", file=sys.stderr)
-                            result = prompt_reconditioning_appointment(sub_message)
-                        elif category == "Car Repairs":
-                            if os.getenv('DEBUG_MODE') == 'true':
-                                print(f"Calling prompt_car_repairs with: {sub_message}", file=sys.stderr)
-                            result = prompt_car_repairs(sub_message)
-                            # Analyze repair task for reconditioner category
-                            repair_task = result.split(" : ")[1].strip().lstrip('[').rstrip(']').split(',')[5].strip()
-                            if repair_task:
-                                reconditioner_result = prompt_reconditioner_category(repair_task)
-                                if os.getenv('DEBUG_MODE') == 'true':
-                                    print(f"Reconditioner category result: {reconditioner_result}", file=sys.stderr)
-                                # Append reconditioner info to the result
-                                result = f"{result} : {reconditioner_result}"
-                        elif category == "Location Update":
-                            if os.getenv('DEBUG_MODE') == 'true':
-                                print(f"Calling prompt_location_update with: {sub_message}", file=sys.stderr)
-                            result = prompt_location_update(sub_message)
-                        elif category == "To Do":
-                            if os.getenv('DEBUG_MODE') == 'true':
-                                print(f"Calling prompt_to_do with: {sub_message}", file=sys.stderr)
-                            result = prompt_to_do(sub_message)
-                        elif category == "Notes":
-                            if os.getenv('DEBUG_MODE') == 'true':
-                                print(f"Calling prompt_notes with: {sub_message}", file=sys.stderr)
-                            result = prompt_notes(sub_message)
-                        elif category == "Sold":
-                            if os.getenv('DEBUG_MODE') == 'true':
-                                print(f"Calling prompt_sold with: {sub_message}", file=sys.stderr)
-                            result = prompt_sold(sub_message)
-                        else:
-                            if os.getenv('DEBUG_MODE') == 'true':
-                                print(f"Unknown category: '{category}'", file=sys.stderr)
-                            continue
-                        if os.getenv('DEBUG_MODE') == 'true':
-                            print(f"Result from category prompt: {result}", file=sys.stderr)
-                        if result:
-                            parsed_output = parse_category_output(result, is_from_photo)
-                            if os.getenv('DEBUG_MODE') == 'true':
-                                print(f"Parsed output for {category}: {parsed_output}", file=sys.stderr)
-                            category_outputs[category].extend(parsed_output)
-                        else:
-                            if os.getenv('DEBUG_MODE') == 'true':
-                                print(f"No result returned from category prompt for {category}", file=sys.stderr)
-                    else:
-                        if os.getenv('DEBUG_MODE') == 'true':
-                            print(f"Malformed line: {line}", file=sys.stderr)
-                except Exception as e:
-                    if os.getenv('DEBUG_MODE') == 'true':
-                        print(f"Failed to parse line: {line} - {str(e)}", file=sys.stderr)
-                    continue
+    for _, category, parsed_output in chain["line_results"]:
+        category_outputs[category].extend(record.as_dict() for record in parsed_output)
+    for category, records in chain.get("categories", {}).items():
+        category_outputs[category].extend(records)
 
     # Prepare JSON output
     output = {
-        "prompt1": output_prompt1,
-        "prompt2": output_prompt2,
-        "prompt3": output_prompt3,
-        "categories": category_outputs
+        "engine": engine,
+        "prompt1": chain["prompt1"],
+        "prompt2": chain["prompt2"],
+        "prompt3": chain["prompt3"],
+        "categories": category_outputs,
+        "sources": sources,
+        # Where each ID's line sits among the caller's message lines, for mapping records back to it
+        "line_index": {
+            line_id: source["line"] - prefix_lines for line_id, source in sources.items() if source["line"] >= prefix_lines
+        }
     }
 
-    if not output_prompt1.strip() and not output_prompt2.strip() and not output_prompt3.strip():
+    if failures:
+        output["failed_lines"] = failures
+    if dropped:
+        output["chatter_filter"] = {
+            "dropped_lines": len(dropped),
+            "short_circuited": short_circuited,
+            "lines": [{"id": line_id, "message": line, "reason": reason} for line_id, line, reason in dropped]
+        }
+    if "timings" in chain:
+        output["timings"] = chain["timings"]
+
+    if chain["error"]:
+        output["error"] = chain["error"]
+    elif not short_circuited and not chain["prompt1"].strip() and not chain["prompt2"].strip() and not chain["prompt3"].strip():
         output["error"] = "Unable to parse input"
 
-    if os.getenv('DEBUG_MODE') == 'true':
+    if semantic_hit is not None:
+        output["semantic_cache"] = {"scope": "pipeline", "similarity": semantic_hit[1]}
+    elif use_semantic and not failures and "error" not in output:
+        semantic_cache.store("pipeline", "\n".join(line for _, line in lines), dict(
+            {key: output[key] for key in ("prompt1", "prompt2", "prompt3", "categories")}, line_ids=line_ids
+        ))
+
+    if DEBUG_MODE:
         print(f"Final category outputs: {category_outputs}", file=sys.stderr)
     return output
 
-def parse_category_output(output: str, is_from_photo: bool = False) -> list:
-    """Parse category prompt output into a list of dictionaries, adding fromPhoto flag for rego."""
-    results = []
-    if not output.strip():
-        if os.getenv('DEBUG_MODE') == 'true':
-            print("No output to parse", file=sys.stderr)
-        return results
-
+def parse_category_output(output: str, category: str, is_from_photo: bool = False, failures: list = None) -> list:
+    """Parse category prompt output into typed records in one pass, reporting lines that fail validation."""
+    records = []
     for line in output.split("\n"):
-        if line.strip():
-            try:
-                # Split the line into message, list, and optional reconditioner parts
-                parts = line.split(" : ")
-                message = parts[0]
-                list_str = parts[1]
-                reconditioner_info = parts[2].strip('[]').split(', ') if len(parts) > 2 else None
-                if os.getenv('DEBUG_MODE') == 'true':
-                    print(f"Parsing line: {line}", file=sys.stderr)
-                list_match = re.match(r'^\[(.*)\]$', list_str.strip())
-                if list_match:
-                    # Parse the list items, handling potential empty or malformed entries
-                    raw_items = list_match.group(1).split(",")
-                    items = []
-                    for item in raw_items:
-                        item = item.strip().strip('"')
-                        if item == '""':
-                            item = ""
-                        items.append(item)
-                    # Determine the expected length based on the category
-                    expected_length = 9  # Default for Customer/Reconditioning Appointments
-                    if "Car Repairs" in message:
-                        expected_length = 7
-                    elif "To Do" in message or "Notes" in message:
-                        expected_length = 6
-                    elif "Ready" in message or "Drop Off" in message or "Location Update" in message or "Sold" in message:
-                        expected_length = 8
-                    
-                    # Pad or truncate the list to the expected length
-                    while len(items) < expected_length:
-                        items.append("")
-                    if len(items) > expected_length:
-                        items = items[:expected_length]
-                    
-                    # Only set fromPhoto to true if there is a rego and it came from a photo
-                    rego = items[4] if len(items) > 4 else ""
-                    from_photo_for_rego = is_from_photo and rego != ""
-                    # Create result object
-                    result_entry = {
-                        "message": message,
-                        "data": items,
-                        "fromPhoto": from_photo_for_rego
-                    }
-                    # Add reconditioner info for Car Repairs
-                    if reconditioner_info:
-                        result_entry["reconditioner"] = {
-                            "category": reconditioner_info[0],
-                            "reconditioner": reconditioner_info[1]
-                        }
-                    # Log the parsed output
-                    if os.getenv('DEBUG_MODE') == 'true':
-                        print(f"Parsed category output: {message}, rego: {rego}, fromPhoto: {from_photo_for_rego}, items: {items}, reconditioner: {reconditioner_info}", file=sys.stderr)
-                    # Append the result
-                    results.append(result_entry)
-                else:
-                    if os.getenv('DEBUG_MODE') == 'true':
-                        print(f"Invalid list format: {line}", file=sys.stderr)
-            except Exception as e:
-                if os.getenv('DEBUG_MODE') == 'true':
-                    print(f"Error parsing category output: {line} - {str(e)}", file=sys.stderr)
-                continue
-    return results
\ No newline at end of file
+        # Lines without a list are the model's commentary, not records
+        if "[" not in line:
+            continue
+        try:
+            records.append(parse_category_line(category, line, is_from_photo))
+        except RecordValidationError as e:
+            if DEBUG_MODE:
+                print(f"Invalid {category} line: {line} - {e}", file=sys.stderr)
+            if failures is not None:
+                failures.append({"category": category, "message": line.strip(), "error": str(e)})
+    return records
+
+def compare_engines(original_message: str, media_url: str = None) -> dict:
+    """Run the staged and fused engines on the same input without the cache and report the difference."""
+    report = {}
+    for engine in ("staged", "fused"):
+        result = run_pipeline(original_message, media_url, engine=engine, use_cache=False)
+        report[engine] = dict(
+            result["usage"],
+            records=sum(len(entries) for entries in result["categories"].values()),
+            error=result.get("error")
+        )
+    report["difference"] = {
+        key: round(report["fused"][key] - report["staged"][key], 3)
+        for key in ("calls", "prompt_tokens", "completion_tokens", "total_tokens", "latency")
+    }
+    return report
+
+# Worker Mode
+def handle_request(request: dict) -> dict:
+    """Dispatch a single worker request to the pipeline or photo analysis."""
+    op = request.get("op", "pipeline")
+    if op == "pipeline":
+        return run_pipeline(request.get("message", ""), request.get("media_url"), **request.get("options", {}))
+    if op == "photo":
+        return {"photo_analysis": analyze_photo_source(request.get("path") or request.get("url"))}
+    if op == "photos":
+        return {"photo_analyses": analyze_photos(request.get("paths", []), request.get("max_concurrency"))}
+    if op == "compare":
+        return compare_engines(request.get("message", ""), request.get("media_url"))
+    if op == "ping":
+        return {"pong": True, "pid": os.getpid()}
+    if op == "stats":
+        return {
+            "response_cache": dict(response_cache.stats),
+            "photo_cache": dict(photo_cache.stats),
+            "images": dict(image_stats),
+            "grok": dict(grok_stats),
+            "reconditioner_rules": reconditioner_rules.stats.report(),
+            "vehicle_aliases": vehicle_index.stats.report(),
+            "extractors": extractor_stats.report(),
+            "chatter_filter": chatter_filter.stats.report(),
+            "semantic_cache": dict(semantic_cache.stats),
+            "rate_limiter": rate_limiter.report(),
+            "single_flight": single_flight.report(),
+            "prompts": {name: template.report() for name, template in PROMPT_TEMPLATES.items()},
+            "startup": dict(startup_timings)
+        }
+    raise ValueError(f"Unknown op: {op}")
+
+def handle_request_line(line: str) -> dict:
+    """Decode one newline-delimited JSON request and wrap the result in a response envelope."""
+    try:
+        request = json.loads(line)
+    except ValueError as e:
+        return {"id": None, "ok": False, "error": f"Invalid request: {e}"}
+    request_id = request.get("id")
+    try:
+        return {"id": request_id, "ok": True, "result": handle_request(request)}
+    except Exception as e:
+        if DEBUG_MODE:
+            print(f"Worker request {request_id} failed: {e}", file=sys.stderr)
+        return {"id": request_id, "ok": False, "error": str(e)}
+
+def serve_stdio():
+    """Serve newline-delimited JSON requests on stdin, writing one response line per request to stdout."""
+    write_lock = threading.Lock()
+
+    def respond(line):
+        response = handle_request_line(line)
+        with write_lock:
+            sys.stdout.write(json.dumps(response) + "\n")
+            sys.stdout.flush()
+
+    with ThreadPoolExecutor(max_workers=WORKER_THREADS) as executor:
+        for line in sys.stdin:
+            if line.strip():
+                executor.submit(respond, line)
+
+class WorkerRequestHandler(socketserver.StreamRequestHandler):
+    """Handle newline-delimited JSON requests on a Unix socket connection."""
+
+    def handle(self):
+        for raw_line in self.rfile:
+            line = raw_line.decode("utf-8")
+            if line.strip():
+                response = handle_request_line(line)
+                self.wfile.write((json.dumps(response) + "\n").encode("utf-8"))
+                self.wfile.flush()
+
+def serve_socket(socket_path: str):
+    """Serve worker requests on a local Unix socket, one thread per connection."""
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    with socketserver.ThreadingUnixStreamServer(socket_path, WorkerRequestHandler) as server:
+        server.daemon_threads = True
+        if DEBUG_MODE:
+            print(f"npai worker listening on {socket_path}", file=sys.stderr)
+        try:
+            server.serve_forever()
+        finally:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+
+def profile_startup() -> dict:
+    """Load every provider now and return the time each import and init step took, in seconds."""
+    errors = {}
+    for loader in (get_http_session, get_grok_client, get_gemini_model):
+        try:
+            loader()
+        except Exception as e:
+            errors[loader.__name__] = str(e)
+    return {
+        "steps": dict(startup_timings),
+        "module_seconds": startup_timings["module"],
+        "providers_seconds": round(sum(startup_timings.get(step, 0) for step in PROVIDER_STARTUP_STEPS), 4),
+        "total_seconds": round(time.perf_counter() - STARTUP_STARTED, 4),
+        "errors": errors
+    }
+
+def main(argv: list) -> int:
+    """Command line entry point: one-shot pipeline, --photo-only, --photos, --compare-engines, --profile-startup,
+    --train-chatter-filter, or a long-lived --worker."""
+    if not argv:
+        print(json.dumps({"error": "No message provided"}))
+        return 1
+    if argv[0] == "--train-chatter-filter":
+        default_log = os.path.join(os.path.dirname(os.path.abspath(__file__)), "npai.log")
+        print(json.dumps(train_chatter_model(argv[1:] or [default_log])))
+        return 0
+    if argv[0] == "--profile-startup":
+        print(json.dumps(profile_startup()))
+        return 0
+    if argv[0] == "--worker":
+        if len(argv) > 2 and argv[1] == "--socket":
+            serve_socket(argv[2])
+        else:
+            serve_stdio()
+        return 0
+    if argv[0] == "--compare-engines":
+        print(json.dumps(compare_engines(argv[1] if len(argv) > 1 else "")))
+        return 0
+    if argv[0] == "--photos":
+        print(json.dumps(analyze_photos(argv[1:])))
+        return 0
+    if argv[0] == "--photo-only":
+        photo_path = argv[1] if len(argv) > 1 else None
+        print(json.dumps({"photo_analysis": analyze_photo(photo_path)}))
+        return 0
+    print(json.dumps(run_pipeline(argv[0])))
+    return 0
+
+startup_timings["module"] = round(time.perf_counter() - STARTUP_STARTED, 4)
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -7,6 +7,7 @@ const Note = require('../models/Note');
 const { identifyUniqueCar } = require('../utils/carIdentification');
 const { updateCarHistory, determineReconditionerCategory } = require('../utils/helpers');
 const { log } = require('../logger');
+const { isUnchangedEntry, rememberSources } = require('../utils/sourceReplay');
 const fs = require('fs');
 const path = require('path');
 
@@ -45,10 +46,17 @@ const updateDatabaseFromPipeline = async (pipelineOutput) => {
     return;
   }
 
-  const { categories, photoRegos, isPlan } = pipelineOutput;
+  const { categories, photoRegos, isPlan, sources, sourceKeys } = pipelineOutput;
+  const attemptedEntries = [];
+  const failedEntries = new Set();
 
   // Process Ready
   for (const entry of categories.Ready) {
+    if (isUnchangedEntry(entry, sources, sourceKeys)) {
+      log('telegram', `Skipping Ready entry with unchanged sources: ${entry.message}`);
+      continue;
+    }
+    attemptedEntries.push(entry);
     try {
       const data = entry.data || [];
       const make = data[0] || '';
@@ -101,6 +109,7 @@ const updateDatabaseFromPipeline = async (pipelineOutput) => {
           carToUpdate = newCar;
           log('telegram', `Created new car: ${newCar.make} ${newCar.model} ${newCar.rego}`);
         } catch (e) {
+          failedEntries.add(entry);
           log('error', `Failed to create new car with rego ${rego}: ${e.message}`);
           if (e.name === 'ValidationError') {
             log('error', `Validation error details: ${JSON.stringify(e.errors)}`);
@@ -137,12 +146,14 @@ const updateDatabaseFromPipeline = async (pipelineOutput) => {
           log('telegram', `Updated car status to ${updateData.status} at ${updateData.location}`);
         }
       } catch (e) {
+        failedEntries.add(entry);
         log('error', `Error updating car: ${e.message} for rego ${rego}`);
         if (e.name === 'ValidationError') {
           log('error', `Validation error details: ${JSON.stringify(e.errors)}`);
         }
       }
     } catch (e) {
+      failedEntries.add(entry);
       log('error', `Error processing Ready entry: ${e.message} for rego ${data[4] || 'unknown'}`);
       if (e.name === 'ValidationError') {
         log('error', `Validation error details: ${JSON.stringify(e.errors)}`);
@@ -152,6 +163,11 @@ const updateDatabaseFromPipeline = async (pipelineOutput) => {
 
   // Process Drop Off
   for (const entry of categories['Drop Off']) {
+    if (isUnchangedEntry(entry, sources, sourceKeys)) {
+      log('telegram', `Skipping Drop Off entry with unchanged sources: ${entry.message}`);
+      continue;
+    }
+    attemptedEntries.push(entry);
     try {
       const data = entry.data || [];
       const make = data[0] || '';
@@ -203,6 +219,7 @@ const updateDatabaseFromPipeline = async (pipelineOutput) => {
           carToUpdate = newCar;
           log('telegram', `Created new car: ${newCar.make} ${newCar.model} ${newCar.rego}`);
         } catch (e) {
+          failedEntries.add(entry);
           log('error', `Failed to create new car with rego ${rego}: ${e.message}`);
           if (e.name === 'ValidationError') {
             log('error', `Validation error details: ${JSON.stringify(e.errors)}`);
@@ -254,6 +271,7 @@ const updateDatabaseFromPipeline = async (pipelineOutput) => {
           await taskEntry.save();
           log('telegram', `Created drop off task with car details`);
         } catch (e) {
+          failedEntries.add(entry);
           log('error', `Error creating task for Drop Off: ${e.message}`);
         }
         continue;
@@ -323,6 +341,7 @@ const updateDatabaseFromPipeline = async (pipelineOutput) => {
           await taskEntry.save();
           log('telegram', `Created drop off task`);
         } catch (e) {
+          failedEntries.add(entry);
           log('error', `Error updating car for Drop Off: ${e.message} for rego ${rego}`);
           if (e.name === 'ValidationError') {
             log('error', `Validation error details: ${JSON.stringify(e.errors)}`);
@@ -330,6 +349,7 @@ const updateDatabaseFromPipeline = async (pipelineOutput) => {
         }
       }
     } catch (e) {
+      failedEntries.add(entry);
       log('error', `Error processing Drop Off entry: ${e.message} for rego ${data[4] || 'unknown'}`);
       if (e.name === 'ValidationError') {
         log('error', `Validation error details: ${JSON.stringify(e.errors)}`);
@@ -339,6 +359,11 @@ const updateDatabaseFromPipeline = async (pipelineOutput) => {
 
   // Process Customer Appointment
   for (const entry of categories['Customer Appointment']) {
+    if (isUnchangedEntry(entry, sources, sourceKeys)) {
+      log('telegram', `Skipping Customer Appointment entry with unchanged sources: ${entry.message}`);
+      continue;
+    }
+    attemptedEntries.push(entry);
     try {
       const data = entry.data || [];
       const make = data[0] || '';
@@ -420,6 +445,7 @@ const updateDatabaseFromPipeline = async (pipelineOutput) => {
           };
           log('telegram', `Created new car: ${newCar.make} ${newCar.model} ${newCar.rego}`);
         } catch (e) {
+          failedEntries.add(entry);
           log('error', `Failed to create new car with rego ${rego}: ${e.message}`);
           if (e.name === 'ValidationError') {
             log('error', `Validation error details: ${JSON.stringify(e.errors)}`);
@@ -456,12 +482,14 @@ const updateDatabaseFromPipeline = async (pipelineOutput) => {
         await appointment.save();
         log('telegram', carDetails.id ? `Added customer appointment for ${carDetails.make} ${carDetails.model} ${carDetails.rego}` : `Added customer appointment with car details`);
       } catch (e) {
+        failedEntries.add(entry);
         log('error', carDetails.id ? `Error saving customer appointment: ${e.message} for rego ${rego}` : `Error saving customer appointment with car details: ${e.message}`);
         if (e.name === 'ValidationError') {
           log('error', `Validation error details: ${JSON.stringify(e.errors)}`);
         }
       }
     } catch (e) {
+      failedEntries.add(entry);
       log('error', `Error processing Customer Appointment entry: ${e.message} for rego ${data[4] || 'unknown'}`);
       if (e.name === 'ValidationError') {
         log('error', `Validation error details: ${JSON.stringify(e.errors)}`);
@@ -471,6 +499,11 @@ const updateDatabaseFromPipeline = async (pipelineOutput) => {
 
   // Process Reconditioning Appointment
   for (const entry of categories['Reconditioning Appointment']) {
+    if (isUnchangedEntry(entry, sources, sourceKeys)) {
+      log('telegram', `Skipping Reconditioning Appointment entry with unchanged sources: ${entry.message}`);
+      continue;
+    }
+    attemptedEntries.push(entry);
     try {
       const data = entry.data || [];
       const make = data[0] || '';
@@ -543,6 +576,7 @@ const updateDatabaseFromPipeline = async (pipelineOutput) => {
           };
           log('telegram', `Created new car: ${newCar.make} ${newCar.model} ${newCar.rego}`);
         } catch (e) {
+          failedEntries.add(entry);
           log('error', `Failed to create new car with rego ${rego}: ${e.message}`);
           if (e.name === 'ValidationError') {
             log('error', `Validation error details: ${JSON.stringify(e.errors)}`);
@@ -575,12 +609,14 @@ const updateDatabaseFromPipeline = async (pipelineOutput) => {
         await appointment.save();
         log('telegram', `Added reconditioning appointment for ${make} ${model} ${rego || ''}`);
       } catch (e) {
+        failedEntries.add(entry);
         log('error', `Error saving reconditioning appointment: ${e.message} for rego ${rego}`);
         if (e.name === 'ValidationError') {
           log('error', `Validation error details: ${JSON.stringify(e.errors)}`);
         }
       }
     } catch (e) {
+      failedEntries.add(entry);
       log('error', `Error processing Reconditioning Appointment entry: ${e.message} for rego ${data[4] || 'unknown'}`);
       if (e.name === 'ValidationError') {
         log('error', `Validation error details: ${JSON.stringify(e.errors)}`);
@@ -590,6 +626,11 @@ const updateDatabaseFromPipeline = async (pipelineOutput) => {
 
   // Process Car Repairs
   for (const entry of categories['Car Repairs']) {
+    if (isUnchangedEntry(entry, sources, sourceKeys)) {
+      log('telegram', `Skipping Car Repairs entry with unchanged sources: ${entry.message}`);
+      continue;
+    }
+    attemptedEntries.push(entry);
     try {
       const data = entry.data || [];
       const make = data[0] || '';
@@ -645,6 +686,7 @@ const updateDatabaseFromPipeline = async (pipelineOutput) => {
           carToUpdate = newCar;
           log('telegram', `Created new car: ${newCar.make} ${newCar.model} ${newCar.rego}`);
         } catch (e) {
+          failedEntries.add(entry);
           log('error', `Failed to create new car with rego ${rego}: ${e.message}`);
           if (e.name === 'ValidationError') {
             log('error', `Validation error details: ${JSON.stringify(e.errors)}`);
@@ -712,12 +754,14 @@ const updateDatabaseFromPipeline = async (pipelineOutput) => {
         await appointment.save();
         log('telegram', `Created reconditioning appointment for ${carToUpdate.make} ${carToUpdate.model} ${carToUpdate.rego} with ${reconditionerInfo.reconditioner} (Category: ${reconditionerInfo.category})`);
       } catch (e) {
+        failedEntries.add(entry);
         log('error', `Error updating car or creating reconditioning appointment for Car Repairs: ${e.message} for rego ${rego}`);
         if (e.name === 'ValidationError') {
           log('error', `Validation error details: ${JSON.stringify(e.errors)}`);
         }
       }
     } catch (e) {
+      failedEntries.add(entry);
       log('error', `Error processing Car Repairs entry: ${e.message} for rego ${data[4] || 'unknown'}`);
       if (e.name === 'ValidationError') {
         log('error', `Validation error details: ${JSON.stringify(e.errors)}`);
@@ -727,6 +771,11 @@ const updateDatabaseFromPipeline = async (pipelineOutput) => {
 
   // Process Location Update
   for (const entry of categories['Location Update']) {
+    if (isUnchangedEntry(entry, sources, sourceKeys)) {
+      log('telegram', `Skipping Location Update entry with unchanged sources: ${entry.message}`);
+      continue;
+    }
+    attemptedEntries.push(entry);
     try {
       const data = entry.data || [];
       const make = data[0] || '';
@@ -778,6 +827,7 @@ const updateDatabaseFromPipeline = async (pipelineOutput) => {
           carToUpdate = newCar;
           log('telegram', `Created new car: ${newCar.make} ${newCar.model} ${newCar.rego}`);
         } catch (e) {
+          failedEntries.add(entry);
           log('error', `Failed to create new car with rego ${rego}: ${e.message}`);
           if (e.name === 'ValidationError') {
             log('error', `Validation error details: ${JSON.stringify(e.errors)}`);
@@ -827,6 +877,7 @@ const updateDatabaseFromPipeline = async (pipelineOutput) => {
           await noteEntry.save();
           log('telegram', `Created location update note with car details`);
         } catch (e) {
+          failedEntries.add(entry);
           log('error', `Error creating note for Location Update: ${e.message}`);
         }
         continue;
@@ -893,6 +944,7 @@ const updateDatabaseFromPipeline = async (pipelineOutput) => {
           await noteEntry.save();
           log('telegram', `Created location update note for rego ${rego}`);
         } catch (e) {
+          failedEntries.add(entry);
           log('error', `Error updating car for Location Update: ${e.message} for rego ${rego}`);
           if (e.name === 'ValidationError') {
             log('error', `Validation error details: ${JSON.stringify(e.errors)}`);
@@ -900,6 +952,7 @@ const updateDatabaseFromPipeline = async (pipelineOutput) => {
         }
       }
     } catch (e) {
+      failedEntries.add(entry);
       log('error', `Error processing Location Update entry: ${e.message} for rego ${data[4] || 'unknown'}`);
       if (e.name === 'ValidationError') {
         log('error', `Validation error details: ${JSON.stringify(e.errors)}`);
@@ -909,6 +962,11 @@ const updateDatabaseFromPipeline = async (pipelineOutput) => {
 
   // Process To Do
   for (const entry of categories['To Do']) {
+    if (isUnchangedEntry(entry, sources, sourceKeys)) {
+      log('telegram', `Skipping To Do entry with unchanged sources: ${entry.message}`);
+      continue;
+    }
+    attemptedEntries.push(entry);
     try {
       const data = entry.data || [];
       const make = data[0] || '';
@@ -958,6 +1016,7 @@ const updateDatabaseFromPipeline = async (pipelineOutput) => {
             carToUpdate = newCar;
             log('telegram', `Created new car: ${newCar.make} ${newCar.model} ${newCar.rego}`);
           } catch (e) {
+            failedEntries.add(entry);
             log('error', `Failed to create new car with rego ${rego}: ${e.message}`);
             if (e.name === 'ValidationError') {
               log('error', `Validation error details: ${JSON.stringify(e.errors)}`);
@@ -985,6 +1044,7 @@ const updateDatabaseFromPipeline = async (pipelineOutput) => {
             await taskEntry.save();
             log('telegram', `Created to do task with car details`);
           } catch (e) {
+            failedEntries.add(entry);
             log('error', `Error creating to do task with car details: ${e.message}`);
           }
           continue;
@@ -1016,6 +1076,7 @@ const updateDatabaseFromPipeline = async (pipelineOutput) => {
           await taskEntry.save();
           log('telegram', `Created to do task for ${carToUpdate.make} ${carToUpdate.model} ${carToUpdate.rego}`);
         } catch (e) {
+          failedEntries.add(entry);
           log('error', `Error processing To Do for car: ${e.message} for rego ${rego}`);
           if (e.name === 'ValidationError') {
             log('error', `Validation error details: ${JSON.stringify(e.errors)}`);
@@ -1031,10 +1092,12 @@ const updateDatabaseFromPipeline = async (pipelineOutput) => {
           await taskEntry.save();
           log('telegram', `Created to do task without car: ${cleanedMessage}`);
         } catch (e) {
+          failedEntries.add(entry);
           log('error', `Error creating to do task without car: ${e.message}`);
         }
       }
     } catch (e) {
+      failedEntries.add(entry);
       log('error', `Error processing To Do entry: ${e.message} for rego ${data[4] || 'unknown'}`);
       if (e.name === 'ValidationError') {
         log('error', `Validation error details: ${JSON.stringify(e.errors)}`);
@@ -1044,6 +1107,11 @@ const updateDatabaseFromPipeline = async (pipelineOutput) => {
 
   // Process Notes
   for (const entry of categories.Notes) {
+    if (isUnchangedEntry(entry, sources, sourceKeys)) {
+      log('telegram', `Skipping Notes entry with unchanged sources: ${entry.message}`);
+      continue;
+    }
+    attemptedEntries.push(entry);
     try {
       const data = entry.data || [];
       const make = data[0] || '';
@@ -1093,6 +1161,7 @@ const updateDatabaseFromPipeline = async (pipelineOutput) => {
             carToUpdate = newCar;
             log('telegram', `Created new car: ${newCar.make} ${newCar.model} ${newCar.rego}`);
           } catch (e) {
+            failedEntries.add(entry);
             log('error', `Failed to create new car with rego ${rego}: ${e.message}`);
             if (e.name === 'ValidationError') {
               log('error', `Validation error details: ${JSON.stringify(e.errors)}`);
@@ -1118,6 +1187,7 @@ const updateDatabaseFromPipeline = async (pipelineOutput) => {
             await noteEntry.save();
             log('telegram', `Created note with car details`);
           } catch (e) {
+            failedEntries.add(entry);
             log('error', `Error creating note with car details: ${e.message}`);
           }
           continue;
@@ -1141,6 +1211,7 @@ const updateDatabaseFromPipeline = async (pipelineOutput) => {
           await noteEntry.save();
           log('telegram', `Created note for ${carToUpdate.make} ${carToUpdate.model} ${carToUpdate.rego}`);
         } catch (e) {
+          failedEntries.add(entry);
           log('error', `Error creating note for car: ${e.message} for rego ${rego}`);
           if (e.name === 'ValidationError') {
             log('error', `Validation error details: ${JSON.stringify(e.errors)}`);
@@ -1155,10 +1226,12 @@ const updateDatabaseFromPipeline = async (pipelineOutput) => {
           await noteEntry.save();
           log('telegram', `Created note without car: ${cleanedMessage}`);
         } catch (e) {
+          failedEntries.add(entry);
           log('error', `Error creating note without car: ${e.message}`);
         }
       }
     } catch (e) {
+      failedEntries.add(entry);
       log('error', `Error processing Notes entry: ${e.message} for rego ${data[4] || 'unknown'}`);
       if (e.name === 'ValidationError') {
         log('error', `Validation error details: ${JSON.stringify(e.errors)}`);
@@ -1168,6 +1241,11 @@ const updateDatabaseFromPipeline = async (pipelineOutput) => {
 
   // Process Sold
   for (const entry of categories.Sold) {
+    if (isUnchangedEntry(entry, sources, sourceKeys)) {
+      log('telegram', `Skipping Sold entry with unchanged sources: ${entry.message}`);
+      continue;
+    }
+    attemptedEntries.push(entry);
     try {
       const data = entry.data || [];
       const make = data[0] || '';
@@ -1222,6 +1300,7 @@ const updateDatabaseFromPipeline = async (pipelineOutput) => {
           carToUpdate = newCar;
           log('telegram', `Created new sold car: ${newCar.make} ${newCar.model} ${newCar.rego}`);
         } catch (e) {
+          failedEntries.add(entry);
           log('error', `Failed to create new car with rego ${rego}: ${e.message}`);
           if (e.name === 'ValidationError') {
             log('error', `Validation error details: ${JSON.stringify(e.errors)}`);
@@ -1249,18 +1328,22 @@ const updateDatabaseFromPipeline = async (pipelineOutput) => {
         await Car.findByIdAndUpdate(carToUpdate._id, updateData, { new: true });
         log('telegram', `Marked car as sold: ${carToUpdate.make} ${carToUpdate.model} ${carToUpdate.rego}`);
       } catch (e) {
+        failedEntries.add(entry);
         log('error', `Error updating car to sold: ${e.message} for rego ${rego}`);
         if (e.name === 'ValidationError') {
           log('error', `Validation error details: ${JSON.stringify(e.errors)}`);
         }
       }
     } catch (e) {
+      failedEntries.add(entry);
       log('error', `Error processing Sold entry: ${e.message} for rego ${data[4] || 'unknown'}`);
       if (e.name === 'ValidationError') {
         log('error', `Validation error details: ${JSON.stringify(e.errors)}`);
       }
     }
   }
+
+  rememberSources(attemptedEntries.filter((entry) => !failedEntries.has(entry)), sources, sourceKeys);
 };
 
 module.exports = { updateDatabaseFromPipeline };
\ No newline at end of file
@@ -0,0 +1,88 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+# Keep caches and rate-limit state out of the working tree; set before npai is first imported
+STATE_DIR = tempfile.mkdtemp(prefix="npai-tests-")
+os.environ.setdefault("NPAI_CACHE_PATH", os.path.join(STATE_DIR, "cache.sqlite3"))
+os.environ.setdefault("NPAI_RATE_LIMIT_PATH", os.path.join(STATE_DIR, "ratelimit.json"))
+os.environ.setdefault("NPAI_METRICS_FILE", "")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bench_npai  # noqa: E402
+import npai  # noqa: E402
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(STATE_DIR, ignore_errors=True)
+
+
+class FakeGrok:
+    """Stands in for the OpenAI client Grok is called through, answering like the bench's stand-in server.
+
+    `reply(system, prompt)` may return the text for a call (or raise); returning None falls back to the
+    bench's synthesised reply. `delay(prompt)` gives each call's latency in seconds.
+    """
+
+    def __init__(self, reply=None, delay=None):
+        self.reply = reply
+        self.delay = delay
+        self.requests = []
+        self._lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=self)
+
+    def text(self, messages: list, response_format: dict = None) -> str:
+        system = next((m["content"] for m in messages if m["role"] == "system"), "")
+        prompt = next((m["content"] for m in reversed(messages) if m["role"] == "user"), "")
+        with self._lock:
+            self.requests.append({"system": system, "prompt": prompt})
+        if self.delay is not None:
+            time.sleep(self.delay(prompt))
+        text = self.reply(system, prompt) if self.reply is not None else None
+        return text if text is not None else bench_npai.synthesise_grok(system, prompt, response_format)
+
+    def create(self, messages, stream=False, response_format=None, **options):
+        text = self.text(messages, response_format)
+        usage = SimpleNamespace(
+            prompt_tokens=sum(len(m["content"]) // 4 for m in messages), completion_tokens=len(text) // 4,
+            prompt_tokens_details=SimpleNamespace(cached_tokens=0)
+        )
+        if not stream:
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=text))], usage=usage)
+        chunks = [
+            SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=line + "\n"))], usage=None)
+            for line in text.split("\n")
+        ]
+        return iter(chunks + [SimpleNamespace(choices=[], usage=usage)])
+
+    @property
+    def calls(self) -> int:
+        return len(self.requests)
+
+
+@pytest.fixture
+def state_path(tmp_path):
+    return str(tmp_path / "cache.sqlite3")
+
+
+@pytest.fixture
+def fake_grok(state_path, monkeypatch):
+    """Route npai's Grok calls to a FakeGrok, with fresh caches and no rate limiting."""
+    grok = FakeGrok()
+    monkeypatch.setattr(npai, "get_grok_client", lambda: grok)
+    monkeypatch.setattr(npai, "response_cache", npai.ResponseCache(state_path, 100, 60))
+    monkeypatch.setattr(npai, "semantic_cache", npai.SemanticCache(state_path, 100, 60, npai.SEMANTIC_THRESHOLD))
+    monkeypatch.setattr(npai, "rate_limiter", npai.RateLimiter(state_path + ".limits", {}, 1.0))
+    monkeypatch.setattr(npai, "single_flight", npai.SingleFlight())
+    return grok
+
+
+def category_messages(output: dict) -> list:
+    return [record["message"] for records in output["categories"].values() for record in records]
@@ -0,0 +1,44 @@
+const test = require('node:test');
+const assert = require('node:assert');
+const {
+  SOURCE_REPLAY_WINDOW, buildSourceKeys, isUnchangedEntry, rememberSources, clearAppliedSources,
+} = require('../utils/sourceReplay');
+
+const finalMessages = [
+  { text: '[PHOTO] Chris: White Toyota Hilux', sourceKey: '10:photo:0' },
+  { text: 'Chris: Clean:', sourceKey: '11:0' },
+  { text: 'Chris: - Triton', sourceKey: '11:1' },
+];
+const sources = { L1: { hash: 'a' }, L2: { hash: 'b' }, L3: { hash: 'c' } };
+
+test('buildSourceKeys follows npai line_index past blank separator lines', () => {
+  // Joined with blank lines, the messages sit on lines 0, 2 and 4; a blank input line shifts nothing
+  const keys = buildSourceKeys(finalMessages, { L1: 0, L2: 2, L3: 4 });
+  assert.deepStrictEqual(keys, { L1: '10:photo:0', L2: '11:0', L3: '11:1' });
+});
+
+test('buildSourceKeys ignores IDs for lines npai added itself', () => {
+  // A media_url photo line has no index in the caller's message
+  assert.deepStrictEqual(buildSourceKeys(finalMessages, { L2: 0, L3: 2 }), { L2: '10:photo:0', L3: '11:0' });
+  assert.deepStrictEqual(buildSourceKeys(finalMessages, undefined), {});
+});
+
+test('a retried batch skips entries whose sources were applied', () => {
+  clearAppliedSources();
+  const sourceKeys = buildSourceKeys(finalMessages, { L1: 0, L2: 2, L3: 4 });
+  const applied = { message: 'Clean the Triton', sources: ['L2', 'L3'] };
+  const failed = { message: 'Hilux ready', sources: ['L1'] };
+  rememberSources([applied], sources, sourceKeys, 1000);
+  assert.strictEqual(isUnchangedEntry(applied, sources, sourceKeys, 2000), true);
+  assert.strictEqual(isUnchangedEntry(failed, sources, sourceKeys, 2000), false);
+  assert.strictEqual(isUnchangedEntry(applied, sources, sourceKeys, 1000 + SOURCE_REPLAY_WINDOW), false);
+});
+
+test('edited lines and untagged entries are applied again', () => {
+  clearAppliedSources();
+  const sourceKeys = buildSourceKeys(finalMessages, { L1: 0, L2: 2, L3: 4 });
+  const entry = { message: 'Clean the Triton', sources: ['L3'] };
+  rememberSources([entry], sources, sourceKeys, 1000);
+  assert.strictEqual(isUnchangedEntry(entry, { L3: { hash: 'edited' } }, sourceKeys, 2000), false);
+  assert.strictEqual(isUnchangedEntry({ message: 'No sources' }, sources, sourceKeys, 2000), false);
+});
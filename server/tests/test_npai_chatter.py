@@ -0,0 +1,56 @@
+import npai
+
+CHATTER_RULES = {
+    "chatter_phrases": ["thanks", "lol", "cheers"],
+    "reply_phrases": ["yep", "nah", "why"],
+    "question_words": ["is", "can", "why"],
+    "keep_words": ["ready"]
+}
+
+
+def test_chatter_filter_drops_acknowledgements_and_empty_lines():
+    chatter = npai.ChatterFilter(CHATTER_RULES)
+    kept, dropped = chatter.filter_lines([("L1", "Sam: Cheers!"), ("L2", "Sam: :)"), ("L3", "Sam: Take the Hilux to Unique")])
+    assert kept == [("L3", "Sam: Take the Hilux to Unique")]
+    assert [(line_id, reason) for line_id, _, reason in dropped] == [("L1", "phrase"), ("L2", "no_text")]
+
+
+def test_chatter_filter_drops_short_replies_without_a_question():
+    chatter = npai.ChatterFilter(CHATTER_RULES)
+    assert chatter.classify("Sam: nah") == "phrase"
+    assert chatter.classify("Sam: nah", pending_question=True) is None
+
+
+def test_chatter_filter_keeps_replies_until_the_question_is_answered():
+    chatter = npai.ChatterFilter(CHATTER_RULES)
+    lines = [
+        ("L1", "Chris: Is the Hilux ready at Unique?"), ("L2", "Sam: lol"), ("L3", "Sam: yep"),
+        ("L4", "Sam: Take it to Capital after"), ("L5", "Chris: cheers")
+    ]
+    kept, dropped = chatter.filter_lines(lines)
+    assert kept == lines[:4]
+    assert [line_id for line_id, _, _ in dropped] == ["L5"]
+
+
+def test_chatter_filter_rules_handle_the_config_examples_without_a_model(tmp_path):
+    chatter = npai.ChatterFilter.load(npai.CHATTER_RULES_PATH, str(tmp_path / "missing.json"))
+    assert chatter.model is None
+    kept, dropped = chatter.filter_lines([
+        ("L1", "Christian: the AC for the gti doesn't work, its blowing hot air"),
+        ("L2", "Christian: nah thats okay"), ("L3", "Christian: legend")
+    ])
+    assert [line_id for line_id, _ in kept] == ["L1"]
+    assert [line_id for line_id, _, _ in dropped] == ["L2", "L3"]
+    kept, dropped = chatter.filter_lines([("L1", "Chris: is the Hilux ready?"), ("L2", "Sam: nice"), ("L3", "Sam: np")])
+    assert dropped == []
+
+
+def test_chatter_filter_never_drops_photo_or_unattributed_lines():
+    chatter = npai.ChatterFilter(CHATTER_RULES)
+    assert chatter.classify("[PHOTO] Sam: thanks") is None
+    assert chatter.classify("thanks") is None
+
+
+def test_chatter_filter_ignores_model_with_too_little_training():
+    model = {"lines": {"chatter": 3, "actionable": 3}, "ngrams": {"chatter": {}, "actionable": {}}}
+    assert npai.ChatterFilter(CHATTER_RULES, model).model is None
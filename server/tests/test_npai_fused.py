@@ -0,0 +1,36 @@
+import json
+
+import npai
+
+MESSAGE = "Chris: The Hilux is ready at Unique\n\nSam: the ranger has a dent in the door\n\nSam: order pizza"
+
+
+def fused_reply(records: list):
+    return lambda system, prompt: json.dumps({"records": records})
+
+
+def test_fused_engine_builds_records_from_one_call(fake_grok):
+    fake_grok.reply = fused_reply([
+        {"sender": "Chris", "summary": "The Toyota Hilux is ready at Unique", "category": "Ready", "sources": ["L1"],
+         "fields": {"make": "Toyota", "model": "Hilux", "location": "Unique", "status": "Ready"}},
+        {"sender": "Sam", "summary": "Fix the dent in the Ford Ranger door", "category": "Car Repairs", "sources": ["#L2"],
+         "fields": {"make": "Ford", "model": "Ranger", "task": "dent in the door"},
+         "reconditioner": {"category": "dents", "name": "Ermin"}},
+        {"sender": "Sam", "summary": "Order pizza", "category": "Lunch", "sources": ["L3"]}
+    ])
+    output = npai.run_pipeline(MESSAGE, use_cache=False, engine="fused")
+    assert fake_grok.calls == 1
+    [ready] = output["categories"]["Ready"]
+    assert ready["message"] == "Chris: The Toyota Hilux is ready at Unique"
+    assert ready["sources"] == ["L1"]
+    [repair] = output["categories"]["Car Repairs"]
+    assert repair["sources"] == ["L2"]
+    assert repair["reconditioner"] == {"category": "dents", "reconditioner": "Ermin"}
+    [failure] = output["failed_lines"]
+    assert failure["category"] == "Lunch"
+
+
+def test_fused_engine_reports_invalid_json(fake_grok):
+    fake_grok.reply = lambda system, prompt: "not json"
+    output = npai.run_pipeline(MESSAGE, use_cache=False, engine="fused")
+    assert "invalid JSON" in output["error"]
@@ -0,0 +1,95 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import httpx
+import openai
+import pytest
+
+import npai
+from conftest import FakeGrok
+
+
+def status_error(status: int, headers: dict = None) -> Exception:
+    error = type("APIStatusError", (Exception,), {"status_code": status})("boom")
+    error.response = SimpleNamespace(headers=headers or {})
+    return error
+
+
+@pytest.mark.parametrize("error, retryable", [
+    (openai.APIConnectionError(request=httpx.Request("POST", "https://api.x.ai")), True),
+    (httpx.ConnectTimeout("slow"), True),
+    (TimeoutError(), True),
+    (status_error(429), True),
+    (status_error(503), True),
+    (status_error(408), True),
+    (status_error(409), False),
+    (status_error(400), False),
+    (ImportError("no openai"), False),
+])
+def test_is_retryable(error, retryable):
+    assert npai.is_retryable(error) is retryable
+
+
+def test_retry_delay_honours_retry_after(monkeypatch):
+    monkeypatch.setattr(npai, "GROK_RETRY_AFTER_MAX", 30)
+    assert npai.retry_delay(status_error(429, {"retry-after": "2"}), 0) == 2
+    assert npai.retry_delay(status_error(429, {"retry-after-ms": "1500"}), 0) == 1.5
+    assert npai.retry_delay(status_error(429, {"retry-after": "600"}), 0) == 30
+    assert 0 <= npai.retry_delay(status_error(503), 3) <= npai.GROK_BACKOFF_BASE * 8
+
+
+def test_call_grok_retries_then_wraps_failures(monkeypatch):
+    attempts = []
+
+    def create(**kwargs):
+        attempts.append(kwargs)
+        raise status_error(503 if len(attempts) == 1 else 400)
+
+    monkeypatch.setattr(npai, "GROK_HEDGE", False)
+    monkeypatch.setattr(npai, "rate_limiter", npai.RateLimiter("", {}, 1.0))
+    monkeypatch.setattr(npai.time, "sleep", lambda seconds: None)
+    monkeypatch.setattr(npai, "get_grok_client", lambda: SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create))))
+    with pytest.raises(npai.GrokError, match="after 2 attempt"):
+        npai.call_grok([{"role": "user", "content": "hi"}])
+    assert len(attempts) == 2
+
+
+def test_call_grok_wraps_client_import_errors(monkeypatch):
+    def missing_sdk():
+        raise ImportError("No module named 'openai'")
+
+    monkeypatch.setattr(npai, "get_grok_client", missing_sdk)
+    with pytest.raises(npai.GrokError):
+        npai.call_grok([{"role": "user", "content": "hi"}])
+
+
+def test_hedged_attempt_returns_the_faster_duplicate(fake_grok, monkeypatch):
+    started = threading.Event()
+
+    def delay(prompt):
+        # The first request stalls; the hedge fired after the p95 answers straight away
+        if not started.is_set():
+            started.set()
+            return 0.5
+        return 0
+
+    fake_grok.delay = delay
+    monkeypatch.setattr(npai, "GROK_HEDGE", True)
+    monkeypatch.setattr(npai, "grok_latency_p95", lambda: 0.05)
+    before = dict(npai.grok_stats)
+    began = time.monotonic()
+    response = npai.hedged_grok_attempt([{"role": "system", "content": ""}, {"role": "user", "content": "hi"}])
+    assert time.monotonic() - began < 0.4
+    assert response.choices[0].message.content
+    assert fake_grok.calls == 2
+    assert npai.grok_stats["hedged"] == before["hedged"] + 1
+    assert npai.grok_stats["hedge_wins"] == before["hedge_wins"] + 1
+
+
+def test_hedging_waits_for_enough_latency_samples(fake_grok, monkeypatch):
+    monkeypatch.setattr(npai, "GROK_HEDGE", True)
+    monkeypatch.setattr(npai, "grok_latencies", npai.deque(maxlen=npai.GROK_LATENCY_WINDOW))
+    assert npai.grok_latency_p95() is None
+    npai.hedged_grok_attempt([{"role": "user", "content": "hi"}])
+    assert fake_grok.calls == 1
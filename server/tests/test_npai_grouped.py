@@ -0,0 +1,26 @@
+import npai
+from conftest import category_messages
+
+
+def test_split_grouped_reply_matches_lines_to_entries():
+    entries = [{"sub_message": "Clean the ranger"}, {"sub_message": "take the hilux to unique"}, {"sub_message": "wash the falcon"}]
+    reply = "Take the Hilux to Unique : [Toyota]\nClean the Ranger : [Ford]\nsomething else : [x]"
+    assert npai.split_grouped_reply(reply, entries) == [
+        "Clean the Ranger : [Ford]",
+        "Take the Hilux to Unique : [Toyota]",
+        "something else : [x]"
+    ]
+
+
+def test_split_grouped_reply_pairs_duplicate_messages_in_order():
+    entries = [{"sub_message": "Clean the GTI"}, {"sub_message": "Clean the GTI"}]
+    reply = "Clean the GTI : [first]\nClean the GTI : [second]"
+    assert npai.split_grouped_reply(reply, entries) == ["Clean the GTI : [first]", "Clean the GTI : [second]"]
+
+
+def test_grouped_mode_sends_each_category_prompt_once(fake_grok):
+    message = "\n\n".join(f"Chris: order {colour} mats for stock" for colour in ("red", "blue", "green"))
+    output = npai.run_pipeline(message, use_cache=False, grouped=True)
+    # prompt_1, prompt_2, prompt_3 and one Notes prompt for all three lines
+    assert fake_grok.calls == 4
+    assert [m.split("order ")[1].split()[0] for m in category_messages(output)] == ["red", "blue", "green"]
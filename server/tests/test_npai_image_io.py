@@ -0,0 +1,62 @@
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import pytest
+
+import npai
+
+
+def fake_session(chunks, content_length=None):
+    """A requests-style session whose streamed GET yields the given chunks."""
+    @contextmanager
+    def get(url, timeout=None, stream=False):
+        yield SimpleNamespace(
+            headers={"Content-Length": str(content_length)} if content_length is not None else {},
+            raise_for_status=lambda: None,
+            iter_content=lambda chunk_size: iter(chunks)
+        )
+    return SimpleNamespace(get=get)
+
+
+def test_download_image_joins_streamed_chunks(monkeypatch):
+    monkeypatch.setattr(npai, "get_http_session", lambda: fake_session([b"\xff\xd8\xff", b"rest"]))
+    assert npai.download_image("https://example.com/photo.jpg") == b"\xff\xd8\xffrest"
+
+
+def test_download_image_refuses_declared_oversize(monkeypatch):
+    monkeypatch.setattr(npai, "MAX_IMAGE_BYTES", 10)
+    monkeypatch.setattr(npai, "get_http_session", lambda: fake_session([b"x"], content_length=11))
+    assert npai.download_image("https://example.com/photo.jpg") is None
+
+
+def test_download_image_stops_streaming_past_the_limit(monkeypatch):
+    served = []
+
+    def chunks():
+        for _ in range(100):
+            served.append(1)
+            yield b"x" * 4
+
+    monkeypatch.setattr(npai, "MAX_IMAGE_BYTES", 10)
+    monkeypatch.setattr(npai, "get_http_session", lambda: fake_session(chunks()))
+    assert npai.download_image("https://example.com/photo.jpg") is None
+    assert len(served) == 3
+
+
+@pytest.mark.skipif(npai.Image is None, reason="needs Pillow")
+def test_analyze_photo_reads_the_file_through_mmap(tmp_path, monkeypatch):
+    path = tmp_path / "photo.jpg"
+    npai.Image.new("RGB", (32, 24), (200, 10, 10)).save(path, "JPEG")
+    uploads = []
+
+    def generate_content(parts):
+        uploads.append(parts[1]["inline_data"])
+        return SimpleNamespace(text="Photo: Red Mazda 3", usage_metadata=None)
+
+    monkeypatch.setattr(npai, "get_gemini_model", lambda: SimpleNamespace(generate_content=generate_content))
+    monkeypatch.setattr(npai, "photo_cache", npai.PhotoHashCache(str(tmp_path / "cache.sqlite3"), 10, 60, 0))
+    monkeypatch.setattr(npai, "rate_limiter", npai.RateLimiter("", {}, 1.0))
+    assert npai.analyze_photo(str(path), use_cache=False) == "Photo: Red Mazda 3"
+    # The mmap is only turned into bytes for the upload itself
+    assert isinstance(uploads[0]["data"], bytes)
+    assert npai.analyze_photo(str(tmp_path / "missing.jpg")) == "Photo Analysis: Car (file not found)"
@@ -0,0 +1,61 @@
+import bench_npai
+import npai
+
+
+def test_split_line_tags_collects_ids_in_order():
+    assert npai.split_line_tags("Take the Hilux [L1, #L3] to Unique [L2]") == ("Take the Hilux to Unique", ["L1", "L3", "L2"])
+    assert npai.split_line_tags("No tags here") == ("No tags here", [])
+    assert npai.tag_line("Take the Hilux", ["L1", "L2"]) == "Take the Hilux [L1,L2]"
+
+
+def test_number_input_lines_skips_blank_lines_and_flags_photos():
+    lines, sources = npai.number_input_lines("[PHOTO] Chris: Photo: White Hilux\n\nChris: Take it to Unique\n")
+    assert lines == [("L1", "[PHOTO] Chris: Photo: White Hilux"), ("L2", "Chris: Take it to Unique")]
+    assert sources["L1"]["from_photo"] is True
+    assert sources["L2"]["from_photo"] is False
+    assert sources["L1"]["hash"] != sources["L2"]["hash"]
+    assert (sources["L1"]["line"], sources["L2"]["line"]) == (0, 2)
+
+
+def test_tag_message_keeps_line_breaks_and_drops_filtered_lines():
+    message = "Christian: Clean:\n- Triton\n- GTI\n\nSam: cheers\n\nSam: Hilux to Unique"
+    lines, sources = npai.number_input_lines(message)
+    kept = [pair for pair in lines if pair[1] != "Sam: cheers"]
+    assert npai.tag_message(message, kept, sources) == (
+        "Christian: Clean: [L1]\n- Triton [L2]\n- GTI [L3]\n\n\nSam: Hilux to Unique [L5]"
+    )
+
+
+def test_parse_prompt3_line_reads_category_and_sources():
+    entry = npai.parse_prompt3_line((0,), "Chris: Take the Hilux to Unique : Drop Off [L2]", {"L2": {"from_photo": True}})
+    assert entry["category"] == "Drop Off"
+    assert entry["sources"] == ["L2"]
+    assert entry["is_from_photo"] is True
+
+
+def test_guess_line_ids_recovers_an_untagged_line():
+    _, sources = npai.number_input_lines("Chris: take the hilux to Unique\nSam: the ranger needs tyres")
+    assert npai.guess_line_ids("- Sam: The Ford Ranger needs new tyres", sources) == ["L2"]
+    assert npai.guess_line_ids("- Sam: Order pizza", sources) == []
+
+
+def test_run_pipeline_attributes_records_when_prompt_3_drops_a_tag(fake_grok):
+    def reply(system, prompt):
+        if system == npai.PROMPT_3.system:
+            return "\n".join(
+                npai.split_line_tags(line)[0] if "ranger" in line.lower() else line
+                for line in bench_npai.synthesise_grok(system, prompt).split("\n")
+            )
+
+    fake_grok.reply = reply
+    output = npai.run_pipeline("Chris: take the hilux to Unique\n\nSam: the ranger needs new tyres", use_cache=False)
+    records = [record for records in output["categories"].values() for record in records]
+    assert sorted(record["sources"] for record in records) == [["L1"], ["L2"]]
+
+
+def test_run_pipeline_maps_line_ids_to_the_callers_lines(fake_grok, monkeypatch):
+    monkeypatch.setattr(npai, "download_image", lambda url: b"jpeg")
+    monkeypatch.setattr(npai, "analyze_image", lambda data: "Photo: White Toyota Hilux\nrego ABC123")
+    output = npai.run_pipeline("Chris: Clean:\n- Triton\n\nChris: take the hilux to Unique", media_url="http://x/p.jpg", use_cache=False)
+    assert output["sources"]["L1"]["text"].startswith("[PHOTO]")
+    assert output["line_index"] == {"L3": 0, "L4": 1, "L5": 3}
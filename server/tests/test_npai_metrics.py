@@ -0,0 +1,39 @@
+import json
+
+import npai
+
+MESSAGE = "Chris: order red mats for stock\n\nChris: order blue mats for stock"
+
+
+def test_run_pipeline_reports_usage_and_stage_spans(fake_grok):
+    output = npai.run_pipeline(MESSAGE, use_cache=False)
+    assert output["usage"]["calls"] == fake_grok.calls
+    assert output["usage"]["total_tokens"] > 0
+    assert output["metrics"]["stages"]["prompt_1"]["count"] == 1
+    assert output["metrics"]["stages"]["prompt_1"]["calls"] == 1
+
+
+def test_export_metrics_appends_json_lines(fake_grok, monkeypatch, tmp_path):
+    path = tmp_path / "metrics.jsonl"
+    monkeypatch.setattr(npai, "METRICS_FILE", str(path))
+    monkeypatch.setattr(npai, "METRICS_FORMAT", "jsonl")
+    npai.run_pipeline(MESSAGE, use_cache=False)
+    npai.run_pipeline(MESSAGE, use_cache=False)
+    runs = [json.loads(line) for line in path.read_text().splitlines()]
+    assert len(runs) == 2
+    assert runs[0]["usage"]["calls"] == fake_grok.calls // 2
+    assert {span["name"] for span in runs[0]["spans"]} >= {"prompt_1", "prompt_2", "prompt_3"}
+
+
+def test_export_metrics_writes_prometheus_totals(fake_grok, monkeypatch, tmp_path):
+    path = tmp_path / "npai.prom"
+    monkeypatch.setattr(npai, "METRICS_FILE", str(path))
+    monkeypatch.setattr(npai, "METRICS_FORMAT", "prometheus")
+    monkeypatch.setattr(npai, "metrics_totals", {"runs": 0, "latency": 0.0, "usage": {}, "stages": {}, "avoided_calls": {}})
+    npai.run_pipeline(MESSAGE, use_cache=False)
+    npai.run_pipeline(MESSAGE, use_cache=False)
+    samples = dict(line.rsplit(" ", 1) for line in path.read_text().splitlines() if not line.startswith("#"))
+    assert samples["npai_runs_total"] == "2"
+    assert float(samples["npai_calls_total"]) == fake_grok.calls
+    assert samples['npai_stage_count_total{stage="prompt_1"}'] == "2"
+    assert not (tmp_path / "npai.prom.tmp").exists()
@@ -0,0 +1,61 @@
+import io
+from types import SimpleNamespace
+
+import pytest
+
+import npai
+
+
+def test_photo_hash_cache_matches_exactly_by_default(state_path):
+    cache = npai.PhotoHashCache(state_path, 10, 60, 0)
+    cache.store(0b1011, "Photo: White Toyota Hilux rego ABC123")
+    assert cache.lookup(0b1011) == "Photo: White Toyota Hilux rego ABC123"
+    assert cache.lookup(0b1010) is None
+
+
+def test_photo_hash_cache_near_match_within_threshold(state_path):
+    cache = npai.PhotoHashCache(state_path, 10, 60, 2)
+    cache.store(0b1011, "Photo: White Toyota Hilux")
+    assert cache.lookup(0b1000) == "Photo: White Toyota Hilux"
+    assert cache.lookup(0b0100) is None
+    assert cache.stats["near_hits"] == 1
+
+
+@pytest.fixture
+def fake_gemini(state_path, monkeypatch):
+    calls = []
+
+    def generate_content(parts):
+        calls.append(parts)
+        return SimpleNamespace(text="Photo: White Toyota Hilux rego ABC123", usage_metadata=None)
+
+    monkeypatch.setattr(npai, "get_gemini_model", lambda: SimpleNamespace(generate_content=generate_content))
+    monkeypatch.setattr(npai, "photo_cache", npai.PhotoHashCache(state_path, 10, 60, 0))
+    monkeypatch.setattr(npai, "rate_limiter", npai.RateLimiter(state_path + ".limits", {}, 1.0))
+    return calls
+
+
+def jpeg(colour) -> bytes:
+    buffer = io.BytesIO()
+    npai.Image.new("RGB", (64, 48), colour).save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+@pytest.mark.skipif(npai.Image is None, reason="needs Pillow")
+def test_analyze_image_reuses_cached_description(fake_gemini):
+    photo = jpeg((240, 240, 240))
+    assert npai.analyze_image(photo) == "Photo: White Toyota Hilux rego ABC123"
+    assert npai.analyze_image(photo) == "Photo: White Toyota Hilux rego ABC123"
+    assert len(fake_gemini) == 1
+
+
+@pytest.mark.skipif(npai.Image is None, reason="needs Pillow")
+def test_analyze_image_honours_run_cache_bypass(fake_gemini):
+    photo = jpeg((240, 240, 240))
+    npai.analyze_image(photo)
+    token = npai.cache_bypass_var.set(True)
+    try:
+        npai.analyze_image(photo)
+    finally:
+        npai.cache_bypass_var.reset(token)
+    assert len(fake_gemini) == 2
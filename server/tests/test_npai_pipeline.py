@@ -0,0 +1,38 @@
+import bench_npai
+import npai
+from conftest import category_messages
+
+COLOURS = ["red", "blue", "green", "black", "white", "grey"]
+MESSAGE = "\n\n".join(f"Chris: order {colour} mats for stock" for colour in COLOURS)
+
+
+def test_run_pipeline_keeps_input_order_when_later_lines_finish_first(fake_grok):
+    # Category prompts for earlier lines are the slowest, so they complete in reverse order
+    def delay(prompt):
+        lines = bench_npai.prompt_input_lines(prompt)
+        if len(lines) != 1:
+            return 0
+        return next(0.02 * (len(COLOURS) - i) for i, colour in enumerate(COLOURS) if f"order {colour} mats" in lines[0])
+
+    fake_grok.delay = delay
+    output = npai.run_pipeline(MESSAGE, use_cache=False, max_concurrency=8)
+    assert output.get("error") is None
+    assert [message.split("order ")[1].split()[0] for message in category_messages(output)] == COLOURS
+
+
+def test_run_pipeline_runs_one_category_prompt_per_line(fake_grok):
+    npai.run_pipeline(MESSAGE, use_cache=False, max_concurrency=8)
+    # prompt_1, prompt_2 and prompt_3 once each, then one category prompt per line
+    assert fake_grok.calls == 3 + len(COLOURS)
+
+
+def test_run_pipeline_reports_failed_category_lines(fake_grok):
+    def reply(system, prompt):
+        if bench_npai.prompt_input_lines(prompt) == ["Chris:  order green mats for stock"]:
+            raise npai.GrokError("down")
+
+    fake_grok.reply = reply
+    output = npai.run_pipeline(MESSAGE, use_cache=False, max_concurrency=8)
+    assert len(category_messages(output)) == len(COLOURS) - 1
+    [failure] = output["failed_lines"]
+    assert "down" in failure["error"]
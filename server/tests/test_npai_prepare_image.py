@@ -0,0 +1,62 @@
+import io
+import mmap
+
+import pytest
+
+import npai
+
+pytestmark = pytest.mark.skipif(npai.Image is None, reason="needs Pillow")
+
+
+def encode(size, image_format, colour=(30, 90, 200)) -> bytes:
+    buffer = io.BytesIO()
+    options = {"quality": npai.IMAGE_QUALITY, "optimize": True} if image_format == "JPEG" else {}
+    npai.Image.new("RGB", size, colour).save(buffer, image_format, **options)
+    return buffer.getvalue()
+
+
+def test_prepare_image_downscales_large_photos(monkeypatch):
+    monkeypatch.setattr(npai, "IMAGE_MAX_SIDE", 320)
+    original = encode((1600, 1200), "PNG")
+    payload, mime_type = npai.prepare_image(original, npai.open_image(original))
+    assert mime_type == "image/jpeg"
+    assert max(npai.Image.open(io.BytesIO(payload)).size) == 320
+    assert len(payload) < len(original)
+
+
+def test_prepare_image_keeps_small_originals():
+    original = encode((16, 16), "JPEG")
+    payload, mime_type = npai.prepare_image(original, npai.open_image(original))
+    assert (payload, mime_type) == (original, "image/jpeg")
+
+
+def test_prepare_image_converts_unsupported_types_to_jpeg():
+    original = encode((16, 16), "GIF")
+    payload, mime_type = npai.prepare_image(original, npai.open_image(original))
+    assert mime_type == "image/jpeg"
+    assert payload.startswith(b"\xff\xd8\xff")
+
+
+def test_prepare_image_sends_undecodable_data_as_is():
+    payload, mime_type = npai.prepare_image(b"\x89PNG\r\n\x1a\nbroken", None)
+    assert (payload, mime_type) == (b"\x89PNG\r\n\x1a\nbroken", "image/png")
+
+
+def test_prepare_image_materialises_an_mmap_only_for_the_upload(tmp_path):
+    path = tmp_path / "photo.jpg"
+    path.write_bytes(encode((16, 16), "JPEG"))
+    with open(path, "rb") as image_file, mmap.mmap(image_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        payload, _ = npai.prepare_image(data, npai.open_image(data))
+    assert isinstance(payload, bytes)
+    assert payload == path.read_bytes()
+
+
+@pytest.mark.parametrize("header, mime_type", [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF89a", "image/gif"),
+    (b"RIFF\x00\x00\x00\x00WEBPVP8 ", "image/webp"),
+    (b"\x00\x00\x00\x18ftypheic", "image/heic"),
+    (b"unknown", "image/jpeg"),
+])
+def test_detect_mime_type(header, mime_type):
+    assert npai.detect_mime_type(header) == mime_type
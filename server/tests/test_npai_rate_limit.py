@@ -0,0 +1,77 @@
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import npai
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def limiter(tmp_path):
+    # 6000 tokens a minute refills at 100 tokens a second
+    return npai.RateLimiter(str(tmp_path / "limits.json"), {"grok": (600, 6000)}, 1.0)
+
+
+def bucket_tokens(limiter) -> float:
+    with limiter._state() as state:
+        return limiter._bucket(state, "grok", time.time())["tokens"]
+
+
+def test_rate_limiter_serves_waiters_in_arrival_order(limiter):
+    limiter.acquire("grok", 6000)
+    order = []
+
+    def take(name, tokens):
+        limiter.acquire("grok", tokens)
+        order.append(name)
+
+    # The large request queues first; the small one behind it must not overtake it
+    large = threading.Thread(target=take, args=("large", 50))
+    small = threading.Thread(target=take, args=("small", 5))
+    large.start()
+    time.sleep(0.1)
+    small.start()
+    large.join(5)
+    small.join(5)
+    assert order == ["large", "small"]
+    assert limiter.stats["waits"] == 2
+
+
+def test_rate_limiter_settle_corrects_the_reservation(limiter):
+    reserved = limiter.acquire("grok", 1000)
+    limiter.settle("grok", reserved, 200)
+    assert bucket_tokens(limiter) == pytest.approx(5800, abs=5)
+    reserved = limiter.acquire("grok", 1000)
+    limiter.settle("grok", reserved, 0)
+    assert bucket_tokens(limiter) == pytest.approx(5800, abs=5)
+
+
+def test_rate_limiter_ignores_unlimited_providers(limiter):
+    assert limiter.acquire("gemini", 10 ** 9) == 0
+
+
+def test_failed_grok_attempt_gives_back_its_reservation(limiter, monkeypatch):
+    def fail(**kwargs):
+        raise ConnectionError("reset by peer")
+
+    monkeypatch.setattr(npai, "rate_limiter", limiter)
+    monkeypatch.setattr(npai, "get_grok_client", lambda: SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=fail))))
+    with pytest.raises(ConnectionError):
+        npai.grok_attempt([{"role": "user", "content": "x" * 4000}])
+    assert bucket_tokens(limiter) == pytest.approx(6000, abs=5)
+
+
+def test_rate_limiter_is_off_and_unlimited_by_default(monkeypatch):
+    for name in ("NPAI_RATE_LIMIT", "NPAI_GROK_RPM", "NPAI_GROK_TPM", "NPAI_RATE_LIMIT_PATH"):
+        monkeypatch.delenv(name, raising=False)
+    script = "import npai; print(npai.RATE_LIMIT, npai.RATE_LIMITS['grok'], npai.rate_limiter.limits, npai.RATE_LIMIT_PATH)"
+    result = subprocess.run([sys.executable, "-c", script], cwd=SERVER_DIR, capture_output=True, text=True, timeout=60)
+    assert result.stdout.split(" ", 4)[:4] == ["False", "(0,", "0)", "{}"]
+    assert result.stdout.strip().endswith(os.path.join(tempfile.gettempdir(), "npai_ratelimit.json"))
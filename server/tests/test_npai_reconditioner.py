@@ -0,0 +1,28 @@
+import npai
+
+RULES = {
+    "fallback": {"category": "other", "reconditioner": "Technician"},
+    "categories": [
+        {"category": "wheels", "reconditioner": "Keith", "keywords": ["wheel", "rims"]},
+        {"category": "Mechanic", "reconditioner": "Technician", "keywords": ["wheel bearing", "engine"]},
+        {"category": "dents", "reconditioner": "Ermin", "keywords": ["dent"]}
+    ]
+}
+
+
+def test_reconditioner_rules_prefer_longest_keyword():
+    rules = npai.ReconditionerRules(RULES)
+    assert rules.classify("replace the wheel bearing") == ["Mechanic", "Technician"]
+    assert rules.classify("Scuffed wheel") == ["wheels", "Keith"]
+
+
+def test_reconditioner_rules_leave_ambiguous_or_unknown_tasks_to_grok():
+    rules = npai.ReconditionerRules(RULES)
+    assert rules.classify("dent and rims") is None
+    assert rules.classify("new floor mats") is None
+    assert npai.ReconditionerRules({}).classify("dent") is None
+
+
+def test_reconditioner_rules_load_missing_file(tmp_path):
+    rules = npai.ReconditionerRules.load(str(tmp_path / "missing.json"))
+    assert rules.classify("dent") is None
@@ -0,0 +1,53 @@
+import pytest
+
+import npai
+
+
+def test_record_types_hold_category_fields_as_slots():
+    for category, fields in npai.CATEGORY_FIELDS.items():
+        record_type = npai.RECORD_TYPES[category]
+        assert record_type.category == category
+        assert record_type.fields == tuple(fields)
+        assert issubclass(record_type, npai.CategoryRecord)
+
+
+def test_parse_category_line_with_reconditioner():
+    record = npai.parse_category_line(
+        "Car Repairs",
+        "Fix the bumper : [Toyota, Hilux, SR5, white, ABC123, bumper, scuffed] : [Body, Technician]"
+    )
+    assert record.message == "Fix the bumper"
+    assert record.data == ["Toyota", "Hilux", "SR5", "white", "ABC123", "bumper", "scuffed"]
+    assert record.as_dict()["reconditioner"] == {"category": "Body", "reconditioner": "Technician"}
+
+
+def test_parse_category_line_pads_missing_values():
+    record = npai.parse_category_line("Sold", "Sold the Ranger : [Ford, Ranger]")
+    assert record.data == ["Ford", "Ranger", "", "", "", ""]
+
+
+def test_parse_category_line_folds_extra_values_into_free_text():
+    record = npai.parse_category_line("Notes", "Keys upstairs : [Ford, Ranger, XLT, , , keys upstairs, top drawer]")
+    assert record.notes == "keys upstairs, top drawer"
+
+
+def test_parse_category_line_accepts_json_array_body():
+    record = npai.parse_category_line("To Do", 'Order mats : ["Toyota", "Corolla", "", "", "", "order mats, front"]')
+    assert record.task == "order mats, front"
+
+
+def test_parse_category_line_only_sets_from_photo_with_rego():
+    with_rego = npai.parse_category_line("Ready", "Ready : [Toyota, Hilux, , , ABC123, Unique, Ready, ]", True)
+    without_rego = npai.parse_category_line("Ready", "Ready : [Toyota, Hilux, , , , Unique, Ready, ]", True)
+    assert with_rego.from_photo is True
+    assert without_rego.from_photo is False
+
+
+@pytest.mark.parametrize("category, line", [
+    ("Ready", "no list here"),
+    ("Sold", "Sold : [a, b, c, d, e, f, g]"),
+    ("Car Repairs", "Fix : [a, b, c, d, e, f, g] : [Body]"),
+])
+def test_parse_category_line_rejects_malformed_lines(category, line):
+    with pytest.raises(npai.RecordValidationError):
+        npai.parse_category_line(category, line)
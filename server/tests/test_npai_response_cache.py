@@ -0,0 +1,50 @@
+import npai
+
+
+def test_response_cache_hit_and_miss(state_path):
+    cache = npai.ResponseCache(state_path, 10, 60)
+    key = cache.make_key("model", "prompt")
+    assert cache.get(key) is None
+    cache.set(key, "reply")
+    assert cache.get(key) == "reply"
+    assert (cache.stats["hits"], cache.stats["misses"]) == (1, 1)
+
+
+def test_response_cache_expires_after_ttl(state_path, monkeypatch):
+    cache = npai.ResponseCache(state_path, 10, 60)
+    cache.set("key", "reply")
+    now = npai.time.time()
+    monkeypatch.setattr(npai.time, "time", lambda: now + 61)
+    assert cache.get("key") is None
+    assert cache.stats["expired"] == 1
+
+
+def test_response_cache_evicts_least_recently_used(state_path, monkeypatch):
+    cache = npai.ResponseCache(state_path, 2, 0)
+    clock = iter(range(1000, 2000))
+    monkeypatch.setattr(npai.time, "time", lambda: next(clock))
+    cache.set("a", "1")
+    cache.set("b", "2")
+    assert cache.get("a") == "1"
+    cache.set("c", "3")
+    assert cache.get("b") is None
+    assert cache.get("a") == "1"
+    assert cache.stats["evictions"] == 1
+
+
+def test_analyze_with_grok_serves_repeats_from_cache(fake_grok):
+    fake_grok.reply = lambda system, prompt: "Chris: Take the Toyota Hilux to Unique"
+    assert npai.analyze_with_grok("take the hilux to unique") == "Chris: Take the Toyota Hilux to Unique"
+    assert npai.analyze_with_grok("take the hilux to unique") == "Chris: Take the Toyota Hilux to Unique"
+    assert fake_grok.calls == 1
+
+
+def test_analyze_with_grok_honours_cache_bypass(fake_grok):
+    npai.analyze_with_grok("take the hilux to unique")
+    token = npai.cache_bypass_var.set(True)
+    try:
+        npai.analyze_with_grok("take the hilux to unique")
+    finally:
+        npai.cache_bypass_var.reset(token)
+    npai.analyze_with_grok("take the hilux to unique", use_cache=False)
+    assert fake_grok.calls == 3
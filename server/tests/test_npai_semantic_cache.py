@@ -0,0 +1,46 @@
+import pytest
+
+import npai
+
+
+def test_semantic_cache_reuses_reworded_repeat(state_path):
+    cache = npai.SemanticCache(state_path, 10, 60, 0.3)
+    cache.store("pipeline", "Christian: take the ranger to als", {"records": 1})
+    value, similarity = cache.lookup("pipeline", "Christian: Ranger to Al's pls")
+    assert value == {"records": 1}
+    assert 0.3 <= similarity < 1
+
+
+def test_semantic_cache_needs_same_entities_and_kind(state_path):
+    cache = npai.SemanticCache(state_path, 10, 60, 0.3)
+    cache.store("pipeline", "Christian: take the ranger to als", {"records": 1})
+    assert cache.lookup("pipeline", "Christian: take the hilux to als") is None
+    assert cache.lookup("line", "Christian: take the ranger to als") is None
+
+
+def test_semantic_cache_rebuilds_index_from_disk(state_path):
+    npai.SemanticCache(state_path, 10, 60, 0.7).store("pipeline", "Christian: take the ranger to als", "done")
+    fresh = npai.SemanticCache(state_path, 10, 60, 0.7)
+    assert fresh.lookup("pipeline", "Christian: take the ranger to als") == ("done", 1.0)
+
+
+def test_semantic_cache_same_tokens_misses_a_changed_word(state_path):
+    cache = npai.SemanticCache(state_path, 10, 60, 0.3)
+    cache.store("pipeline", "Chris: the Ranger needs new tyres", "tyres")
+    assert cache.lookup("pipeline", "Chris: the Ranger needs new brakes") is not None
+    assert cache.lookup("pipeline", "Chris: the Ranger needs new brakes", same_tokens=True) is None
+    assert cache.lookup("pipeline", "Chris: Ranger needs new tyres pls", same_tokens=True)[0] == "tyres"
+
+
+@pytest.mark.parametrize("repeat, reused", [
+    ("Chris: the ranger needs new tyres pls", True),
+    ("Chris: the Ranger needs new brakes", False),
+    ("Chris: the Ranger is booked in for new tyres", False),
+])
+def test_run_pipeline_only_replays_batches_with_the_same_words(fake_grok, monkeypatch, repeat, reused):
+    monkeypatch.setattr(npai, "SEMANTIC_CACHE", True)
+    npai.run_pipeline("Chris: the Ranger needs new tyres")
+    calls = fake_grok.calls
+    output = npai.run_pipeline(repeat)
+    assert ("semantic_cache" in output) is reused
+    assert (fake_grok.calls == calls) is reused
@@ -0,0 +1,29 @@
+import pytest
+
+import npai
+
+
+def entry(category, sub_message):
+    return {"idx": (0,), "category": category, "sub_message": sub_message, "is_from_photo": False, "sources": ["L1"]}
+
+
+def test_settle_entry_locally_builds_ready_record():
+    [(idx, category, [record])] = npai.settle_entry_locally(entry("Ready", "Chris: The Hilux is ready at Unique"))
+    assert (idx, category) == ((0,), "Ready")
+    assert record.data == ["Toyota", "Hilux", "", "", "", "Unique", "Ready", ""]
+    assert record.sources == ["L1"]
+
+
+def test_settle_entry_locally_builds_location_update_record():
+    [(_, _, [record])] = npai.settle_entry_locally(entry("Location Update", "Chris: The white Corolla is at Capital rego ABC123"))
+    assert record.data == ["Toyota", "Corolla", "", "White", "ABC123", "", "Capital", ""]
+
+
+@pytest.mark.parametrize("category, sub_message", [
+    ("Ready", "Chris: The Hilux is ready at Unique at 3pm"),
+    ("Ready", "Chris: The Hilux and Ranger are ready"),
+    ("Drop Off", "Chris: The Hilux is ready at Unique"),
+    ("Location Update", "Chris: The Hilux is going to Unique tomorrow"),
+])
+def test_settle_entry_locally_leaves_harder_lines_to_grok(category, sub_message):
+    assert npai.settle_entry_locally(entry(category, sub_message)) is None
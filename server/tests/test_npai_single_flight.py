@@ -0,0 +1,75 @@
+import threading
+import time
+
+import npai
+
+
+def run_concurrently(flight, fn, callers: int) -> list:
+    """Call flight.do from several threads once the first call is in flight, returning results or errors."""
+    results = [None] * callers
+
+    def call(i):
+        try:
+            results[i] = flight.do("grok", "same prompt", fn)
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(callers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    return results
+
+
+def gated(result=None, error=None):
+    """A call that blocks until every other caller has joined it, then returns or raises."""
+    release = threading.Event()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        release.wait(5)
+        if error is not None:
+            raise error
+        return result
+
+    return fn, release, calls
+
+
+def release_when_coalesced(flight, release, followers):
+    def watch():
+        while flight.report().get("grok", {}).get("coalesced", 0) < followers:
+            time.sleep(0.01)
+        release.set()
+    threading.Thread(target=watch, daemon=True).start()
+
+
+def test_single_flight_shares_one_call():
+    flight = npai.SingleFlight()
+    fn, release, calls = gated(result="reply")
+    release_when_coalesced(flight, release, 3)
+    assert run_concurrently(flight, fn, 4) == ["reply"] * 4
+    assert len(calls) == 1
+    assert flight.report() == {"grok": {"calls": 1, "coalesced": 3}}
+
+
+def test_single_flight_raises_failure_to_every_caller():
+    flight = npai.SingleFlight()
+    error = npai.GrokError("down")
+    fn, release, calls = gated(error=error)
+    release_when_coalesced(flight, release, 2)
+    assert run_concurrently(flight, fn, 3) == [error] * 3
+    assert len(calls) == 1
+    # The failed call is forgotten, so the next caller tries again
+    assert flight.do("grok", "same prompt", lambda: "retry") == "retry"
+
+
+def test_single_flight_disabled_calls_every_time():
+    flight = npai.SingleFlight(enabled=False)
+    calls = []
+    for _ in range(3):
+        flight.do("grok", "same prompt", lambda: calls.append(1))
+    assert len(calls) == 3
+    assert flight.report() == {}
+
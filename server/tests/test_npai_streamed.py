@@ -0,0 +1,71 @@
+import threading
+import time
+
+import npai
+from conftest import category_messages
+
+MESSAGE = "\n\n".join(f"Chris: take the hilux to {place}" for place in ("Unique", "Capital", "Als", "Imperial"))
+
+
+def test_micro_batch_flushes_by_size_age_and_close():
+    flushed = []
+    batch = npai.MicroBatch(flushed.append, 2, 0.05)
+    batch.add("a")
+    batch.add("b")
+    assert flushed == [["a", "b"]]
+    batch.add("c")
+    time.sleep(0.2)
+    assert flushed == [["a", "b"], ["c"]]
+    batch.add("d")
+    assert batch.close() is True
+    assert batch.close() is False
+    assert flushed == [["a", "b"], ["c"], ["d"]]
+
+
+def test_source_slot_follows_previous_for_untagged_lines():
+    slots = [((0,), {"L1"}), ((1,), {"L2"})]
+    assert npai.source_slot("x [L2]", slots, (0,)) == (1,)
+    assert npai.source_slot("untagged", slots, (1,)) == (1,)
+    assert npai.source_slot("x [L1]", slots, (1,)) == (0,)
+
+
+def test_streamed_chain_matches_staged_records(fake_grok, monkeypatch):
+    monkeypatch.setattr(npai, "STREAM_BATCH_SIZE", 1)
+    staged = npai.run_pipeline(MESSAGE, use_cache=False, streaming=False)
+    streamed = npai.run_pipeline(MESSAGE, use_cache=False, streaming=True)
+    assert streamed.get("error") is None
+    assert streamed["timings"]["time_to_first_record"] is not None
+    assert category_messages(streamed) == category_messages(staged)
+    assert len(category_messages(streamed)) == 4
+
+
+def test_streamed_chain_counts_local_alias_expansion_once_per_run(fake_grok, monkeypatch):
+    monkeypatch.setattr(npai, "STREAM_BATCH_SIZE", 1)
+    output = npai.run_pipeline(MESSAGE, use_cache=False, streaming=True)
+    assert not any(request["system"] == npai.PROMPT_2.system for request in fake_grok.requests)
+    assert output["usage"]["avoided_calls"]["vehicle_aliases"] == 1
+
+
+def test_streamed_chain_stops_queued_batches_when_prompt_1_fails(fake_grok, monkeypatch):
+    release = threading.Event()
+
+    def failing_prompt_1(message, stream=False):
+        yield "Chris: Take the Holden Colorado to Unique [L1]"
+        yield "Chris: Take the Holden Colorado to Capital [L2]"
+        yield "Chris: Take the Holden Colorado to Als [L3]"
+        release.wait(5)
+        raise npai.GrokError("stream dropped")
+
+    def delay(prompt):
+        # Hold the first downstream call until prompt_1 has failed
+        release.set()
+        return 0.1
+
+    fake_grok.delay = delay
+    monkeypatch.setattr(npai, "prompt_1", failing_prompt_1)
+    monkeypatch.setattr(npai, "STREAM_BATCH_SIZE", 1)
+    output = npai.run_pipeline(MESSAGE, use_cache=False, streaming=True, max_concurrency=1)
+    assert "stream dropped" in output["error"]
+    # Only the batch already in flight reached Grok; nothing went on to a category prompt
+    assert fake_grok.calls == 1
+    assert category_messages(output) == []
@@ -0,0 +1,73 @@
+import pytest
+
+import npai
+
+ALIASES = {
+    "make_aliases": {"VW": "Volkswagen"},
+    "vehicles": [
+        {"make": "Toyota", "model": "Hilux", "aliases": ["Hilux"]},
+        {"make": "Toyota", "model": "Landcruiser", "aliases": ["Landcruiser", "Cruiser"]},
+        {"make": "Volkswagen", "model": "Golf", "badge": "GTI", "aliases": ["GTI"]},
+        {"make": "Honda", "model": "Accord", "aliases": ["Accord"]},
+        {"make": "Nissan", "model": "Patrol", "aliases": ["Patrol"]},
+        {"make": "Ford", "model": "Escape", "aliases": ["Escape"]},
+        {"make": "Ford", "model": "Focus", "aliases": ["Focus"]},
+        {"make": "Ford", "model": "Transit", "aliases": ["Transit"]}
+    ]
+}
+
+
+def test_vehicle_alias_index_expands_one_vehicle():
+    index = npai.VehicleAliasIndex(ALIASES)
+    assert index.expand_line("Chris: take the hilux to Unique") == "Chris: take the Toyota Hilux to Unique"
+    assert index.expand_line("Chris: clean the vw gti") == "Chris: clean the Volkswagen Golf GTI"
+
+
+def test_vehicle_alias_index_matches_one_typo():
+    index = npai.VehicleAliasIndex(ALIASES)
+    spans, unmatched = index.scan("the white landcrusier is ready")
+    assert [canonical for _, _, canonical in spans] == ["Toyota Landcruiser"]
+    assert unmatched == ["the", "white", "is", "ready"]
+
+
+@pytest.mark.parametrize("line", [
+    "Chris: take the hilux and the gti to Unique",
+    "Chris: take both hiluxes to Unique",
+    "Chris: take the hilux qx9 to Unique",
+    "Chris: take it to Unique",
+])
+def test_vehicle_alias_index_leaves_unclear_lines_to_prompt_2(line):
+    assert npai.VehicleAliasIndex(ALIASES).expand_line(line) is None
+
+
+@pytest.mark.parametrize("line, expanded", [
+    ("Chris: The patrol is ready at Unique", "Chris: The Nissan Patrol is ready at Unique"),
+    ("Chris: take the white focus to Unique", "Chris: take the white Ford Focus to Unique"),
+    ("Chris: Transit rego 1ABC234 is at Unique", "Chris: Ford Transit rego 1ABC234 is at Unique"),
+    ("Chris: accord needs tyres", "Chris: Honda Accord needs tyres"),
+])
+def test_vehicle_alias_index_expands_bare_models_with_context(line, expanded):
+    assert npai.VehicleAliasIndex(ALIASES).expand_line(line) == expanded
+
+
+@pytest.mark.parametrize("text", [
+    "accord parking sorted",
+    "we reached an accord on parking",
+    "patrol the yard tonight",
+    "can someone patrol out back",
+    "no escape from the rain",
+    "focus on the paperwork",
+    "the parts are in transit",
+    "the landcrusier is ready",
+    "fill the petrol tank",
+])
+def test_vehicle_alias_index_leaves_everyday_words_alone(text):
+    assert npai.VehicleAliasIndex(ALIASES).scan(text)[0] == []
+
+
+def test_place_refined_lines_keeps_input_order():
+    lines = ["a [L1]", "b [L2]", "c [L3]", "d [L4]"]
+    expanded = ["A [L1]", None, "C [L3]", None]
+    slots = npai.place_refined_lines(lines, expanded, ["D [L4]", "B [L2]", "B split [L2]"])
+    assert slots == {1: ["B [L2]", "B split [L2]"], 3: ["D [L4]"]}
+
@@ -0,0 +1,67 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+import npai
+
+NPAI_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "npai.py")
+
+
+def test_handle_request_line_wraps_results_and_errors():
+    assert npai.handle_request_line('{"id": 7, "op": "ping"}') == {"id": 7, "ok": True, "result": {"pong": True, "pid": os.getpid()}}
+    assert npai.handle_request_line('{"id": 8, "op": "nope"}') == {"id": 8, "ok": False, "error": "Unknown op: nope"}
+    invalid = npai.handle_request_line("not json")
+    assert invalid["id"] is None and invalid["ok"] is False
+
+
+@pytest.fixture
+def worker_env(tmp_path):
+    return dict(
+        os.environ,
+        NPAI_CACHE_PATH=str(tmp_path / "cache.sqlite3"),
+        NPAI_RATE_LIMIT_PATH=str(tmp_path / "ratelimit.json")
+    )
+
+
+def test_worker_answers_stdio_requests_by_id(worker_env):
+    proc = subprocess.Popen(
+        [sys.executable, NPAI_PATH, "--worker"], env=worker_env, text=True,
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+    )
+    try:
+        proc.stdin.write('{"id": 1, "op": "ping"}\n\n{"id": 2, "op": "nope"}\n')
+        proc.stdin.flush()
+        responses = {response["id"]: response for response in (json.loads(proc.stdout.readline()) for _ in range(2))}
+    finally:
+        proc.stdin.close()
+        proc.wait(10)
+    assert responses[1]["ok"] is True and responses[1]["result"]["pong"] is True
+    assert responses[2] == {"id": 2, "ok": False, "error": "Unknown op: nope"}
+    # The worker exits cleanly once stdin closes
+    assert proc.returncode == 0
+
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="Unix sockets only")
+def test_worker_answers_socket_requests(worker_env, tmp_path):
+    socket_path = str(tmp_path / "npai.sock")
+    proc = subprocess.Popen([sys.executable, NPAI_PATH, "--worker", "--socket", socket_path], env=worker_env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + 10
+        while not os.path.exists(socket_path) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(socket_path)
+            stream = client.makefile("rw", encoding="utf-8")
+            stream.write('{"id": "a", "op": "ping"}\n')
+            stream.flush()
+            response = json.loads(stream.readline())
+    finally:
+        proc.terminate()
+        proc.wait(10)
+    assert response["id"] == "a" and response["result"]["pong"] is True
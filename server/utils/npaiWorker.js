@@ -0,0 +1,112 @@
+const { spawn } = require('child_process');
+const path = require('path');
+const readline = require('readline');
+const { log } = require('../logger');
+
+// One long-lived `npai.py --worker` process shared by every caller. Requests and
+// responses are newline-delimited JSON matched up by id.
+const pyScript = path.join(__dirname, '../npai.py');
+const REQUEST_TIMEOUT = 5 * 60 * 1000;
+const DEBUG_MARKERS = ['Raw input received', 'Photo analysis result', 'Prompt', 'Processing line', 'Photo messages to compare'];
+
+let worker = null;
+let nextId = 1;
+const pending = new Map();
+
+const workerLogger = (message, type = 'telegram') => {
+  log(type, `[npai worker] ${message}`);
+};
+
+const rejectPending = (err) => {
+  pending.forEach((entry) => {
+    clearTimeout(entry.timer);
+    entry.reject(err);
+  });
+  pending.clear();
+};
+
+const startWorker = () => {
+  const proc = spawn('python', [pyScript, '--worker']);
+  workerLogger(`Started npai worker (pid ${proc.pid})`);
+
+  readline.createInterface({ input: proc.stdout }).on('line', (line) => {
+    let response;
+    try {
+      response = JSON.parse(line);
+    } catch (e) {
+      workerLogger(`Unexpected worker output: ${line}`, 'error');
+      return;
+    }
+    const entry = pending.get(response.id);
+    if (!entry) {
+      return;
+    }
+    pending.delete(response.id);
+    clearTimeout(entry.timer);
+    if (response.ok) {
+      entry.resolve(response.result);
+    } else {
+      entry.reject(new Error(response.error || 'npai worker request failed'));
+    }
+  });
+
+  proc.stderr.on('data', (errData) => {
+    const errStr = errData.toString().trim();
+    if (DEBUG_MARKERS.some((marker) => errStr.includes(marker))) {
+      workerLogger(`Python debug: ${errStr}`, 'debug');
+    } else {
+      workerLogger(`Python error: ${errStr}`, 'error');
+    }
+  });
+
+  proc.on('error', (err) => {
+    workerLogger(`Failed to start npai worker: ${err.message}`, 'error');
+    if (worker === proc) {
+      worker = null;
+    }
+    rejectPending(err);
+  });
+
+  // Writing to a worker that died mid-request raises EPIPE here; without a
+  // listener it would surface as an uncaught exception in the server.
+  proc.stdin.on('error', (err) => {
+    workerLogger(`npai worker stdin error: ${err.message}`, 'error');
+    if (worker === proc) {
+      worker = null;
+    }
+    rejectPending(err);
+  });
+
+  proc.on('exit', (code) => {
+    workerLogger(`npai worker exited with code ${code}`, code === 0 ? 'telegram' : 'error');
+    if (worker === proc) {
+      worker = null;
+    }
+    rejectPending(new Error(`npai worker exited with code ${code}`));
+  });
+
+  return proc;
+};
+
+// Send one request to the worker, starting (or restarting) it on demand.
+const request = (op, payload = {}) => new Promise((resolve, reject) => {
+  if (!worker) {
+    worker = startWorker();
+  }
+  const id = nextId++;
+  const timer = setTimeout(() => {
+    pending.delete(id);
+    reject(new Error(`npai worker request ${id} (${op}) timed out`));
+  }, REQUEST_TIMEOUT);
+  pending.set(id, { resolve, reject, timer });
+  worker.stdin.write(`${JSON.stringify({ ...payload, id, op })}\n`);
+});
+
+const stopWorker = () => {
+  if (worker) {
+    worker.stdin.end();
+    worker = null;
+  }
+};
+
+module.exports = { request, stopWorker };
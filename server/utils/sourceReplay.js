@@ -0,0 +1,64 @@
+// Source lines applied recently, keyed by the Telegram message and line they came from plus their
+// content hash. npai tags every record with the IDs of the input lines it came from, so when a batch
+// is retried within the window records whose sources were already applied are skipped, while the
+// same text sent again as a new message (or an edited message) is applied as usual.
+const SOURCE_REPLAY_WINDOW = 10 * 60 * 1000;
+const appliedSources = new Map();
+
+// Map npai's line IDs to the Telegram message lines they came from. npai reports where each ID's line
+// sits in the joined message (line_index), so blank separator lines and lines it adds itself (a
+// media_url photo) don't shift the mapping.
+const buildSourceKeys = (finalMessages, lineIndex) => {
+  const lineKeys = [];
+  finalMessages.forEach((msg, index) => {
+    if (index > 0) {
+      lineKeys.push(null);
+    }
+    msg.text.split('\n').forEach(() => lineKeys.push(msg.sourceKey));
+  });
+  return Object.fromEntries(
+    Object.entries(lineIndex || {})
+      .filter(([, index]) => lineKeys[index])
+      .map(([id, index]) => [id, lineKeys[index]])
+  );
+};
+
+const sourceReplayKey = (id, sources, sourceKeys) => {
+  if (!sources || !sourceKeys || !sources[id] || !sourceKeys[id]) {
+    return null;
+  }
+  return `${sourceKeys[id]}:${sources[id].hash}`;
+};
+
+const isUnchangedEntry = (entry, sources, sourceKeys, now = Date.now()) => {
+  const ids = entry.sources || [];
+  if (ids.length === 0) {
+    return false;
+  }
+  return ids.every((id) => {
+    const key = sourceReplayKey(id, sources, sourceKeys);
+    const appliedAt = key && appliedSources.get(key);
+    return appliedAt && now - appliedAt < SOURCE_REPLAY_WINDOW;
+  });
+};
+
+// Only entries whose updates went through are remembered, so a retry re-applies anything that failed
+const rememberSources = (entries, sources, sourceKeys, now = Date.now()) => {
+  appliedSources.forEach((appliedAt, key) => {
+    if (now - appliedAt >= SOURCE_REPLAY_WINDOW) {
+      appliedSources.delete(key);
+    }
+  });
+  entries.forEach((entry) => {
+    (entry.sources || []).forEach((id) => {
+      const key = sourceReplayKey(id, sources, sourceKeys);
+      if (key) {
+        appliedSources.set(key, now);
+      }
+    });
+  });
+};
+
+const clearAppliedSources = () => appliedSources.clear();
+
+module.exports = { SOURCE_REPLAY_WINDOW, buildSourceKeys, isUnchangedEntry, rememberSources, clearAppliedSources };
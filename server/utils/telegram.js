@@ -1,9 +1,10 @@
 const axios = require('axios');
 const fs = require('fs');
 const path = require('path');
-const { spawn } = require('child_process');
 const { log } = require('../logger');
 const { updateDatabaseFromPipeline } = require('../services/databaseUpdate');
+const npaiWorker = require('./npaiWorker');
+const { buildSourceKeys } = require('./sourceReplay');
 
 let messageBatch = [];
 let mediaGroups = new Map();
@@ -61,42 +62,30 @@ const extractRegoFromPhotoAnalysis = (photoAnalysis) => {
   return regoMatch ? regoMatch[1].toUpperCase().replace(/[^A-Z0-9]/g, '') : null; // Normalize to uppercase, alphanumeric only
 };
 
-const analyzePhoto = async (photoPath) => {
+// Analyse every photo of a batch in one worker request; returns a Map of path -> description
+const analyzePhotos = async (photoPaths) => {
+  const descriptions = new Map();
+  if (photoPaths.length === 0) {
+    return descriptions;
+  }
   try {
-    const pyScript = path.join(__dirname, '../npai.py');
-    const args = [pyScript, '--photo-only', photoPath];
-    const pythonProcess = spawn('python', args);
-
-    let output = '';
-    await new Promise((resolve) => {
-      pythonProcess.stdout.on('data', (data) => {
-        output += data.toString();
-      });
-      pythonProcess.stderr.on('data', (errData) => {
-        const errStr = errData.toString().trim();
-        if (errStr.includes('Raw input received') || errStr.includes('Photo analysis result')) {
-          telegramLogger(`Python debug: ${errStr}`, 'debug');
-        } else {
-          telegramLogger(`Python error: ${errStr}`, 'error');
-        }
-      });
-      pythonProcess.on('close', () => resolve());
+    const result = await npaiWorker.request('photos', { paths: photoPaths });
+    photoPaths.forEach((photoPath, index) => {
+      const photoAnalysis = result.photo_analyses[index] || 'Photo Analysis: Car';
+      telegramLogger(`Photo analysis: ${photoAnalysis}`, 'telegram');
+      descriptions.set(photoPath, photoAnalysis);
     });
-
-    const result = JSON.parse(output);
-    const photoAnalysis = result.photo_analysis || 'Photo Analysis: Car';
-    telegramLogger(`Photo analysis: ${photoAnalysis}`, 'telegram');
-    return photoAnalysis;
   } catch (e) {
     telegramLogger(`Error parsing photo analysis output: ${e.message}`, 'error');
-    return 'Photo Analysis: Car';
   }
+  return descriptions;
 };
 
 const processBatch = async (batch, chatId, isPlan = false) => {
   const finalMessages = [];
   let lastSender = 'Unknown';
   const photoRegos = [];
+  const photoDescriptions = await analyzePhotos(batch.filter(item => item.type === 'photo').map(item => item.path));
 
   for (let i = 0; i < batch.length; i++) {
     const item = batch[i];
@@ -109,7 +98,7 @@ const processBatch = async (batch, chatId, isPlan = false) => {
     try {
       if (item.type === 'photo') {
         category = 'Photo';
-        const description = await analyzePhoto(item.path);
+        const description = photoDescriptions.get(item.path) || 'Photo Analysis: Car';
         const photoRego = extractRegoFromPhotoAnalysis(description);
         if (photoRego) {
           photoRegos.push(photoRego);
@@ -117,9 +106,10 @@ const processBatch = async (batch, chatId, isPlan = false) => {
         }
         const photoLines = description.split('\n').filter(line => line.trim());
         list = photoLines.length > 0 ? photoLines.join(', ') : 'No description';
-        photoLines.forEach(line => {
+        photoLines.forEach((line, lineIndex) => {
           const messageText = `[PHOTO] ${sender}: ${line}`;
-          finalMessages.push({ text: messageText, isFromPhoto: true, category, list });
+          const sourceKey = `${item.messageId}:photo:${lineIndex}`;
+          finalMessages.push({ text: messageText, isFromPhoto: true, category, list, sourceKey });
         });
         processedPhotoPaths.add(item.path);
         if (i + 1 < batch.length && batch[i + 1].type === 'text' && batch[i + 1].isCaption) {
@@ -127,9 +117,10 @@ const processBatch = async (batch, chatId, isPlan = false) => {
           const caption = batch[i + 1].content;
           const captionLines = caption.split('\n').filter(line => line.trim());
           list = captionLines.length > 0 ? captionLines.join(', ') : 'No caption';
-          captionLines.forEach(line => {
+          captionLines.forEach((line, lineIndex) => {
             const messageText = `${sender}: ${line}`;
-            finalMessages.push({ text: messageText, isFromPhoto: false, category, list });
+            const sourceKey = `${batch[i + 1].messageId}:${lineIndex}`;
+            finalMessages.push({ text: messageText, isFromPhoto: false, category, list, sourceKey });
           });
           i++;
         }
@@ -139,9 +130,10 @@ const processBatch = async (batch, chatId, isPlan = false) => {
         }
         const lines = item.content.split('\n').filter(line => line.trim());
         list = lines.length > 0 ? lines.join(', ') : 'No text';
-        lines.forEach(line => {
+        lines.forEach((line, lineIndex) => {
           const messageText = `${sender}: ${line}`;
-          finalMessages.push({ text: messageText, isFromPhoto: false, category, list });
+          const sourceKey = `${item.messageId}:${lineIndex}`;
+          finalMessages.push({ text: messageText, isFromPhoto: false, category, list, sourceKey });
         });
       }
     } catch (err) {
@@ -153,64 +145,57 @@ const processBatch = async (batch, chatId, isPlan = false) => {
     telegramLogger(`Message: ${msg.text}`, 'telegram');
   });
 
-  const pyScript = path.join(__dirname, '../npai.py');
-  const pythonProcess = spawn('python', [pyScript, finalMessages.map(msg => msg.text).join('\n\n')]);
+  try {
+    const result = await npaiWorker.request('pipeline', { message: finalMessages.map(msg => msg.text).join('\n\n') });
+
+    if (result.prompt1) telegramLogger(`Prompt 1 output: ${result.prompt1}`, 'telegram');
+    if (result.prompt2) telegramLogger(`Prompt 2 output: ${result.prompt2}`, 'telegram');
+    if (result.prompt3) telegramLogger(`Prompt 3 output: ${result.prompt3}`, 'telegram');
+    if (result.error) telegramLogger(`npai pipeline error: ${result.error}`, 'error');
+    if (result.chatter_filter) {
+      const { dropped_lines: dropped, short_circuited: skipped } = result.chatter_filter;
+      telegramLogger(`npai chatter filter dropped ${dropped} line(s)${skipped ? ', batch skipped' : ''}`, 'info');
+    }
+    (result.failed_lines || []).forEach(failure => {
+      telegramLogger(`npai failed ${failure.category} line "${failure.message}": ${failure.error}`, 'error');
+    });
+    if (result.usage) {
+      const { calls, total_tokens: tokens, cost_usd: cost, latency } = result.usage;
+      telegramLogger(`npai usage: ${calls} calls, ${tokens} tokens, $${cost} in ${latency}s`, 'info');
+    }
+    Object.entries((result.metrics && result.metrics.stages) || {}).forEach(([stage, totals]) => {
+      telegramLogger(`npai stage ${stage}: ${totals.count}x, ${totals.seconds}s, ${totals.prompt_tokens + totals.completion_tokens} tokens`, 'info');
+    });
 
-  let output = '';
-  pythonProcess.stdout.on('data', (data) => {
-    output += data.toString();
-  });
+    result.photoRegos = photoRegos;
+    result.isPlan = isPlan;
+    result.sourceKeys = buildSourceKeys(finalMessages, result.line_index);
 
-  pythonProcess.stderr.on('data', (errData) => {
-    const errStr = errData.toString().trim();
-    if (errStr.includes('Raw input received') || errStr.includes('Photo analysis result') || errStr.includes('Prompt') || errStr.includes('Processing line') || errStr.includes('Photo messages to compare')) {
-      telegramLogger(`Python debug: ${errStr}`, 'debug');
+    const updateResult = await updateDatabaseFromPipeline(result);
+    if (!updateResult.success) {
+      telegramLogger(`Database update failed: ${updateResult.error}`, 'error');
     } else {
-      telegramLogger(`Python error: ${errStr}`, 'error');
+      telegramLogger(`Database updated successfully for regos: ${photoRegos.join(', ')}`, 'telegram');
     }
-  });
-
-  pythonProcess.on('close', async (code) => {
-    try {
-      const jsonMatch = output.match(/\{[\s\S]*\}/);
-      if (!jsonMatch) {
-        throw new Error('No valid JSON found in npai.py output');
-      }
-      const result = JSON.parse(jsonMatch[0]);
-
-      if (result.prompt1) telegramLogger(`Prompt 1 output: ${result.prompt1}`, 'telegram');
-      if (result.prompt2) telegramLogger(`Prompt 2 output: ${result.prompt2}`, 'telegram');
-      if (result.prompt3) telegramLogger(`Prompt 3 output: ${result.prompt3}`, 'telegram');
-
-      result.photoRegos = photoRegos;
-      result.isPlan = isPlan;
-
-      const updateResult = await updateDatabaseFromPipeline(result);
-      if (!updateResult.success) {
-        telegramLogger(`Database update failed: ${updateResult.error}`, 'error');
-      } else {
-        telegramLogger(`Database updated successfully for regos: ${photoRegos.join(', ')}`, 'telegram');
-      }
 
-      setTimeout(() => {
-        batch.forEach(item => {
-          if (item.type === 'photo' && processedPhotoPaths.has(item.path) && fs.existsSync(item.path)) {
-            fs.unlink(item.path, (err) => {
-              if (err) telegramLogger(`Error deleting photo: ${err.message}`, 'error');
-              processedPhotoPaths.delete(item.path);
-            });
-          }
-        });
-      }, 30000);
-    } catch (e) {
-      telegramLogger(`Error parsing npai.py output: ${e.message}`, 'error');
-    }
-    messageBatch = [];
-    mediaGroups.clear();
-    batchTimeout = null;
-    telegramLogger('', 'spacer');
-    telegramLogger('', 'spacer');
-  });
+    setTimeout(() => {
+      batch.forEach(item => {
+        if (item.type === 'photo' && processedPhotoPaths.has(item.path) && fs.existsSync(item.path)) {
+          fs.unlink(item.path, (err) => {
+            if (err) telegramLogger(`Error deleting photo: ${err.message}`, 'error');
+            processedPhotoPaths.delete(item.path);
+          });
+        }
+      });
+    }, 30000);
+  } catch (e) {
+    telegramLogger(`Error parsing npai.py output: ${e.message}`, 'error');
+  }
+  messageBatch = [];
+  mediaGroups.clear();
+  batchTimeout = null;
+  telegramLogger('', 'spacer');
+  telegramLogger('', 'spacer');
 };
 
 const telegramWebhook = async (req, res) => {
@@ -238,12 +223,12 @@ const telegramWebhook = async (req, res) => {
         if (message.photo) {
           const fileId = message.photo[message.photo.length - 1].file_id;
           const photoPath = await downloadTelegramPhoto(fileId);
-          batch.push({ type: 'photo', path: photoPath, chatId, sender });
+          batch.push({ type: 'photo', path: photoPath, chatId, sender, messageId: message.message_id });
           if (message.caption) {
-            batch.push({ type: 'text', content: message.caption, isCaption: true, sender });
+            batch.push({ type: 'text', content: message.caption, isCaption: true, sender, messageId: message.message_id });
           }
         } else if (message.text) {
-          batch.push({ type: 'text', content: message.text, isCaption: false, sender });
+          batch.push({ type: 'text', content: message.text, isCaption: false, sender, messageId: message.message_id });
         }
         await processBatch(batch, chatId, true);
       } else {
@@ -254,9 +239,9 @@ const telegramWebhook = async (req, res) => {
             if (!mediaGroups.has(mediaGroupId)) {
               mediaGroups.set(mediaGroupId, []);
             }
-            mediaGroups.get(mediaGroupId).push({ type: 'photo', path: photoPath, chatId, sender });
+            mediaGroups.get(mediaGroupId).push({ type: 'photo', path: photoPath, chatId, sender, messageId: message.message_id });
             if (message.caption) {
-              mediaGroups.get(mediaGroupId).push({ type: 'text', content: message.caption, isCaption: true, sender });
+              mediaGroups.get(mediaGroupId).push({ type: 'text', content: message.caption, isCaption: true, sender, messageId: message.message_id });
             }
             if (batchTimeout) {
               clearTimeout(batchTimeout);
@@ -269,9 +254,9 @@ const telegramWebhook = async (req, res) => {
               processBatch([...messageBatch, ...mediaGroupBatch], chatId);
             }, 5000);
           } else {
-            messageBatch.push({ type: 'photo', path: photoPath, chatId, sender });
+            messageBatch.push({ type: 'photo', path: photoPath, chatId, sender, messageId: message.message_id });
             if (message.caption) {
-              messageBatch.push({ type: 'text', content: message.caption, isCaption: true, sender });
+              messageBatch.push({ type: 'text', content: message.caption, isCaption: true, sender, messageId: message.message_id });
             }
             if (batchTimeout) {
               clearTimeout(batchTimeout);
@@ -279,7 +264,7 @@ const telegramWebhook = async (req, res) => {
             batchTimeout = setTimeout(() => processBatch(messageBatch, chatId), BATCH_WINDOW);
           }
         } else if (message.text) {
-          messageBatch.push({ type: 'text', content: message.text, isCaption: false, sender });
+          messageBatch.push({ type: 'text', content: message.text, isCaption: false, sender, messageId: message.message_id });
           if (mediaGroups.size > 0) {
             if (batchTimeout) {
               clearTimeout(batchTimeout);